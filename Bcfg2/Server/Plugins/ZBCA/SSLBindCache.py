@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class SSLBindCache(object):
+    '''
+    A bounded LRU cache of bound Path entries
+
+    Binding an existing object reads its PEM file, and for certs
+    parses the cert to check its expiration, on every client run.
+    The cache keeps the result of each bind, keyed by
+    (ca, ssltype, name, host, format, passphrase):  the entry
+    attributes and text, the time the object is due for renewal, and
+    the index generation of every object the text was built from (see
+    SSLObj.indexKeys()).
+
+    A cached entry is used only while none of those index entries has
+    changed and the object hasn't entered its renewal window;
+    otherwise it's dropped and the bind goes through the CA again.
+    '''
+    def __init__(self,size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = {}
+        # circular doubly-linked list of [prev, next, key, value]
+        # nodes in LRU order; self.root's next is the least recent
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def _unlink(self,node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _append(self,node):
+        last = self.root[0]
+        node[0] = last
+        node[1] = self.root
+        last[1] = self.root[0] = node
+
+    def bind(self,key,entry,cas):
+        '''
+        Bind an entry from the cache; return True on a hit.  'cas'
+        maps CA names to CA objects, to check index generations.
+        '''
+        if not self.size:
+            return False
+        now = time.time()
+        with self.lock:
+            node = self.entries.get(key)
+            if node is not None:
+                attrib, text, renew, deps = node[3]
+                if (renew is not None and now >= renew) or \
+                        [d for d in deps
+                         if cas[d[0]].index.generation(d[1]) != d[2]]:
+                    # stale
+                    self._unlink(node)
+                    del self.entries[key]
+                    node = None
+                else:
+                    # move to most recently used
+                    self._unlink(node)
+                    self._append(node)
+            if node is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+        entry.attrib.update(attrib)
+        entry.text = text
+        return True
+
+    def add(self,key,entry,obj):
+        '''
+        Cache a bound entry built from SSL object obj
+        '''
+        if not self.size or not obj.store:
+            return
+        deps = [(obj.ca.name,k,obj.ca.index.generation(k))
+                for k in obj.indexKeys()]
+        value = (dict(entry.attrib.items()),entry.text,obj.renewTime(),deps)
+        with self.lock:
+            node = self.entries.get(key)
+            if node is not None:
+                node[3] = value
+                self._unlink(node)
+            else:
+                node = [None,None,key,value]
+                self.entries[key] = node
+            self._append(node)
+            while len(self.entries) > self.size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.entries[oldest[2]]
+                self.evictions += 1
+
+    def clear(self):
+        '''Drop all cached entries'''
+        with self.lock:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None]
+
+    def stats(self):
+        '''Return a dict of cache statistics'''
+        return {
+            'size'      : self.size,
+            'entries'   : len(self.entries),
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+            }
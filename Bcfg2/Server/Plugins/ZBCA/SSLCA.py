@@ -1,6 +1,25 @@
+import copy
+import hashlib
 import logging
-from SSLObj import SSLObj
+import ConfigParser
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from SSLObj import SSLObj, SSLCAObj, genKeyText, keySpec, validKeySpec
 from SSLObjIndex import SSLObjIndex
+from SSLKeyPool import SSLKeyPool
+from SSLRenewer import SSLRenewer
+from SSLIssuer import SSLIssuer
+from SSLRevocation import SSLRevocation, reasons
+from SSLOCSP import SSLOCSPResponder
+from SSLExtensionProfile import SSLExtensionProfile, \
+    SSLExtensionProfileException
+from SSLRecord import SSLRecord
+from SSLStats import SSLStats
+from SSLTextStore import stores
+from SSLVerify import SSLVerifier
 from pprint import pformat
 
 logger = logging.getLogger(__name__)
@@ -21,16 +40,53 @@ class SSLCA(object):
         # set config defaults
         self.key_default_bits = '2048'
         self.key_default_algorithm = 'rsa'
-        self.req_default_md = 'sha512'
+        self.key_default_curve = 'secp256r1'
         self.cert_default_md = 'sha512'
         self.cert_default_days = '365'
         self.cert_default_extensions = None
+        self.cert_verify = 'false'
         self.ca_days = '1096'
+        self.index_backend = 'xml'
+        self.index_journal = 'true'
+        self.index_journal_records = '1000'
+        self.index_journal_bytes = '1048576'
+        self.text_store = 'files'
+        self.text_pack_garbage = '0.5'
+        self.key_pool_depth = '0'
+        self.key_pool_workers = '0'
+        self.key_pool_types = ''
+        self.renew_enable = 'false'
+        self.renew_days = '45'
+        self.renew_window = '01:00-05:00'
+        self.renew_rate = '60'
+        self.renew_workers = '1'
+        self.issue_processes = '0'
+        self.issue_timeout = '300'
+        self.crl_days = '7'
+        self.crl_refresh_hours = '24'
+        self.ocsp_listen = ''
+        self.ocsp_valid_hours = '24'
+        self.ocsp_refresh_minutes = '60'
         self.dn_fields = [ 'C', 'ST', 'L', 'O', 'OU', 'CN' ]
         self.dn_defaults = {}
         self.extensions = {}
+        # { profile : fingerprint }, see profileFingerprint()
+        self.fingerprints = {}
         self.basepath = '%s/CA/%s' % (plugin.data,self.name)
         self.plugin = plugin
+        self.ca_cache = {}
+        self.ca_cache_lock = threading.Lock()
+        # uuids of objects with cached binary encodings, see
+        # encodedUUIDs(); also under ca_cache_lock
+        self.encoded = None
+        # serializes index lookups and changes and serial allocation
+        # between server threads and background services; held only
+        # briefly, never across crypto jobs
+        self.lock = threading.RLock()
+        # per-index key locks, see keyLock(); { key : [lock, users] }
+        self.key_locks = {}
+        # bind path counters and stage timings
+        self.perf = SSLStats('ZBCA:%s' % self.name)
 
         # read configuration file
         self.readBasicConfig()
@@ -40,6 +96,67 @@ class SSLCA(object):
         # initialize object index & make methods available
         self.index = SSLObjIndex(self)
 
+        # PEM text storage for keys and certs
+        try:
+            self.textstore = stores[self.text_store](self)
+        except KeyError:
+            raise SSLCAException('CA "%s": unknown text_store "%s"' %
+                                 (self.name,self.text_store))
+
+        # pre-generated keys; filled in the background after start()
+        self.keypool = SSLKeyPool(self)
+
+        # background cert renewal; started by start()
+        self.renewer = SSLRenewer(self)
+
+        # crypto job runner; its worker processes are started by start()
+        self.issuer = SSLIssuer(self)
+
+        # revocation list
+        self.revocation = SSLRevocation(self)
+
+        # OCSP responder; started by start() if ocsp_listen is set
+        self.ocsp = SSLOCSPResponder(self)
+
+        # cert verification against the CA cert and chain
+        self.verifier = SSLVerifier(self)
+
+    def start(self):
+        '''
+        Start the CA's background services; called by the plugin,
+        but not by offline tools
+        '''
+        self.issuer.start()
+        self.keypool.start()
+        self.renewer.start()
+        self.ocsp.start()
+        self.reissueStale()
+
+        # watch the CA key, cert and chain for changes
+        fam = getattr(self.plugin.core,'fam',None)
+        if fam is not None and os.path.isdir('%s/SSLCA' % self.basepath):
+            fam.AddMonitor('%s/SSLCA' % self.basepath,self)
+
+    def shutdown(self):
+        '''Stop the CA's background services'''
+        self.ocsp.shutdown()
+        self.renewer.shutdown()
+        self.keypool.shutdown()
+        self.issuer.shutdown()
+
+    def stats(self):
+        '''Return a dict of CA statistics'''
+        return {
+            'keypool'   : self.keypool.stats(),
+            'renewer'   : self.renewer.stats(),
+            'issuer'    : self.issuer.stats(),
+            'revocation': self.revocation.stats(),
+            'ocsp'      : self.ocsp.stats(),
+            'perf'      : self.perf.stats(),
+            'textstore' : self.textstore.stats(),
+            'verifier'  : self.verifier.stats(),
+            }
+
     def config(self,*args,**kwargs):
         '''Convenience function to call self.plugin.config with self.name'''
         return self.plugin.config(self.name,*args,**kwargs)
@@ -64,53 +181,440 @@ class SSLCA(object):
     def readExtensionsConfig(self):
         '''
         Process the extensions config file sections for this CA:
-        [zbca:ca_name-extensions-foo]
+        [zbca:ca_name-extensions-foo]; each is compiled into an
+        SSLExtensionProfile, and a bad one stops the CA loading
+        '''
+        try:
+            for suffix,sect in self.config('extensions',True):
+                self.extensions[suffix] = SSLExtensionProfile(suffix,sect)
+        except SSLExtensionProfileException as e:
+            raise SSLCAException('CA "%s": %s' % (self.name,e.args[0]))
+        for name, profile in self.extensions.items():
+            self.fingerprints[name] = self.profileFingerprint(profile)
+        if self.cert_default_extensions is not None and \
+                self.cert_default_extensions not in self.extensions:
+            raise SSLCAException(
+                'CA "%s": cert_default_extensions profile "%s" not found' %
+                (self.name,self.cert_default_extensions))
+
+    def profileFingerprint(self,profile):
         '''
-        for suffix,sect in self.config('extensions',True):
-            self.extensions[suffix] = {}
-            for opt, val in sect:
-                self.extensions[suffix][opt] = val
+        Return a hash of the config a cert with an extensions profile
+        is issued with (see SSLCert.genCrypto()):  the profile's
+        extensions, and the CA's dn_fields and dn-defaults.  Certs
+        record it, so ones issued before the config changed can be
+        found and reissued (see reissueStale()).
+        '''
+        inputs = (profile.specs, tuple(self.dn_fields),
+                  tuple(sorted(self.dn_defaults.items())))
+        return hashlib.sha1(repr(inputs)).hexdigest()[:16]
+
+    def reissueStale(self):
+        '''
+        Queue the certs issued under an older version of their
+        extensions profile or of the DN config for reissue by the
+        renewer, which spreads them out over its window and rate;
+        return the number queued.  Certs issued before fingerprints
+        were recorded are left alone.
+        '''
+        with self.lock:
+            stale = self.index.staleProfiles(self.fingerprints)
+        if not stale:
+            return 0
+        if not self.renewer.enabled:
+            logger.warning('CA "%s": %d certs were issued with an older '
+                           'extensions profile or DN config; set '
+                           'renew_enable to reissue them in the background'
+                           % (self.name,len(stale)))
+            return 0
+        logger.info('CA "%s": queueing %d certs issued with an older '
+                    'extensions profile or DN config for reissue' %
+                    (self.name,len(stale)))
+        self.renewer.enqueue(stale)
+        return len(stale)
 
     def defaultExtensions(self):
         '''
-        Convenience function returns default extensions dict
+        Convenience function returns default extensions profile
         '''
         return self.extensions.get(self.cert_default_extensions,None)
 
+    def caFname(self,ssltype):
+        '''
+        Compute the file name of a CA object:  SSLCACert, SSLCAKey
+        or SSLCAChain
+        '''
+        return '%s/SSLCA/%s.pem' % (self.basepath,ssltype)
+
+    def caObj(self,ssltype):
+        '''
+        Return the cached CA object of type ssltype (SSLCACert,
+        SSLCAKey, SSLCAChain); it is reloaded when the file's mtime
+        changes or after invalidateCACache()
+        '''
+        mtime = os.stat(self.caFname(ssltype)).st_mtime
+        with self.ca_cache_lock:
+            cached = self.ca_cache.get(ssltype)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, SSLObj.typedict[ssltype](self))
+                self.ca_cache[ssltype] = cached
+        return cached[1]
+
+    def invalidateCACache(self,ssltype=None):
+        '''
+        Drop the cached CA objects, or just the one of type ssltype,
+        e.g. when the CA files change
+        '''
+        with self.ca_cache_lock:
+            if ssltype is None:
+                self.ca_cache.clear()
+            else:
+                self.ca_cache.pop(ssltype,None)
+
+    def encodedUUIDs(self):
+        '''
+        Return the set of uuids of objects with binary encodings
+        cached next to their PEM files (see SSLObj.getEncoded()), so
+        rewriting an object's PEM text only looks for encodings to
+        drop when it has some, rather than listing a directory of
+        every object; read from the SSLKey and SSLCert directories on
+        first use, and kept up to date by SSLObj
+        '''
+        with self.ca_cache_lock:
+            if self.encoded is None:
+                encoded = set()
+                for ssltype in ('SSLKey','SSLCert'):
+                    try:
+                        names = os.listdir('%s/%s' % (self.basepath,ssltype))
+                    except OSError:
+                        continue
+                    # encodings are <uuid>.<format> or <uuid>-<hash>.p12,
+                    # and uuid4 strings are 36 characters
+                    encoded.update([name[:36] for name in names
+                                    if not name.endswith('.pem')])
+                self.encoded = encoded
+            return self.encoded
+
+    def passphrase(self,source):
+        '''
+        Return the passphrase from a 'passphrase' spec attribute
+        source, or None if there's none:
+
+        - 'config:<option>':  an option in the [zbca:ca_name-passphrases]
+          config file section
+        - 'file:<path>':  the first line of a file; relative paths are
+          under the plugin's repository directory
+        '''
+        if not source:
+            return None
+        kind, sep, name = source.partition(':')
+        if kind == 'config':
+            try:
+                return dict(self.config('passphrases'))[name]
+            except (ConfigParser.Error, KeyError):
+                raise SSLCAException(
+                    'CA "%s": no passphrase "%s" in the passphrases '
+                    'config section' % (self.name,name))
+        elif kind == 'file':
+            try:
+                f = open(os.path.join(self.plugin.data,name),'r')
+                try:
+                    return f.readline().rstrip('\r\n')
+                finally:
+                    f.close()
+            except IOError as e:
+                raise SSLCAException('CA "%s": can\'t read passphrase '
+                                     'file: %s' % (self.name,e))
+        raise SSLCAException('CA "%s": bad passphrase source "%s"; use '
+                             '"config:<option>" or "file:<path>"' %
+                             (self.name,source))
+
+    def HandleEvent(self,event=None):
+        '''
+        FAM event on the CA's SSLCA directory:  the CA key, cert or
+        chain may have changed
+        '''
+        self.invalidateCACache()
+
     def initSSLObj(self, attrs, metadata):
         '''
         Retrieve an existing SSL object from the object index,
         or if none exists, generate a new one
         '''
+        if issubclass(SSLObj.typedict[attrs['type']], SSLCAObj):
+            # CA objects aren't indexed
+            if attrs['type'] == 'SSLCRL':
+                self.revocation.refresh()
+            return self.caObj(attrs['type'])
+
+        key = (attrs['type'],attrs['name'],attrs['host'])
+        with self.keyLock(key):
+            with self.lock:
+                with self.perf.timer('search'):
+                    elt = self.index.searchAttrs(attrs)
+                if elt is not None:
+                    # work on a copy; the indexed element is only
+                    # replaced under the lock
+                    elt = copy.deepcopy(elt)
+
+            if elt is not None:
+                self.perf.count('index_hits')
+                # object exists in index, so build the object from the
+                # element passed back by the exception
+                obj = SSLObj.init(self,elt,metadata)
+
+                # save the index if the object was invalid and regenerated,
+                # or its element was otherwise updated
+                if obj.regenerated or obj.dirty:
+                    with self.lock:
+                        self.index.update(obj)
+                        self.index.write()
+            else:
+                self.perf.count('index_misses')
+                # generate new object from attrs
+                obj = SSLObj.init(self, attrs, metadata)
+
+                # store object in index and save the index
+                if obj.store:
+                    with self.lock:
+                        self.index.store(obj)
+                        self.index.write()
+
+        if obj.regenerated:
+            self.renewer.schedule(obj)
+            self.ocsp.certIssued(obj)
+
+        return obj
+
+    @contextmanager
+    def keyLock(self,key):
+        '''
+        Context manager that holds the lock for one (ssltype,name,host)
+        index key, so one object is issued at a time per key while
+        other keys go ahead in parallel
+
+        A cert's lock may be held while taking its key's lock, never
+        the other way around; and never take a key lock while holding
+        self.lock
+        '''
+        with self.lock:
+            entry = self.key_locks.setdefault(key,[threading.RLock(),0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.key_locks[key]
+
+    def reissue(self,key):
+        '''
+        Regenerate the indexed object with the (ssltype,name,host)
+        key, e.g. to renew a cert before its client asks for it;
+        return the object, or None if it's no longer indexed
+        '''
+        metadata = self.plugin.core.build_metadata(key[2])
+        with self.keyLock(key):
+            with self.lock:
+                elt = self.index.search(*key)
+                if elt is None:
+                    return None
+                elt = copy.deepcopy(elt)
+            obj = SSLObj.init(self,elt,metadata,validate=False)
+            obj.regenerate()
+            with self.lock:
+                self.index.update(obj)
+                self.index.write()
+        self.renewer.schedule(obj)
+        self.ocsp.certIssued(obj)
+        return obj
+
+    def preissue(self,items,processes=0):
+        '''
+        Issue the objects for a batch of (attrs, metadata) pairs, e.g.
+        one spec entry for every client in a group, ahead of the
+        clients' first runs; return a dict of counts
+
+        The keys the batch needs are generated in parallel in
+        'processes' processes (0 = one per CPU) and handed to the
+        objects through the key pool; the objects are then issued in
+        turn, and the index written once at the end
+        '''
+        # find the keys that will have to be generated
+        specs = []
+        with self.lock:
+            for attrs, metadata in items:
+                specs += self.missingKeySpecs(attrs,metadata)
+        # bad specs fail later, with the key's name in the message
+        specs = [spec for spec in specs if validKeySpec(*spec)]
+
+        # generate them in parallel and add them to the key pool
+        if specs:
+            start = time.time()
+            procs = multiprocessing.Pool(processes or None)
+            try:
+                results = [(spec,procs.apply_async(genKeyText,spec))
+                           for spec in specs]
+                for spec, result in results:
+                    try:
+                        text = result.get(float(self.issue_timeout))
+                    except multiprocessing.TimeoutError:
+                        # the object generates its own key instead
+                        logger.error('CA "%s": generating a %s:%s key '
+                                     'timed out after %ss' %
+                                     (self.name,spec[0],spec[1],
+                                      self.issue_timeout))
+                        continue
+                    self.keypool.put(spec[0],spec[1],text)
+            finally:
+                procs.terminate()
+                procs.join()
+            logger.info('CA "%s": generated %d keys in %.1fs' %
+                        (self.name,len(specs),time.time() - start))
+
+        # issue the objects; hold back index writes until the end
+        issued = 0
+        with self.lock:
+            self.index.defer()
+        try:
+            for attrs, metadata in items:
+                obj = self.initSSLObj(attrs,metadata)
+                if obj.regenerated:
+                    issued += 1
+                if isinstance(obj,SSLObj.typedict['SSLCert']):
+                    keyattrs = obj.appendKeyAttrs()
+                    if keyattrs is not None:
+                        self.initSSLObj(keyattrs,metadata)
+        finally:
+            with self.lock:
+                self.index.commit()
+        return {'objects' : len(items), 'keys' : len(specs),
+                'issued' : issued}
+
+    def missingKeySpecs(self,attrs,metadata):
+        '''
+        Return the (algorithm, size) spec of each key that binding attrs
+        would generate:  the key itself if it isn't indexed yet, or
+        for a cert due for (re)issue, its key if that isn't indexed
+        '''
+        spec = keySpec(attrs.get('algorithm',self.key_default_algorithm),
+                       attrs.get('bits',self.key_default_bits),
+                       attrs.get('curve',self.key_default_curve))
+        if attrs['type'] == 'SSLKey':
+            if self.index.searchAttrs(attrs) is not None:
+                return []
+            return [spec]
+        if attrs['type'] != 'SSLCert':
+            return []
+
         elt = self.index.searchAttrs(attrs)
-        if elt is not None:
-            # object exists in index, so build the object from the
-            # element passed back by the exception
-            obj = SSLObj.init(self,elt,metadata)
-        else:
-            # generate new object from attrs
-            obj = SSLObj.init(self, attrs, metadata)
+        if elt is not None and elt.get('not_after') is not None and \
+                int(elt.get('not_after')) - time.time() > \
+                int(self.cert_replace_days) * 24*60*60:
+            return []
+        # the key gets any key type attributes in the cert spec
+        keyname = attrs.get('key')
+        if keyname is None and attrs.get('append_key'):
+            keyname = attrs['name']
+        if self.index.search('SSLKey',keyname,metadata.hostname) is not None:
+            return []
+        return [spec]
+
+    def revoke(self,name=None,host=None,serial=None,reason=None,
+               rekey=False):
+        '''
+        Revoke a cert, by the name and host of an indexed cert or by
+        serial, and update the CRL; return the serial
 
-            # store object in index and save the index
-            if obj.store:
-                self.index.store(obj)
+        An indexed cert is marked revoked, so it's reissued on its
+        next bind; with 'rekey', its key is removed from the index,
+        so the new cert gets a new key too.  'reason' is one of the
+        CRL reason codes in SSLRevocation.reasons.
+        '''
+        if reason is not None and reason not in reasons:
+            raise SSLCAException('unknown revocation reason "%s"; use one '
+                                 'of: %s' % (reason,', '.join(reasons)))
+        if name is not None:
+            key = ('SSLCert',name,host)
+            with self.keyLock(key):
+                with self.lock:
+                    elt = self.index.search(*key)
+                    if elt is None:
+                        raise SSLCAException(
+                            'CA "%s": no cert "%s" for host "%s"' %
+                            (self.name,name,host))
+                    elt = copy.deepcopy(elt)
+                if elt.get('serial') is None:
+                    # indexed before serials were recorded
+                    SSLObj.init(self,elt,None,validate=False).recordCertInfo()
+                serial = int(elt.get('serial'))
+                elt.set('revoked',str(int(time.time())))
+                with self.lock:
+                    self.index.updateElt(elt)
+                    if rekey:
+                        keyname = elt.get('key') or \
+                            (elt.get('append_key') and name)
+                        keyelt = self.index.search('SSLKey',keyname,host)
+                        if keyelt is not None:
+                            self.index.remove(keyelt)
+                    self.storeRevoked(serial,reason,name,host)
+                    self.index.write()
+        else:
+            with self.lock:
+                self.storeRevoked(int(serial),reason)
                 self.index.write()
 
-        return obj
+        self.revocation.refresh()
+        return serial
 
+    def storeRevoked(self,serial,reason=None,name=None,host=None):
+        '''
+        Add an SSLRevoked entry for serial to the index, unless it's
+        already revoked; call with self.lock held
+        '''
+        if self.index.isRevoked(serial):
+            logger.info('CA "%s": serial %d is already revoked' %
+                        (self.name,serial))
+            return
+        elt = SSLRecord('SSLRevoked',serial=str(serial),
+                        revoked=str(int(time.time())))
+        for attrname, value in (('reason',reason),('name',name),
+                                ('host',host)):
+            if value is not None:
+                elt.set(attrname,value)
+        self.index.storeElt(elt)
+
+    def backfillCertInfo(self):
+        '''
+        Record notBefore, notAfter, serial and subject hash in index
+        entries for certs issued before they were recorded; return
+        the number of certs updated
+        '''
+        count = 0
+        for elt in self.index.records('SSLCert'):
+            if elt.get('not_after') is None:
+                obj = SSLObj.init(self,elt,None,validate=False)
+                obj.recordCertInfo()
+                self.index.update(obj)
+                count += 1
+        if count:
+            self.index.write()
+        return count
 
     def newSerial(self):
         '''
         Retrieve the CA State 'serial' variable, increment the value,
         save the variable, and return the value
 
-        We don't save the index yet; the index should be together with the
-        cert for consistency
+        The index backend allocates the serial; the XML backend
+        doesn't save the index yet, since the index should be
+        together with the cert for consistency
         '''
-        serial = self.index.getCAState('serial',default=0,coerce=int)+1
-        self.index.setCAState('serial',serial)
-
-        return serial
+        with self.lock:
+            return self.index.newSerial()
 
     def tostring(self):
         '''Return a string representation of the CA object'''
@@ -0,0 +1,123 @@
+import logging
+from OpenSSL import crypto
+
+logger = logging.getLogger(__name__)
+
+class SSLExtensionProfileException(Exception):
+    pass
+
+# X509Extension objects built by profiles in this process, by spec
+# tuple; a profile sent to a worker process is rebuilt there once
+compiled = {}
+
+class SSLExtensionProfile(object):
+    '''
+    A compiled [zbca:<ca>-extensions-<name>] config section:  the
+    X509v3 extensions for certs with 'extensions="<name>"'
+
+    Each option is an extension, with the value in the format
+    'value[;arg1[;arg2]]'; the arguments are 'critical', and
+    'subject=cert' or 'issuer=ca' for extensions computed from the
+    cert or the CA cert, e.g. key IDs:
+
+    basicConstraints = CA:FALSE,pathlen:0;critical
+    subjectKeyIdentifier = hash;subject=cert
+
+    The config is parsed once, when the CA is loaded.  Extensions
+    with no subject or issuer are built then and reused for every
+    cert; only the others are built per cert, by build().  A bad
+    profile raises SSLExtensionProfileException when it's compiled,
+    so the plugin fails to load rather than failing client runs.
+
+    Profiles are picklable, so they can go to SSLIssuer worker
+    processes.
+    '''
+    def __init__(self,name,items):
+        self.name = name
+        # the (name, value) config pairs, in order
+        self.items = list(items)
+        # (name, critical, value, ((kwarg, 'cert' or 'ca'), ...))
+        self.specs = tuple([self.parse(k,v) for k, v in self.items])
+        self.check()
+
+    def parse(self,name,val):
+        '''
+        Parse one extension's config value into a spec tuple
+        '''
+        crit = False
+        kwargs = []
+        args = val.split(';')
+        val = args.pop(0).strip()
+        for arg in args:
+            arg = arg.lower().strip()
+            if arg == 'critical':
+                crit = True
+            elif arg.partition('=')[1]:
+                kwarg, sep, obj = arg.partition('=')
+                if kwarg not in ('subject','issuer') or \
+                        obj not in ('cert','ca'):
+                    raise SSLExtensionProfileException(
+                        'extensions profile "%s": unknown argument in '
+                        'extension %s: "%s"' % (self.name,name,arg))
+                kwargs.append((kwarg,obj))
+            elif arg:
+                raise SSLExtensionProfileException(
+                    'extensions profile "%s": unknown argument in '
+                    'extension %s: "%s"' % (self.name,name,arg))
+        return (name,crit,val,tuple(kwargs))
+
+    def static(self):
+        '''
+        Return a list with the prebuilt X509Extension of each
+        extension with no subject or issuer, and None for the others
+        '''
+        if self.specs not in compiled:
+            compiled[self.specs] = [
+                not kwargs and self.makeExtension(name,crit,val) or None
+                for name, crit, val, kwargs in self.specs]
+        return compiled[self.specs]
+
+    def makeExtension(self,name,crit,val,**kwargs):
+        '''Build one X509Extension'''
+        try:
+            return crypto.X509Extension(name, crit, val, **kwargs)
+        except crypto.Error as e:
+            raise SSLExtensionProfileException(
+                'extensions profile "%s": bad extension %s = %s: %s' %
+                (self.name,name,val,e))
+
+    def build(self,cert,cacert):
+        '''
+        Return the list of X509Extension objects for cert, issued
+        by cacert
+        '''
+        objs = {'cert' : cert, 'ca' : cacert}
+        extensions = []
+        for ext, spec in zip(self.static(),self.specs):
+            if ext is None:
+                name, crit, val, kwargs = spec
+                ext = self.makeExtension(name,crit,val,**dict(
+                        [(kwarg,objs[obj]) for kwarg, obj in kwargs]))
+            extensions.append(ext)
+        return extensions
+
+    def check(self):
+        '''
+        Build the static extensions, and the others for a dummy cert
+        and CA, to catch errors at startup
+        '''
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 512)
+        cacert = crypto.X509()
+        cacert.get_subject().CN = 'check'
+        cacert.set_pubkey(key)
+        cacert.add_extensions([crypto.X509Extension(
+                    'subjectKeyIdentifier', False, 'hash', subject=cacert)])
+        cert = crypto.X509()
+        cert.get_subject().CN = 'check'
+        cert.set_pubkey(key)
+        self.build(cert,cacert)
+
+    def __getstate__(self):
+        return {'name' : self.name, 'items' : self.items,
+                'specs' : self.specs}
@@ -0,0 +1,305 @@
+import hashlib
+import logging
+import os
+import re
+import uuid
+from datetime import datetime
+from OpenSSL import crypto
+from SSLObj import keyTypes, certInfo
+from SSLRecord import SSLRecord
+from SSLTextStore import SSLTextStoreException
+
+logger = logging.getLogger(__name__)
+
+class SSLImportException(Exception):
+    pass
+
+# the old SSLCA plugin's layout:  <path>/<basename>.H_<host>
+defaultMaps = [r'^(?P<name>.+)/[^/]+\.H_(?P<host>[^/]+)$']
+
+# files bigger than this aren't keys or certs
+maxFileSize = 65536
+
+class SSLImporter(object):
+    '''
+    Import keys and certs issued outside ZBCA, e.g. by scripts or
+    the old SSLCA plugin, into a CA's index
+
+    The directory tree is walked once, and each file parsed for its
+    first cert and key; certs not signed by the CA are skipped.  Keys
+    are matched to certs by public key fingerprint through two hash
+    maps, fingerprint to file path, of the keys seen so far and of
+    the certs still waiting for their key; only paths are kept in
+    memory, not PEM text, and a pair is imported as soon as both
+    halves are seen.
+
+    The Path entry name and host of each file come from the first of
+    the 'maps' regular expressions to match its path, relative to the
+    top directory, with 'name' and 'host' named groups; the default
+    matches the old SSLCA plugin's layout.  A key and cert in the
+    same file are imported as a cert with its key appended.
+
+    The PEM text is copied into the CA's text store (see
+    SSLTextStore), and the index written every 'batch' pairs.  The
+    CA's serial counter is moved past the highest imported serial.
+    '''
+    def __init__(self,ca,maps=None,batch=500,dryrun=False):
+        self.ca = ca
+        self.maps = [re.compile(m) for m in (maps or defaultMaps)]
+        for m in self.maps:
+            if 'name' not in m.groupindex or 'host' not in m.groupindex:
+                raise SSLImportException('map "%s" needs "name" and "host" '
+                                         'groups' % m.pattern)
+        self.batch = batch
+        self.dryrun = dryrun
+        self.keyAlgos = dict([(t, a) for a, t in keyTypes.items()])
+        self.cacert = ca.caObj('SSLCACert').cryptoObj()
+
+        # { fingerprint : path }
+        self.keys = {}
+        # { fingerprint : [path, ...] }
+        self.certs = {}
+        self.pending = 0
+        self.maxSerial = 0
+        self.counts = dict([(c, 0) for c in (
+                    'files', 'keys', 'certs', 'imported', 'foreign',
+                    'unmapped', 'exists', 'unreadable')])
+
+    def mapPath(self,relpath):
+        '''
+        Return the (name, host) of a file from the maps, or None
+        '''
+        for m in self.maps:
+            match = m.search(relpath)
+            if match:
+                name = match.group('name')
+                if not name.startswith('/'):
+                    name = '/' + name
+                return name, match.group('host')
+        return None
+
+    def readFile(self,path):
+        '''
+        Return the PEM text and crypto objects of the first cert and
+        key in a file as (certtext, cert, keytext, key); missing or
+        unreadable parts are None
+        '''
+        result = [None, None, None, None]
+        try:
+            if os.path.getsize(path) > maxFileSize:
+                return result
+            f = open(path,'r')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError) as e:
+            logger.warning('Can\'t read %s: %s' % (path,e))
+            return result
+        if '-----BEGIN ' not in text:
+            return result
+
+        for block in re.finditer(r'-----BEGIN ([A-Z0-9 ]+)-----.+?'
+                                 r'-----END \1-----', text, re.S):
+            label = block.group(1)
+            try:
+                if label == 'CERTIFICATE' and result[1] is None:
+                    result[1] = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                        block.group(0))
+                    result[0] = crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                                        result[1])
+                elif label.endswith('PRIVATE KEY') and result[3] is None:
+                    # encrypted keys fail to decrypt with an empty
+                    # passphrase, rather than prompting for one
+                    result[3] = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                                       block.group(0),
+                                                       lambda *args: '')
+                    result[2] = block.group(0) + '\n'
+            except crypto.Error:
+                self.counts['unreadable'] += 1
+                logger.warning('Can\'t load the %s in %s' %
+                               (label.lower(),path))
+        return result
+
+    def fingerprint(self,pkey):
+        '''Return the SHA256 fingerprint of a public key'''
+        return hashlib.sha256(crypto.dump_publickey(crypto.FILETYPE_ASN1,
+                                                    pkey)).digest()
+
+    def issuedByCA(self,cert):
+        '''Return True if the cert was signed by the CA'''
+        # check the signature as of the cert's issue time, so expired
+        # certs are imported too; a store only takes the first time
+        # set on it, so each cert gets its own
+        store = crypto.X509Store()
+        store.add_cert(self.cacert)
+        store.set_time(datetime.strptime(
+                max(cert.get_notBefore(),self.cacert.get_notBefore()),
+                '%Y%m%d%H%M%SZ'))
+        try:
+            crypto.X509StoreContext(store,cert).verify_certificate()
+            return True
+        except crypto.X509StoreContextError:
+            return False
+
+    def run(self,topdir):
+        '''
+        Walk topdir and import the pairs found; return a dict of
+        counts
+        '''
+        self.topdir = topdir
+        if not self.dryrun:
+            self.ca.index.defer()
+        try:
+            for dirpath, dirnames, filenames in os.walk(topdir):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    self.scan(os.path.join(dirpath,filename))
+            self.flush()
+        finally:
+            if not self.dryrun:
+                self.ca.index.commit()
+        self.counts['unmatched_certs'] = sum([len(paths) for paths
+                                              in self.certs.values()])
+        return self.counts
+
+    def scan(self,path):
+        '''Look for a cert and key in a file, and match them'''
+        self.counts['files'] += 1
+        certtext, cert, keytext, key = self.readFile(path)
+        if cert is not None:
+            self.counts['certs'] += 1
+            if not self.issuedByCA(cert):
+                self.counts['foreign'] += 1
+                cert = None
+        if key is not None:
+            self.counts['keys'] += 1
+            fp = self.fingerprint(key)
+            if fp not in self.keys:
+                self.keys[fp] = path
+            # certs seen before their key
+            for certpath in self.certs.pop(fp,[]):
+                self.importFile(certpath,path)
+        if cert is not None:
+            fp = self.fingerprint(cert.get_pubkey())
+            if key is not None and self.fingerprint(key) == fp:
+                # key and cert in one file
+                self.importFile(path,path,cert,certtext,keytext)
+            elif fp in self.keys:
+                self.importFile(path,self.keys[fp],cert,certtext)
+            else:
+                self.certs.setdefault(fp,[]).append(path)
+
+    def importFile(self,certpath,keypath,cert=None,certtext=None,
+                   keytext=None):
+        '''
+        Import a cert and its key from their files; the file contents
+        are passed in if they were just read
+        '''
+        if cert is None:
+            certtext, cert = self.readFile(certpath)[:2]
+        if keytext is None:
+            keytext, key = self.readFile(keypath)[2:]
+        else:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM,keytext)
+
+        certmap = self.mapPath(os.path.relpath(certpath,self.topdir))
+        keymap = self.mapPath(os.path.relpath(keypath,self.topdir))
+        if certmap is None or keymap is None or certmap[1] != keymap[1]:
+            logger.warning('No name and host for %s and key %s' %
+                           (certpath,keypath))
+            self.counts['unmapped'] += 1
+            return
+        (name, host), keyname = certmap, keymap[0]
+        with self.ca.lock:
+            if self.ca.index.search('SSLCert',name,host) is not None:
+                self.counts['exists'] += 1
+                return
+            keyelt = self.ca.index.search('SSLKey',keyname,host)
+            if keyelt is not None and not self.sameKey(keyelt,key):
+                logger.warning('%s: host %s already has a different key %s'
+                               % (certpath,host,keyname))
+                self.counts['exists'] += 1
+                return
+
+            if keyelt is None:
+                keyelt = self.keyElt(keyname,host,key)
+                self.save(keyelt,keytext)
+            self.save(self.certElt(name,host,keyname,cert),certtext)
+        self.counts['imported'] += 1
+        self.maxSerial = max(self.maxSerial,cert.get_serial_number())
+
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.flush()
+
+    def sameKey(self,elt,key):
+        '''Return True if an indexed key is the same as key'''
+        try:
+            indexed = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                             self.ca.textstore.read(elt))
+        except (IOError, OSError, SSLTextStoreException, crypto.Error) as e:
+            logger.warning('Can\'t read indexed key "%s", host "%s": %s' %
+                           (elt.get('name'),elt.get('host'),e))
+            return False
+        return self.fingerprint(indexed) == self.fingerprint(key)
+
+    def keyElt(self,name,host,key):
+        '''Return a new SSLKey index element for a key'''
+        elt = SSLRecord('SSLKey',name=name,host=host,type='file',
+                        ca=self.ca.name,owner='root',group='root',
+                        mode='0600',uuid=str(uuid.uuid4()))
+        algorithm = self.keyAlgos.get(key.type())
+        if algorithm is None:
+            raise SSLImportException('key "%s", host "%s" has an unsupported '
+                                     'type' % (name,host))
+        elt.set('algorithm',algorithm)
+        if algorithm == 'ec':
+            elt.set('curve',key.to_cryptography_key().curve.name)
+        elif algorithm != 'ed25519':
+            elt.set('bits',str(key.bits()))
+        return elt
+
+    def certElt(self,name,host,keyname,cert):
+        '''
+        Return a new SSLCert index element for a cert; the subject
+        fields are recorded, so a renewed cert keeps them
+        '''
+        info = certInfo(cert)
+        days = (int(info['not_after']) - int(info['not_before'])) // \
+            (24*60*60)
+        elt = SSLRecord('SSLCert',name=name,host=host,type='file',
+                        key=keyname,ca=self.ca.name,days=str(days),
+                        owner='root',group='root',mode='0600',
+                        uuid=str(uuid.uuid4()),**info)
+        if self.ca.cert_default_extensions is not None:
+            elt.set('extensions',self.ca.cert_default_extensions)
+        dnFields = [f.lower() for f in self.ca.dn_fields]
+        for field, value in cert.get_subject().get_components():
+            # the CN defaults to the host name
+            if field.lower() in dnFields and \
+                    not (field == 'CN' and value == host):
+                elt.set(field.lower(),value)
+        return elt
+
+    def save(self,elt,text):
+        '''
+        Write an object's PEM text into the CA's text store, and add
+        its element to the index; call with the CA lock held.  The
+        text is synced with the batch, in flush().
+        '''
+        if self.dryrun:
+            return
+        self.ca.textstore.write(elt,text,sync=False)
+        self.ca.index.storeElt(elt)
+
+    def flush(self):
+        '''Write the imported batch to the index'''
+        self.pending = 0
+        if self.dryrun:
+            return
+        with self.ca.lock:
+            self.ca.textstore.flush()
+            self.ca.index.raiseSerial(self.maxSerial)
+            self.ca.index.commit()
+            self.ca.index.defer()
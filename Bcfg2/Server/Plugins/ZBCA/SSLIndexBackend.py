@@ -0,0 +1,445 @@
+import logging
+from lxml import etree
+import os
+import posixpath
+import threading
+import json
+from SSLRecord import SSLRecord
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+logger = logging.getLogger(__name__)
+
+class SSLIndexBackendException(Exception):
+    pass
+
+class SSLIndexBackend(object):
+    '''
+    Abstract storage backend for an SSLObjIndex
+
+    The index always keeps its object elements in memory, as
+    SSLRecords; the backend loads them and persists changes to them:
+
+    - read() returns the records and CA state
+    - write() persists the index, given the records and CA state
+      changed since the last write
+    - nextSerial() atomically allocates a new CA serial number
+    '''
+    # name used for the 'index_backend' CA config option
+    name = None
+
+    def __init__(self,ca):
+        self.ca = ca
+
+    def read(self):
+        '''
+        Read the index; return a list of object records and a dict
+        of CA state variables, or None if empty
+        '''
+        raise NotImplementedError
+
+    def write(self,index,changed,removed,state):
+        '''
+        Persist the index; 'changed' is a list of new or modified
+        object records, 'removed' is a list of (ssltype,name,host)
+        keys of removed records, and 'state' is a list of changed
+        (name,value) CA state variables; return the number of bytes
+        written
+        '''
+        raise NotImplementedError
+
+    def nextSerial(self,index):
+        '''
+        Allocate and return a new serial number; the default keeps
+        the serial in the index tree's CA state
+        '''
+        serial = index.getCAState('serial',default=0,coerce=int)+1
+        index.setCAState('serial',serial)
+        return serial
+
+    def raiseSerial(self,index,serial):
+        '''
+        Make sure serials allocated from now on are greater than
+        serial, e.g. after importing certs issued elsewhere
+        '''
+        if serial > index.getCAState('serial',default=0,coerce=int):
+            index.setCAState('serial',serial)
+
+    def exists(self):
+        '''Return True if the backend has stored data'''
+        raise NotImplementedError
+
+    def importIndex(self,records,state):
+        '''
+        Replace the backend contents with a list of object records
+        and a dict of CA state variables, as returned by read()
+        '''
+        raise NotImplementedError
+
+
+class SSLXMLIndexBackend(SSLIndexBackend):
+    '''
+    The original index storage: a single pretty-printed XML file,
+    index.xml, in the CA directory
+
+    Unless the CA's 'index_journal' option is false, changes are
+    appended to a journal, index.journal, one XML record per line,
+    instead of rewriting index.xml on every write:
+
+    - an object element:  add or replace that object
+    - <State name= value=/>:  set a CA state variable
+    - <Remove ssltype= name= host=/>:  remove an object
+
+    The journal is replayed on top of index.xml when the index is
+    read, and compacted into index.xml once it grows past
+    'index_journal_records' records or 'index_journal_bytes' bytes.
+
+    index.xml is parsed and written one element at a time, so the
+    whole document is never held in memory as an lxml tree.
+    '''
+    name = 'xml'
+
+    def __init__(self,ca):
+        SSLIndexBackend.__init__(self,ca)
+        self.journal = str(ca.index_journal).lower() == 'true'
+        self.maxRecords = int(ca.index_journal_records)
+        self.maxBytes = int(ca.index_journal_bytes)
+        self.records = 0
+
+    def indexFilePath(self):
+        '''Convenience function returns name of index file'''
+        return '%s/index.xml' % self.ca.basepath
+
+    def journalFilePath(self):
+        '''Convenience function returns name of journal file'''
+        return '%s/index.journal' % self.ca.basepath
+
+    def exists(self):
+        return posixpath.exists(self.indexFilePath()) or \
+            posixpath.exists(self.journalFilePath())
+
+    def read(self):
+        if not self.exists():
+            return None
+        # avoid a circular import
+        from SSLObjIndex import SSLObjIndex
+        records = []
+        state = {}
+        if posixpath.exists(self.indexFilePath()):
+            for event, elt in etree.iterparse(self.indexFilePath(),
+                                              remove_blank_text=True):
+                if elt.tag == 'State':
+                    state[elt.get('name')] = elt.get('value')
+                elif elt.tag in SSLObjIndex.setnamelist and \
+                        elt.tag != 'SSLCAState':
+                    records.append(SSLRecord.fromElement(elt))
+                else:
+                    continue
+                # free the parsed elements as we go
+                elt.clear()
+                while elt.getprevious() is not None:
+                    del elt.getparent()[0]
+        if posixpath.exists(self.journalFilePath()):
+            records, self.records = self._replay(records,state)
+        return records, state
+
+    def _replay(self,records,state):
+        '''
+        Apply the journal records to a list of object records and a
+        CA state dict; return the new list of object records and the
+        number of journal records
+        '''
+        # avoid a circular import
+        from SSLObjIndex import SSLObjIndex
+        # { key : position in records }
+        positions = dict([(SSLObjIndex.eltKey(elt), i)
+                          for i, elt in enumerate(records)])
+
+        count = 0
+        f = open(self.journalFilePath(),'r')
+        try:
+            for line in f:
+                try:
+                    record = etree.fromstring(line)
+                except etree.XMLSyntaxError:
+                    # a torn write at the end of the journal
+                    logger.warning('CA "%s": ignoring bad journal record '
+                                   '%d' % (self.ca.name,count+1))
+                    break
+                count += 1
+                if record.tag == 'State':
+                    state[record.get('name')] = record.get('value')
+                elif record.tag == 'Remove':
+                    i = positions.pop((record.get('ssltype'),
+                                       record.get('name'),
+                                       record.get('host')),None)
+                    if i is not None:
+                        records[i] = None
+                else:
+                    record = SSLRecord.fromElement(record)
+                    key = SSLObjIndex.eltKey(record)
+                    if key in positions:
+                        records[positions[key]] = record
+                    else:
+                        positions[key] = len(records)
+                        records.append(record)
+        finally:
+            f.close()
+        return [elt for elt in records if elt is not None], count
+
+    def write(self,index,changed=(),removed=(),state=()):
+        if not self.journal:
+            # also drops any journal left from when it was enabled
+            return self.compact(index.records(),index.state)
+
+        records = [elt.tostring() for elt in changed]
+        records += [etree.tostring(etree.Element(
+                    'Remove',ssltype=key[0],name=key[1],host=key[2]))
+                    for key in removed]
+        records += [etree.tostring(etree.Element(
+                    'State',name=name,value=value))
+                    for name, value in state]
+        if not records:
+            return 0
+
+        data = ''.join([r + '\n' for r in records])
+        fd = os.open(self.journalFilePath(),
+                     os.O_CREAT|os.O_WRONLY|os.O_APPEND, 0600)
+        try:
+            os.write(fd,data)
+            os.fsync(fd)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        self.records += len(records)
+
+        if self.records >= self.maxRecords or size >= self.maxBytes:
+            return len(data) + self.compact(index.records(),index.state)
+        return len(data)
+
+    def _writeIndex(self,records,state):
+        '''
+        Write the records, sorted by key, and CA state to index.xml
+        one element at a time, through a temp file so a crash never
+        leaves a partial index; return the size of the file
+        '''
+        # avoid a circular import
+        from SSLObjIndex import SSLObjIndex
+        containers = dict([(setname, []) for setname
+                           in SSLObjIndex.setnamelist.values()])
+        for elt in sorted(records,key=SSLObjIndex.eltKey):
+            containers[SSLObjIndex.setnamelist[elt.tag]].append(elt)
+
+        tmpname = self.indexFilePath() + '.new'
+        f = open(tmpname,'w')
+        try:
+            with etree.xmlfile(f) as xf:
+                with xf.element('ZBCAIndex'):
+                    for setname in sorted(containers):
+                        xf.write('\n  ')
+                        with xf.element(setname):
+                            if setname == 'SSLCAState':
+                                elts = [etree.Element('State',name=name,
+                                                      value=value)
+                                        for name, value
+                                        in sorted(state.items())]
+                            else:
+                                elts = containers[setname]
+                            for elt in elts:
+                                if isinstance(elt,SSLRecord):
+                                    elt = elt.toElement()
+                                xf.write('\n    ',elt)
+                            if elts:
+                                xf.write('\n  ')
+                    xf.write('\n')
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        finally:
+            f.close()
+        os.rename(tmpname,self.indexFilePath())
+        return size
+
+    def compact(self,records,state):
+        '''
+        Fold the journal into index.xml; replaying a journal that
+        wasn't removed after a crash here is harmless; return the
+        size of index.xml
+        '''
+        logger.debug('CA "%s": compacting index journal (%d records)' %
+                     (self.ca.name,self.records))
+        size = self._writeIndex(records,state)
+        if posixpath.exists(self.journalFilePath()):
+            os.unlink(self.journalFilePath())
+        self.records = 0
+        return size
+
+    def importIndex(self,records,state):
+        self.compact(records,state)
+
+
+class SSLSQLiteIndexBackend(SSLIndexBackend):
+    '''
+    Index storage in a SQLite database, index.sqlite, in the CA
+    directory
+
+    Object elements are rows keyed by their (ssltype, name, host)
+    index key (see SSLObjIndex.eltKey()), with the element attributes
+    stored as JSON; only changed rows are written.
+    CA state is kept in its own table, and serial numbers are
+    allocated inside a transaction so concurrent writers never hand
+    out the same serial.
+    '''
+    name = 'sqlite'
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS objects ('
+        ' ssltype TEXT NOT NULL,'
+        ' name TEXT NOT NULL,'
+        ' host TEXT NOT NULL,'
+        ' attrs TEXT NOT NULL,'
+        ' PRIMARY KEY (ssltype, name, host))',
+        'CREATE INDEX IF NOT EXISTS objects_host ON objects (host)',
+        'CREATE TABLE IF NOT EXISTS state ('
+        ' name TEXT PRIMARY KEY,'
+        ' value TEXT NOT NULL)',
+        )
+
+    def __init__(self,ca):
+        SSLIndexBackend.__init__(self,ca)
+        if sqlite3 is None:
+            raise SSLIndexBackendException(
+                'CA "%s": index_backend "sqlite" needs the sqlite3 module'
+                % ca.name)
+        self.lock = threading.RLock()
+        self._conn = None
+
+    def dbFilePath(self):
+        '''Convenience function returns name of database file'''
+        return '%s/index.sqlite' % self.ca.basepath
+
+    def exists(self):
+        return posixpath.exists(self.dbFilePath())
+
+    def conn(self):
+        '''
+        Open the database on first use; the connection is shared by
+        the server threads, serialized by self.lock
+        '''
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.dbFilePath(),
+                                         isolation_level='IMMEDIATE',
+                                         check_same_thread=False)
+            for stmt in self.schema:
+                self._conn.execute(stmt)
+            self._conn.commit()
+        return self._conn
+
+    def read(self):
+        if not self.exists():
+            return None
+        with self.lock:
+            conn = self.conn()
+            records = [SSLRecord(ssltype,json.loads(attrs))
+                       for ssltype, attrs in conn.execute(
+                    'SELECT ssltype, attrs FROM objects ORDER BY rowid')]
+            state = dict([(str(name), str(value)) for name, value
+                          in conn.execute('SELECT name, value FROM state')])
+        return records, state
+
+    def _writeRows(self,conn,changed,removed,state):
+        '''
+        Upsert and delete object rows and state rows; return the
+        size of the object attributes written
+        '''
+        # avoid a circular import
+        from SSLObjIndex import SSLObjIndex
+        rows = [SSLObjIndex.eltKey(elt) + (json.dumps(dict(elt.items())),)
+                for elt in changed]
+        conn.executemany(
+            'INSERT OR REPLACE INTO objects (ssltype, name, host, attrs) '
+            'VALUES (?, ?, ?, ?)', rows)
+        conn.executemany(
+            'DELETE FROM objects WHERE ssltype = ? AND name = ? AND host = ?',
+            removed)
+        conn.executemany(
+            'INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)',
+            state)
+        return sum([len(row[3]) for row in rows])
+
+    def write(self,index,changed=(),removed=(),state=()):
+        # the serial is kept up to date by nextSerial()
+        with self.lock:
+            conn = self.conn()
+            try:
+                size = self._writeRows(conn,changed,removed,
+                                       [(name,value) for name, value in state
+                                        if name != 'serial'])
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        return size
+
+    def nextSerial(self,index):
+        with self.lock:
+            conn = self.conn()
+            try:
+                conn.execute(
+                    'INSERT OR IGNORE INTO state (name, value) '
+                    'VALUES (?, ?)', ('serial',
+                                      str(index.getCAState(
+                                'serial',default=0,coerce=int))))
+                conn.execute(
+                    'UPDATE state SET value = CAST(value AS INTEGER) + 1 '
+                    'WHERE name = ?', ('serial',))
+                serial = int(conn.execute(
+                        'SELECT value FROM state WHERE name = ?',
+                        ('serial',)).fetchone()[0])
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        index.setCAState('serial',serial)
+        return serial
+
+    def raiseSerial(self,index,serial):
+        with self.lock:
+            conn = self.conn()
+            try:
+                conn.execute(
+                    'INSERT OR IGNORE INTO state (name, value) '
+                    'VALUES (?, ?)', ('serial',
+                                      str(index.getCAState(
+                                'serial',default=0,coerce=int))))
+                conn.execute(
+                    'UPDATE state SET value = MAX(CAST(value AS INTEGER), ?) '
+                    'WHERE name = ?', (serial,'serial'))
+                serial = int(conn.execute(
+                        'SELECT value FROM state WHERE name = ?',
+                        ('serial',)).fetchone()[0])
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        index.setCAState('serial',serial)
+
+    def importIndex(self,records,state):
+        with self.lock:
+            conn = self.conn()
+            try:
+                conn.execute('DELETE FROM objects')
+                conn.execute('DELETE FROM state')
+                self._writeRows(conn,records,[],state.items())
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+
+
+# map 'index_backend' config values to backend classes
+backends = dict([(b.name, b) for b in (SSLXMLIndexBackend,
+                                       SSLSQLiteIndexBackend)])
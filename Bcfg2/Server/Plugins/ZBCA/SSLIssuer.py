@@ -0,0 +1,99 @@
+import logging
+import multiprocessing
+import threading
+import time
+from SSLObj import SSLObjException
+
+logger = logging.getLogger(__name__)
+
+class SSLIssuer(object):
+    '''
+    Runs a CA's crypto jobs:  key generation and cert signing (the
+    genKeyText() and issueCertText() functions in SSLObj)
+
+    With 'issue_processes' set, the jobs are sent to a pool of that
+    many worker processes, so concurrent binds from the server's
+    threads and batch jobs use every core; the calling thread waits
+    for its result without holding the GIL.  With 0 (the default),
+    or before start(), jobs run in the calling thread.
+
+    Everything that touches shared state stays in the server
+    process:  SSLCA allocates serials and commits index changes
+    under its lock, and objects for the same index key are issued
+    one at a time (see SSLCA.keyLock()), so jobs for different hosts
+    run in parallel without duplicate serials or lost updates.
+
+    A pooled job that takes longer than 'issue_timeout' seconds
+    fails the bind with an SSLObjException, rather than holding the
+    calling thread and its key lock forever.
+    '''
+    def __init__(self,ca):
+        self.ca = ca
+        self.processes = int(ca.issue_processes)
+        self.timeout = float(ca.issue_timeout)
+        self.procs = None
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.busy = 0
+        self.seconds = 0.0
+        self.timeouts = 0
+
+    def start(self):
+        '''Start the worker processes'''
+        if self.processes and self.procs is None:
+            self.procs = multiprocessing.Pool(self.processes)
+
+    def shutdown(self):
+        '''Stop the worker processes'''
+        if self.procs is not None:
+            procs, self.procs = self.procs, None
+            procs.terminate()
+            procs.join()
+
+    def pooled(self):
+        '''
+        Return True if jobs go to worker processes; their arguments
+        and results must then be picklable, e.g. PEM text rather
+        than pyOpenSSL objects
+        '''
+        return self.procs is not None
+
+    def run(self,func,*args):
+        '''
+        Run func(*args) in a worker process, or in this thread if
+        there are none, and return its result; exceptions raised by
+        func are re-raised here; a pooled job that doesn't finish in
+        'issue_timeout' seconds raises SSLObjException
+        '''
+        start = time.time()
+        with self.lock:
+            self.busy += 1
+        try:
+            procs = self.procs
+            if procs is None:
+                return func(*args)
+            try:
+                return procs.apply_async(func,args).get(self.timeout)
+            except multiprocessing.TimeoutError:
+                with self.lock:
+                    self.timeouts += 1
+                raise SSLObjException('CA "%s": %s timed out after %ss in '
+                                      'the issue processes' %
+                                      (self.ca.name,func.__name__,
+                                       self.ca.issue_timeout))
+        finally:
+            with self.lock:
+                self.busy -= 1
+                self.jobs += 1
+                self.seconds += time.time() - start
+
+    def stats(self):
+        '''Return a dict of issuer statistics'''
+        with self.lock:
+            return {
+                'processes' : self.procs is not None and self.processes or 0,
+                'jobs'      : self.jobs,
+                'busy'      : self.busy,
+                'seconds'   : round(self.seconds,3),
+                'timeouts'  : self.timeouts,
+                }
@@ -0,0 +1,223 @@
+import logging
+import multiprocessing
+import os
+import posixpath
+import threading
+import uuid
+from SSLObj import genKeyText, keySpec, validKeySpec, keyTypes
+
+logger = logging.getLogger(__name__)
+
+class SSLKeyPoolException(Exception):
+    pass
+
+class SSLKeyPool(object):
+    '''
+    A pool of pre-generated keys for a CA, keyed by (algorithm, size)
+    spec (see SSLObj.keySpec())
+
+    Key generation is the slowest part of binding a new key, so a
+    background thread keeps each pool filled to 'key_pool_depth' keys
+    by farming generation out to 'key_pool_workers' processes.
+    SSLKey.genCrypto() pops a ready key with pop(), and only
+    generates one inline when the pool is empty.
+
+    Pooled keys are kept on disk, mode 0600, under
+    CA/<name>/SSLKeyPool/<algorithm>-<size>/ so they survive
+    restarts.  The pool always tracks the CA's default key type and
+    any types listed in 'key_pool_types' (e.g. 'rsa:4096,
+    ec:secp384r1,ed25519'); other types are added the first time a
+    key of that type misses.  ec and ed25519 types are skipped, with a
+    warning, when the cryptography package isn't installed.
+
+    With a depth of 0 (the default) nothing is generated in the
+    background, but keys put() into the pool, e.g. by batch
+    pre-issuance, are still handed out.
+    '''
+    def __init__(self,ca):
+        self.ca = ca
+        self.depth = int(ca.key_pool_depth)
+        self.workers = int(ca.key_pool_workers) or \
+            multiprocessing.cpu_count()
+        self.specs = set([keySpec(ca.key_default_algorithm,
+                                  ca.key_default_bits,
+                                  ca.key_default_curve)])
+        for spec in ca.key_pool_types.split(','):
+            if spec.strip():
+                algorithm, sep, size = spec.strip().partition(':')
+                self.specs.add((algorithm,size))
+        # types are only checked when the pool is in use; those that
+        # need the cryptography package are skipped without it
+        if self.depth:
+            for algorithm, size in list(self.specs):
+                if algorithm in ('ec','ed25519') and \
+                        algorithm not in keyTypes:
+                    logger.warning('CA "%s": key pool type "%s:%s" needs '
+                                   'the cryptography package; skipping it'
+                                   % (ca.name,algorithm,size))
+                    self.specs.discard((algorithm,size))
+                elif not validKeySpec(algorithm,size):
+                    raise SSLKeyPoolException(
+                        'CA "%s": bad or unsupported key pool type "%s:%s"'
+                        % (ca.name,algorithm,size))
+
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+        self.procs = None
+        self.load()
+
+    def pooldir(self,spec=None):
+        '''
+        Convenience function returns the pool directory, or the
+        directory for an (algorithm, size) spec
+        '''
+        path = '%s/SSLKeyPool' % self.ca.basepath
+        if spec is not None:
+            path = '%s/%s-%s' % ((path,) + tuple(spec))
+        return path
+
+    def load(self):
+        '''
+        Scan the pool directory for keys saved by a previous run
+        '''
+        if not posixpath.isdir(self.pooldir()):
+            return
+        for dirname in os.listdir(self.pooldir()):
+            spec = dirname.partition('-')[::2]
+            if not validKeySpec(*spec):
+                continue
+            self.keys[spec] = [
+                '%s/%s' % (self.pooldir(spec),f)
+                for f in os.listdir(self.pooldir(spec))
+                if f.endswith('.pem')]
+
+    def pop(self,algorithm,size):
+        '''
+        Remove a key from the pool and return its PEM text, or
+        return None if the pool is empty
+        '''
+        spec = (algorithm,str(size))
+        with self.lock:
+            if self.keys.get(spec):
+                fname = self.keys[spec].pop()
+                self.hits += 1
+            else:
+                fname = None
+                self.misses += 1
+                if self.depth and spec not in self.specs \
+                        and validKeySpec(*spec):
+                    self.specs.add(spec)
+            # wake up the fill thread
+            self.cond.notify()
+        if fname is None:
+            return None
+
+        f = open(fname,'r')
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        os.unlink(fname)
+        return text
+
+    def put(self,algorithm,size,text):
+        '''
+        Add a key's PEM text to the pool
+        '''
+        spec = (algorithm,str(size))
+        if not posixpath.isdir(self.pooldir(spec)):
+            os.makedirs(self.pooldir(spec),0700)
+        fname = '%s/%s.pem' % (self.pooldir(spec),uuid.uuid4())
+        f = os.fdopen(os.open(fname,os.O_CREAT|os.O_EXCL|os.O_WRONLY,0600),
+                      'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        with self.lock:
+            self.keys.setdefault(spec,[]).append(fname)
+
+    def start(self):
+        '''
+        Start the worker processes and the thread that keeps the
+        pool filled
+        '''
+        if not self.depth or self.running:
+            return
+        self.running = True
+        self.procs = multiprocessing.Pool(self.workers)
+        self.thread = threading.Thread(target=self.fill,
+                                       name='ZBCA %s key pool' % self.ca.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self):
+        '''
+        Fill thread main loop:  generate keys for any spec below the
+        pool depth, a round of at most 'key_pool_workers' keys at a
+        time; sleep until a key is popped otherwise
+        '''
+        while self.running:
+            with self.lock:
+                jobs = []
+                for spec in self.specs:
+                    jobs += [spec] * (self.depth - len(self.keys.get(spec,[])))
+                if not jobs:
+                    self.cond.wait(60)
+                    continue
+            results = [(spec,self.procs.apply_async(genKeyText,spec))
+                       for spec in jobs[:self.workers]]
+            failed = False
+            for spec, result in results:
+                try:
+                    text = result.get(float(self.ca.issue_timeout))
+                except multiprocessing.TimeoutError:
+                    logger.error('CA "%s": key pool timed out generating '
+                                 'a %s:%s key after %ss' %
+                                 (self.ca.name,spec[0],spec[1],
+                                  self.ca.issue_timeout))
+                    failed = True
+                    continue
+                except Exception as e:
+                    logger.error('CA "%s": key pool failed to generate '
+                                 'a %s:%s key: %s' %
+                                 (self.ca.name,spec[0],spec[1],e))
+                    failed = True
+                    continue
+                if not self.running:
+                    return
+                self.put(spec[0],spec[1],text)
+                self.generated += 1
+            if failed:
+                # back off rather than spin on a persistent error
+                with self.lock:
+                    self.cond.wait(60)
+
+    def shutdown(self):
+        '''Stop the fill thread and the worker processes'''
+        if not self.running:
+            return
+        self.running = False
+        with self.lock:
+            self.cond.notify()
+        self.procs.terminate()
+        self.procs.join()
+
+    def stats(self):
+        '''Return a dict of pool statistics'''
+        with self.lock:
+            sizes = dict([('%s:%s' % spec, len(keys))
+                          for spec, keys in self.keys.items()])
+        return {
+            'depth'     : self.depth,
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'generated' : self.generated,
+            'sizes'     : sizes,
+            }
@@ -0,0 +1,382 @@
+import base64
+import logging
+import threading
+import time
+import urllib
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime, timedelta
+from OpenSSL import crypto
+from SSLObj import HAS_CRYPTOGRAPHY
+
+if HAS_CRYPTOGRAPHY:
+    from cryptography import x509
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.x509 import ocsp
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+
+logger = logging.getLogger(__name__)
+
+class SSLOCSPException(Exception):
+    pass
+
+class SSLOCSPResponder(object):
+    '''
+    An OCSP responder for a CA, answering from the CA's index
+
+    The responder keeps a table of the CA's serials, built from the
+    index:  { serial : (not_after, revoked, reason) }, and a cache of
+    signed responses keyed by (serial, CertID hash algorithm).  Every
+    'ocsp_refresh_minutes' minutes a thread re-signs the SHA1 (the
+    CertID hash clients normally use) responses of all unexpired
+    serials that are missing or past half their 'ocsp_valid_hours'
+    validity, so a query is a request parse and two dict lookups;
+    responses for other hash algorithms are signed on first query
+    and cached.
+
+    Revocations are picked up on the next query from the index's
+    revocation log (see SSLObjIndex), and certs issued by this
+    process from SSLCA.initSSLObj(); a standalone responder ('zbca
+    ocsp') instead reloads the index on each refresh.  Serials the
+    index doesn't know, or whose certs have expired, get an
+    'unauthorized' error response, which needs no signature.  As RFC
+    5019 allows, request nonces are ignored, since responses are
+    signed ahead of time.
+
+    With 'ocsp_listen' set to 'host:port', the Bcfg2 server runs the
+    responder in a thread, answering RFC 6960 GET and POST requests
+    on any URL path.
+    '''
+    def __init__(self,ca,reload=False):
+        self.ca = ca
+        self.reload = reload
+        self.listen = ca.ocsp_listen
+        self.validSeconds = int(ca.ocsp_valid_hours) * 60*60
+        self.refreshSeconds = int(ca.ocsp_refresh_minutes) * 60
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.table = {}
+        self.responses = {}
+        self.logPos = 0
+        self.resets = None
+        self.running = False
+        self.loaded = False
+        self.threads = []
+        self.httpd = None
+        self.queries = 0
+        self.hits = 0
+        self.signed = 0
+        self.unauthorized = 0
+        self.malformed = 0
+        self.unsupported = 0
+
+    def load(self):
+        '''
+        Load the CA cert and key, and pre-build the error responses;
+        done lazily, so CAs without an OCSP responder don't need the
+        cryptography package
+        '''
+        if self.loaded:
+            return
+        if not HAS_CRYPTOGRAPHY:
+            raise SSLOCSPException('CA "%s": the OCSP responder needs the '
+                                   'cryptography package' % self.ca.name)
+        self.cacert = self.ca.caObj('SSLCACert').cryptoObj()
+        self.issuer = self.cacert.to_cryptography()
+        self.cakey = serialization.load_pem_private_key(
+            self.ca.caObj('SSLCAKey').text,None,default_backend())
+        if isinstance(self.cakey,ed25519.Ed25519PrivateKey):
+            self.md = None
+        else:
+            self.md = getattr(hashes,self.ca.cert_default_md.upper())()
+        # the issuer name and key hashes a request's CertID should
+        # have, by hash algorithm name
+        self.issuerHashes = {}
+        for md in (hashes.SHA1,hashes.SHA256,hashes.SHA384,hashes.SHA512):
+            req = ocsp.OCSPRequestBuilder().add_certificate(
+                self.stubCert(1),self.issuer,md()).build()
+            self.issuerHashes[md.name] = (req.issuer_name_hash,
+                                          req.issuer_key_hash)
+        self.errorResponses = dict([
+                (status, ocsp.OCSPResponseBuilder.build_unsuccessful(
+                        status).public_bytes(serialization.Encoding.DER))
+                for status in (ocsp.OCSPResponseStatus.MALFORMED_REQUEST,
+                               ocsp.OCSPResponseStatus.UNAUTHORIZED)])
+        self.loaded = True
+
+    def stubCert(self,serial):
+        '''
+        Return a cert with just the serial and the CA's subject as
+        issuer, which is all an OCSP CertID is built from; this way
+        responses are signed without reading the issued certs
+        '''
+        cert = crypto.X509()
+        cert.set_serial_number(serial)
+        cert.set_issuer(self.cacert.get_subject())
+        return cert.to_cryptography()
+
+    def build(self):
+        '''
+        Build the serial table from the index, dropping the cached
+        responses of serials whose entries changed
+        '''
+        index = self.ca.index
+        table = {}
+        with self.ca.lock:
+            for elt in index.records('SSLCert'):
+                if elt.get('serial') is not None and \
+                        elt.get('not_after') is not None:
+                    table[int(elt.get('serial'))] = \
+                        (int(elt.get('not_after')),None,None)
+            for elt in index.records('SSLRevoked'):
+                serial = int(elt.get('serial'))
+                table[serial] = self.revokedEntry(elt,table.get(serial))
+            logPos = len(index.revokedLog)
+            resets = index.revokedResets
+        with self.lock:
+            for key in self.responses.keys():
+                if table.get(key[0]) != self.table.get(key[0]):
+                    del self.responses[key]
+            self.table = table
+            self.logPos = logPos
+            self.resets = resets
+
+    def revokedEntry(self,elt,entry):
+        '''
+        Return the serial table entry for an SSLRevoked element; a
+        revoked serial without an indexed cert stays in the table
+        until its revocation is removed
+        '''
+        notAfter = entry is not None and entry[0] or None
+        return (notAfter,int(elt.get('revoked')),elt.get('reason'))
+
+    def sync(self):
+        '''
+        Pick up revocations made since the table was built:  cheap
+        unless something was revoked
+        '''
+        index = self.ca.index
+        if index.revokedResets != self.resets:
+            self.build()
+        elif len(index.revokedLog) > self.logPos:
+            with self.ca.lock:
+                serials = index.revokedLog[self.logPos:]
+                elts = [index.search('SSLRevoked',str(serial),'')
+                        for serial in serials]
+                logPos = len(index.revokedLog)
+            with self.lock:
+                for serial, elt in zip(serials,elts):
+                    self.table[serial] = self.revokedEntry(
+                        elt,self.table.get(serial))
+                    self.dropResponses(serial)
+                self.logPos = logPos
+
+    def certIssued(self,obj):
+        '''Add a newly issued cert to the serial table'''
+        if not self.running or obj.attrib('serial') is None:
+            return
+        with self.lock:
+            serial = int(obj.attrib('serial'))
+            self.table[serial] = (int(obj.attrib('not_after')),None,None)
+            self.dropResponses(serial)
+
+    def dropResponses(self,serial):
+        '''Drop a serial's cached responses; call with self.lock held'''
+        for name in self.issuerHashes:
+            self.responses.pop((serial,name),None)
+
+    def sign(self,serial,md):
+        '''
+        Sign and cache a response for serial with CertID hash md;
+        return the response, or None if the serial isn't in the
+        table or its cert has expired
+        '''
+        now = int(time.time())
+        entry = self.table.get(serial)
+        if entry is None or (entry[1] is None and entry[0] <= now):
+            return None
+        notAfter, revoked, reason = entry
+        thisUpdate = datetime.utcfromtimestamp(now)
+        if revoked is None:
+            status = ocsp.OCSPCertStatus.GOOD
+            revocationTime = reasonFlag = None
+        else:
+            status = ocsp.OCSPCertStatus.REVOKED
+            revocationTime = datetime.utcfromtimestamp(revoked)
+            # CRL reason names are the x509.ReasonFlags values, but
+            # for the case of the first letter
+            reasonFlag = reason and \
+                x509.ReasonFlags(reason[0].lower() + reason[1:]) or None
+        builder = ocsp.OCSPResponseBuilder().add_response(
+            self.stubCert(serial),self.issuer,md,status,
+            thisUpdate,thisUpdate + timedelta(seconds=self.validSeconds),
+            revocationTime,reasonFlag).responder_id(
+            ocsp.OCSPResponderEncoding.HASH,self.issuer)
+        response = builder.sign(self.cakey,self.md).public_bytes(
+            serialization.Encoding.DER)
+        with self.lock:
+            # don't cache over a revocation made while signing
+            if self.table.get(serial) == entry:
+                self.responses[(serial,md.name)] = \
+                    (response,now + self.validSeconds)
+            self.signed += 1
+        return response
+
+    def presign(self):
+        '''
+        Sign SHA1 responses for every serial that has none, or whose
+        response is past half its validity
+        '''
+        due = time.time() + self.validSeconds / 2
+        with self.lock:
+            serials = [serial for serial in self.table
+                       if self.responses.get((serial,'sha1'),(0,0))[1] < due]
+        for serial in serials:
+            self.sign(serial,hashes.SHA1())
+
+    def respond(self,der):
+        '''Return the DER response to a DER OCSP request'''
+        self.queries += 1
+        try:
+            req = ocsp.load_der_ocsp_request(der)
+            md = req.hash_algorithm
+        except UnsupportedAlgorithm:
+            # a CertID hash cryptography doesn't know can't be ours
+            self.unsupported += 1
+            return self.errorResponses[ocsp.OCSPResponseStatus.UNAUTHORIZED]
+        except (ValueError, TypeError, NotImplementedError):
+            # NotImplementedError:  more than one CertID in the request
+            self.malformed += 1
+            return self.errorResponses[
+                ocsp.OCSPResponseStatus.MALFORMED_REQUEST]
+        if self.issuerHashes.get(md.name) != (req.issuer_name_hash,
+                                              req.issuer_key_hash):
+            self.unauthorized += 1
+            return self.errorResponses[ocsp.OCSPResponseStatus.UNAUTHORIZED]
+
+        self.sync()
+        cached = self.responses.get((req.serial_number,md.name))
+        if cached is not None and cached[1] > time.time():
+            self.hits += 1
+            return cached[0]
+        response = self.sign(req.serial_number,md)
+        if response is None:
+            self.unauthorized += 1
+            return self.errorResponses[ocsp.OCSPResponseStatus.UNAUTHORIZED]
+        return response
+
+    def start(self,listen=None):
+        '''
+        Build the table and start the refresh thread, and an HTTP
+        server thread on 'listen' or 'ocsp_listen', if set
+        '''
+        listen = listen or self.listen
+        if not listen or self.running:
+            return
+        self.load()
+        self.running = True
+        self.build()
+        host, sep, port = listen.rpartition(':')
+        self.httpd = SSLOCSPHTTPServer((host,int(port)),self)
+        self.threads = [
+            threading.Thread(target=self.refresher,
+                             name='ZBCA %s OCSP refresh' % self.ca.name),
+            threading.Thread(target=self.httpd.serve_forever,
+                             name='ZBCA %s OCSP server' % self.ca.name)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        logger.info('CA "%s": OCSP responder listening on %s:%d' %
+                    ((self.ca.name,) + self.httpd.server_address[:2]))
+
+    def refresher(self):
+        '''Refresh thread main loop:  keep the responses signed'''
+        while self.running:
+            try:
+                if self.reload:
+                    with self.ca.lock:
+                        self.ca.index.reload()
+                self.build()
+                self.presign()
+            except Exception as e:
+                logger.error('CA "%s": OCSP refresh failed: %s' %
+                             (self.ca.name,e))
+            with self.lock:
+                if self.running:
+                    self.cond.wait(self.refreshSeconds)
+
+    def shutdown(self):
+        '''Stop the threads'''
+        if not self.running:
+            return
+        self.running = False
+        with self.lock:
+            self.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for thread in self.threads:
+            thread.join(10)
+
+    def stats(self):
+        '''Return a dict of responder statistics'''
+        return {
+            'serials'       : len(self.table),
+            'cached'        : len(self.responses),
+            'queries'       : self.queries,
+            'hits'          : self.hits,
+            'signed'        : self.signed,
+            'unauthorized'  : self.unauthorized,
+            'malformed'     : self.malformed,
+            'unsupported'   : self.unsupported,
+            }
+
+
+class SSLOCSPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answer RFC 6960 OCSP requests:  POSTed DER, or GET with the
+    base64 DER request as the last URL path component
+    '''
+    # clients expect persistent connections
+    protocol_version = 'HTTP/1.1'
+    # requests are small; refuse anything bigger
+    maxRequest = 10240
+
+    def do_GET(self):
+        try:
+            der = base64.b64decode(
+                urllib.unquote(self.path.rstrip('/').rpartition('/')[2]))
+        except TypeError:
+            der = ''
+        self.reply(der)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.maxRequest:
+            self.send_error(413)
+            return
+        self.reply(self.rfile.read(length))
+
+    def reply(self,der):
+        response = self.server.responder.respond(der)
+        self.send_response(200)
+        self.send_header('Content-Type','application/ocsp-response')
+        self.send_header('Content-Length',str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self,format,*args):
+        logger.debug('OCSP %s: %s' % (self.client_address[0],format % args))
+
+
+class SSLOCSPHTTPServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    '''An HTTP server for an SSLOCSPResponder'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,address,responder):
+        self.responder = responder
+        BaseHTTPServer.HTTPServer.__init__(self,address,
+                                           SSLOCSPRequestHandler)
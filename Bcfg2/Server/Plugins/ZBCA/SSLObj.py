@@ -1,16 +1,211 @@
+import base64
+import glob
+import hashlib
 import logging
-from lxml import etree
 import os
 from OpenSSL import crypto
 import uuid
+import calendar
+import time
 from datetime import datetime, timedelta
 from pprint import pformat
+from SSLRecord import SSLRecord
+
+# EC and Ed25519 keys are generated with the cryptography package,
+# which pyOpenSSL is built on
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from OpenSSL._util import lib as _lib, ffi as _ffi
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+try:
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+    HAS_ED25519 = HAS_CRYPTOGRAPHY and hasattr(_lib,'EVP_PKEY_ED25519')
+except ImportError:
+    HAS_ED25519 = False
 
 logger = logging.getLogger(__name__)
 
 class SSLObjException(Exception):
     pass
 
+# map key 'algorithm' attributes to pyOpenSSL key types, as returned
+# by PKey.type()
+keyTypes = {
+    'rsa'       : crypto.TYPE_RSA,
+    'dsa'       : crypto.TYPE_DSA,
+    }
+# map 'curve' attributes of 'ec' keys to cryptography curves
+ecCurves = {}
+if HAS_CRYPTOGRAPHY:
+    keyTypes['ec'] = _lib.EVP_PKEY_EC
+    ecCurves.update({
+            'secp256r1'     : ec.SECP256R1,
+            'prime256v1'    : ec.SECP256R1,
+            'secp384r1'     : ec.SECP384R1,
+            'secp521r1'     : ec.SECP521R1,
+            })
+if HAS_ED25519:
+    keyTypes['ed25519'] = _lib.EVP_PKEY_ED25519
+
+def keySpec(algorithm,bits=None,curve=None):
+    '''
+    Return the (algorithm, size) spec of a key, which identifies
+    the keys that are interchangeable, e.g. in SSLKeyPool:  the size
+    is the bits of 'rsa' and 'dsa' keys, the curve of 'ec' keys, and
+    empty for 'ed25519' keys
+    '''
+    if algorithm == 'ec':
+        return (algorithm,str(curve))
+    elif algorithm == 'ed25519':
+        return (algorithm,'')
+    return (algorithm,str(bits))
+
+def validKeySpec(algorithm,size):
+    '''Return True if keys of the (algorithm, size) spec can be made'''
+    if algorithm not in keyTypes:
+        return False
+    elif algorithm == 'ec':
+        return size in ecCurves
+    elif algorithm == 'ed25519':
+        return size == ''
+    return size.isdigit()
+
+def genKey(algorithm,size):
+    '''Generate a new key and return the PKey object'''
+    if algorithm == 'ec':
+        key = ec.generate_private_key(ecCurves[size](),default_backend())
+    elif algorithm == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = crypto.PKey()
+        key.generate_key(keyTypes[algorithm], int(size))
+        return key
+    # PKey.from_cryptography_key() doesn't take these; go through PEM
+    return crypto.load_privatekey(crypto.FILETYPE_PEM, key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+
+def genKeyText(algorithm,size):
+    '''
+    Generate a new key and return its PEM text
+
+    This is a module-level function so it can be run in
+    multiprocessing workers, e.g. by SSLKeyPool
+    '''
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM,
+                                  genKey(algorithm,size))
+
+def signWith(cert,key,md):
+    '''
+    Sign an X509 object with key; Ed25519 keys sign without a
+    digest, which pyOpenSSL's sign() method can't do
+    '''
+    if not HAS_ED25519 or key.type() != keyTypes['ed25519']:
+        cert.sign(key, md)
+        return
+    if not _lib.X509_sign(cert._x509, key._pkey, _ffi.NULL):
+        raise SSLObjException('Ed25519 signature failed')
+
+def signCRL(crl,cacert,cakey,md):
+    '''
+    Sign a CRL object with the CA cert and key; see signWith()
+    '''
+    if not HAS_ED25519 or cakey.type() != keyTypes['ed25519']:
+        crl.sign(cacert, cakey, md)
+        return
+    # what CRL.sign() does, without the digest
+    _lib.X509_CRL_set_issuer_name(crl._crl,
+                                  _lib.X509_get_subject_name(cacert._x509))
+    _lib.X509_CRL_sort(crl._crl)
+    if not _lib.X509_CRL_sign(crl._crl, cakey._pkey, _ffi.NULL):
+        raise SSLObjException('Ed25519 signature failed')
+
+# the last CA cert and key loaded by issueCertText(), by PEM text
+caCrypto = [None, None]
+
+def loadCACrypto(cacerttext,cakeytext):
+    '''
+    Return the CA cert and key objects for their PEM texts, parsing
+    them only when they change
+    '''
+    if caCrypto[0] != (cacerttext,cakeytext):
+        caCrypto[1] = (
+            crypto.load_certificate(crypto.FILETYPE_PEM, cacerttext),
+            crypto.load_privatekey(crypto.FILETYPE_PEM, cakeytext))
+        caCrypto[0] = (cacerttext,cakeytext)
+    return caCrypto[1]
+
+def certInfo(cert):
+    '''
+    Return a dict of the cert's notBefore and notAfter (seconds
+    since the epoch), serial and subject hash, as index element
+    attributes
+    '''
+    # the date format returned by load_certificate()
+    asn1Format = '%Y%m%d%H%M%SZ'
+
+    info = {}
+    for attrname, asn1time in (('not_before',cert.get_notBefore()),
+                               ('not_after',cert.get_notAfter())):
+        info[attrname] = str(calendar.timegm(
+                time.strptime(asn1time,asn1Format)))
+    info['serial'] = str(cert.get_serial_number())
+    info['subject_hash'] = '%08x' % cert.subject_name_hash()
+    return info
+
+def issueCertText(subject,key,serial,days,md,extensions,cacert,cakey):
+    '''
+    Build and sign a cert for the key; 'subject' is a list of
+    (field, value) pairs and 'extensions' an SSLExtensionProfile.
+    Return the cert PEM text and its certInfo() dict
+
+    The subject and key go straight into the cert; no cert request
+    is built.  'key', 'cacert' and 'cakey' may be live PKey and X509
+    objects, when run in the server process, or PEM text, when sent
+    to a multiprocessing worker (see SSLIssuer); the serial is
+    allocated by the caller
+    '''
+    if not isinstance(key,crypto.PKey):
+        key = crypto.load_privatekey(crypto.FILETYPE_PEM, key)
+    if not isinstance(cacert,crypto.X509):
+        cacert, cakey = loadCACrypto(cacert,cakey)
+
+    # generate cert and fill out basic attributes
+    cert = crypto.X509()
+    cert.set_version(2) # X509v3 = 2
+    certsubject = cert.get_subject()
+    for f, value in subject:
+        try:
+            setattr(certsubject,f.upper(),value)
+        except AttributeError as e:
+            # the caller adds the cert name and host to the message
+            raise SSLObjException(f,e.args[0])
+    cert.set_serial_number(serial)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(int(days) * 24 * 60 * 60)
+    cert.set_issuer(cacert.get_subject())
+    cert.set_pubkey(key)
+
+    # build extensions from config and add to cert
+    cert.add_extensions(extensions.build(cert,cacert))
+
+    # sign cert
+    signWith(cert, cakey, md)
+    return crypto.dump_certificate(crypto.FILETYPE_PEM, cert), certInfo(cert)
+
+def loadCerts(text):
+    '''
+    Return the X509 objects of PEM text holding one or more certs,
+    e.g. a CA chain
+    '''
+    end = '-----END CERTIFICATE-----'
+    return [crypto.load_certificate(crypto.FILETYPE_PEM, pem + end)
+            for pem in text.split(end) if pem.strip()]
+
 class SSLObj(object):
     '''
     An object representing an abstract SSL object; the SSLKey,
@@ -23,7 +218,14 @@ class SSLObj(object):
     '''
     # map 'type="..."' attributes to subclasses, filled in by subclasses
     typedict = {}
-    store = True   # Most objects stored in files, except reqs
+    store = True   # Most objects stored in the text store
+    # the file formats objects can be bound in, by 'format' spec
+    # attribute; formats other than PEM are built by encode()
+    formats = ('pem',)
+    # the SSLStats stage genCrypto() is timed as, and the counter of
+    # objects generated
+    perfStage = 'generate'
+    perfCounter = None
 
     def __init__(self,ca,elt_or_attrs,metadata,**kwargs):
         '''
@@ -36,23 +238,38 @@ class SSLObj(object):
         create the element, generate the crypto objects, and save the
         PEM data to disk
 
+        If 'validate=False' is supplied in kwargs, an element from
+        the index is loaded as-is, without validating or regenerating
+        it; this is useful for offline tools
+
         If an attribute map is supplied in kwargs, build a new attrs
         dict from the old based on the map; this is useful when the
         cert and key are in the same spec
         '''
         self.ca = ca
         self.metadata = metadata
-
-        if type(elt_or_attrs) == etree._Element:
+        # the live crypto object, if any; see cryptoObj()
+        self.crypto = None
+        self.regenerated = False
+        # set when index element attributes change outside genCrypto()
+        self.dirty = False
+        validate = kwargs.pop('validate',True)
+
+        valid = True
+        if isinstance(elt_or_attrs,SSLRecord):
             # we were given an element; fill out object attributes
             self.elt = elt_or_attrs
-            self.text = self.readText()
+            with self.ca.perf.timer('read'):
+                self.text = self.readText()
+            if validate:
+                with self.ca.perf.timer('validate'):
+                    valid = self.validate()
 
-        if type(elt_or_attrs) != etree._Element or not self.validate():
+        if not isinstance(elt_or_attrs,SSLRecord) or not valid:
             # we were given an attrs dict or object is invalid;
             # regenerate
 
-            if type(elt_or_attrs) != etree._Element:
+            if not isinstance(elt_or_attrs,SSLRecord):
                 # generate a new element tree
                 attrs = elt_or_attrs
                 # process the attribute map
@@ -63,19 +280,29 @@ class SSLObj(object):
                     attrs = newattrs
 
                 # build index element from attrs and create object
-                self.elt = etree.Element(attrs['type'],**attrs)
+                self.elt = SSLRecord(attrs['type'],attrs)
                 self.attrib('type','file')
 
-            # generate crypto
+            self.regenerate()
+
+    def regenerate(self):
+        '''
+        Generate new crypto and save the PEM text to a file
+        '''
+        # generate crypto
+        with self.ca.perf.timer(self.perfStage):
             self.genCrypto()
+        if self.perfCounter is not None:
+            self.ca.perf.count(self.perfCounter)
+        self.regenerated = True
 
-            # save the PEM text to a file
-            if self.store:
-                self.writeText()
+        # save the PEM text to a file
+        if self.store:
+            self.writeText()
 
 
     @classmethod
-    def init(cls,ca,elt_or_attrs,metadata):
+    def init(cls,ca,elt_or_attrs,metadata,**kwargs):
         '''
         Init a new SSLObj: determine intended type and call
         appropriate __init__() routine
@@ -87,7 +314,7 @@ class SSLObj(object):
             ssltype = elt_or_attrs.tag
 
         # return result of appropriate class's constructor function
-        return cls.typedict[ssltype](ca,elt_or_attrs,metadata)
+        return cls.typedict[ssltype](ca,elt_or_attrs,metadata,**kwargs)
 
     def validate(self):
         ''' Validate self; return True on success '''
@@ -102,99 +329,148 @@ class SSLObj(object):
             self.elt.set(attrname,setval)
         return self.elt.get(attrname,default)
 
-    def extensionValueParse(self,name,val,cert,cacert):
-        '''
-        Parse X509v3 extensions from config; usually used by SSLCert,
-        but could be used by SSLReq
-
-        Set critical flag
-        Add key IDs for complex extensions
-        Return an OpenSSL.crypto.X509Extension object
-
-        Example format for config file inserts a 'X509v3 Subject Key
-        Identifier' extension with the cert's pubkey digest and sets
-        the 'critical' flag:
-        subjectKeyIdentifier = hash;subject=cert;critical
-        '''
-        # init variables
-        crit = False
-        kwargs = {}
-
-        # a function that fills out subject/issuer= arguments
-        def subject_issuer(arg):
-            args = arg.partition('=')
-            if args[2] == 'cert':
-                kwargs[args[0]] = cert
-            elif args[2] == 'ca':
-                kwargs[args[0]] = cacert
-            else:
-                raise SSLObjException(
-                    'unknown argument in extension: "%s=%s"' %
-                    (args[0],args[2]))
-
-        # value is in format 'name[;arg1[;arg2]]'; split name & process args
-        args = val.split(';')
-        val = args.pop(0)
-        for arg in args:
-            arg=arg.lower().strip()
-            if arg == 'critical':
-                crit = True
-            elif (arg.partition('=')[1]):
-                subject_issuer(arg)
-
-        # generate extension object & return it
-        extension = crypto.X509Extension(name, crit, val, **kwargs)
-        return extension
-
     def myAttrs(self):
         '''Convenience function copies attrs from self.elt'''
-        return dict(self.elt.attrib.items() + [('type',self.elt.tag)])
+        return dict(self.elt.items() + [('type',self.elt.tag)])
     
-    def bind(self,entry):
+    def bind(self,entry,fmt=None,passphrase=None):
         '''
-        Bind Path entry with file metadata and PEM text
+        Bind Path entry with file metadata and text in format fmt
+        (the 'format' spec attribute; default 'pem')
 
         Text is somewhat complex:
         - Simple keys and certs are straight-forward
         - Certs may be combined with keys in the same file
+        - Other formats are binary, and bound with base64 encoding;
+          'passphrase' is the passphrase source for PKCS#12 (see
+          SSLCA.passphrase())
         '''
+        fmt = fmt or 'pem'
+        if fmt not in self.formats:
+            raise SSLObjException(
+                '%s can\'t be bound in format "%s"; use one of: %s' %
+                (self.ssltype(),fmt,', '.join(self.formats)))
+
         for k in ('owner','group','mode','type'):
             entry.attrib[k] = self.attrib(k)
 
-        entry.text = self.getText()
+        if fmt == 'pem':
+            entry.text = self.getText()
+        else:
+            entry.text = base64.b64encode(self.getEncoded(fmt,passphrase))
+            entry.attrib['encoding'] = 'base64'
 
     def textFname(self):
         '''
-        Compute the crypto text file name
-        E.g. /var/lib/bcfg2/ZBCA/CA/myca/SSLKey
+        Compute the crypto text file name in the 'files' text store,
+        which binary encodings are cached next to, whatever the store
+        E.g. /var/lib/bcfg2/ZBCA/CA/myca/SSLKey/<uuid>.pem
         '''
         return '%s/%s/%s.pem' % (self.ca.basepath,
                                  self.ssltype(),self.attrib('uuid'))
 
     def writeText(self):
         '''
-        Write the PEM text to a file
-        Create w/mode go-rwx to keep key data safe
+        Save the PEM text in the CA's text store (see SSLTextStore),
+        which may record where in the element
         '''
-        with os.fdopen(
-            os.open(self.textFname(), 
-                    os.O_CREAT|os.O_RDWR, 0600),
-            'w') as f:
-            f.write(self.text)
-        
+        self.dropEncoded()
+        self.ca.textstore.write(self.elt,self.text)
+
     def readText(self):
         '''
-        Read PEM text from a file
+        Read PEM text from the CA's text store
         '''
-        with open(self.textFname(), 'r') as f:
-            return f.read()
+        return self.ca.textstore.read(self.elt)
+
+    def textTime(self):
+        '''
+        Return the time the PEM text was last written
+        '''
+        return self.ca.textstore.mtime(self.elt)
 
     def getText(self):
         '''
-        Return file text in requested form.  For now, that's just PEM.
+        Return file text in PEM form; other formats are built by
+        getEncoded()
         '''
         return self.text
 
+    def encodedFname(self,fmt,passphrase=None):
+        '''
+        Compute the file name the object is cached under in binary
+        format fmt:  next to the PEM file, e.g. <uuid>.der; PKCS#12
+        files are per passphrase, named by a hash of the passphrase
+        and PEM file name
+        '''
+        base = os.path.splitext(self.textFname())[0]
+        if fmt == 'pkcs12':
+            digest = hashlib.sha256('%s\0%s' % (self.textFname(),
+                                                passphrase or ''))
+            return '%s-%s.p12' % (base,digest.hexdigest()[:16])
+        return '%s.%s' % (base,fmt)
+
+    def encodedSourceTimes(self,fmt):
+        '''
+        Return the times the texts the object's fmt encoding is built
+        from were last written
+        '''
+        return [self.textTime()]
+
+    def getEncoded(self,fmt,passphrase=None):
+        '''
+        Return the object encoded in binary format fmt, with the
+        passphrase from source 'passphrase'
+
+        Encodings are cached in files, see encodedFname(); a cached
+        encoding is used while it's newer than the files it's built
+        from, so PKCS#12 key encryption is only done once
+        '''
+        passphrase = self.ca.passphrase(passphrase)
+        fname = self.encodedFname(fmt,passphrase)
+        try:
+            mtime = os.stat(fname).st_mtime
+            if not [t for t in self.encodedSourceTimes(fmt) if t > mtime]:
+                with open(fname,'rb') as f:
+                    return f.read()
+        except (OSError, IOError):
+            # not cached yet
+            pass
+
+        data = self.encode(fmt,passphrase)
+        self.ca.encodedUUIDs().add(self.attrib('uuid'))
+        # write through a temp file, so readers never see a partial one
+        tmpname = '%s.%s' % (fname,uuid.uuid4())
+        with os.fdopen(os.open(tmpname,os.O_CREAT|os.O_EXCL|os.O_WRONLY,
+                               0600),'wb') as f:
+            f.write(data)
+        os.rename(tmpname,fname)
+        return data
+
+    def encode(self,fmt,passphrase=None):
+        '''
+        Return the object encoded in binary format fmt; subclasses
+        implement the formats they list in 'formats'
+        '''
+        raise NotImplementedError
+
+    def dropEncoded(self):
+        '''
+        Remove the cached encodings of the object, e.g. when its PEM
+        text is rewritten
+        '''
+        encoded = self.ca.encodedUUIDs()
+        if self.attrib('uuid') not in encoded:
+            return
+        encoded.discard(self.attrib('uuid'))
+        base = os.path.splitext(self.textFname())[0]
+        for fname in glob.glob('%s.*' % base) + glob.glob('%s-*' % base):
+            if fname != self.textFname():
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+
     def tostring(self,text=True):
         '''
         Create a string serializing important attributes for debugging
@@ -204,13 +480,30 @@ class SSLObj(object):
         else:
             text = ''
         return '%s\n%s' % \
-            (etree.tostring(self.elt,pretty_print=True),
+            (self.elt.tostring(pretty_print=True),
              text)
 
     def ssltype(self):
         '''Convenience function to return object SSL type'''
         return self.__class__.__name__
 
+    def indexKeys(self):
+        '''
+        Return the (ssltype,name,host) index keys of the objects the
+        bound text is built from; a cached bind is stale once any of
+        them changes
+        '''
+        if not self.store:
+            return []
+        return [(self.elt.tag,self.attrib('name'),self.attrib('host'))]
+
+    def renewTime(self):
+        '''
+        Return the time (seconds since the epoch) when this object is
+        due for regeneration, or None if it never is
+        '''
+        return None
+
     def __str__(self):
         return '%s %s' % (type(self), self.ssltype())
 
@@ -226,10 +519,17 @@ class SSLKey(SSLObj):
     owner='root' group='root' mode='0600'
     />
 
+    'algorithm' is 'rsa' or 'dsa' with 'bits', 'ec' with 'curve'
+    (secp256r1, secp384r1 or secp521r1), or 'ed25519'; 'ec' and
+    'ed25519' need the cryptography package.
+
     The 'rsa' and 'bits' attributes may be put in a 'type="SSLCert"'
     spec with the 'key' attribute value the same as 'name'; the
     resulting key PEM text will be put in the same file as the cert's.
     '''
+    perfStage = 'genkey'
+    perfCounter = 'keys_generated'
+
     def genCrypto(self):
         '''
         Generate new SSL key PEM data from metadata
@@ -237,107 +537,73 @@ class SSLKey(SSLObj):
         # fill out metadata defaults
         defaults = {
             'ca'        : self.ca.name,
-            'bits'      : self.ca.key_default_bits,
             'algorithm' : self.ca.key_default_algorithm,
             'owner'     : 'root',
             'group'     : 'root',
             'mode'      : '0600',
             'uuid'      : str(uuid.uuid4())
             }
-        # Element.attrib has no 'setdefault' method, so...
-        defaults.update(self.elt.attrib)
-        self.elt.attrib.update(defaults)
+        # the size default depends on the algorithm
+        algorithm = self.attrib('algorithm',default=defaults['algorithm'])
+        if algorithm == 'ec':
+            defaults['curve'] = self.ca.key_default_curve
+        elif algorithm != 'ed25519':
+            defaults['bits'] = self.ca.key_default_bits
+        # records have no 'setdefault' method, so...
+        defaults.update(self.elt.items())
+        self.elt.update(defaults)
+
+        # take a pre-generated key from the CA's key pool, or
+        # generate the key here if the pool is empty; keep the live
+        # key when it's generated in this process
+        spec = self.keySpec()
+        self.text = self.ca.keypool.pop(*spec)
+        if self.text is None:
+            if not validKeySpec(*spec):
+                raise SSLObjException(
+                    'unsupported key algorithm "%s" (%s) for key "%s", '
+                    'host "%s"' % (spec[0],spec[1] or 'no size',
+                                   self.attrib('name'),self.attrib('host')))
+            if self.ca.issuer.pooled():
+                self.text = self.ca.issuer.run(genKeyText,*spec)
+            else:
+                self.crypto = genKey(*spec)
+                self.text = crypto.dump_privatekey(crypto.FILETYPE_PEM,
+                                                   self.crypto)
 
-        # generate the key
-        key = crypto.PKey()
-        key.generate_key(self.keyAlgo(), int(self.attrib('bits')))
-        self.text = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+    def keySpec(self):
+        '''Return the key's (algorithm, size) spec; see keySpec()'''
+        return keySpec(self.attrib('algorithm'),self.attrib('bits'),
+                       self.attrib('curve'))
 
     def keyAlgo(self):
         '''Convenience function to calculate key crypto algorithm'''
-        if self.attrib('algorithm') == 'rsa':
-            return crypto.TYPE_RSA
-        elif self.attrib('algorithm') == 'dsa':
-            return crypto.TYPE_DSA
+        if self.attrib('algorithm') in keyTypes:
+            return keyTypes[self.attrib('algorithm')]
         else:
             logger.error ('key algorthim not set for key "%s", host "%s"' %
                           (self.attrib('name'),self.attrib('host')))
 
     def cryptoObj(self):
-        return crypto.load_privatekey(crypto.FILETYPE_PEM, self.text)
-
-
-class SSLReq(SSLObj):
-    '''
-    An object representing an SSL certificate request
-
-    These are not put in spec, and not stored anywhere (they could be
-    if there's ever a use for that), and are only used in the
-    generation of SSLCert objects.
-    '''
-
-    store = False
-
-    def genCrypto(self):
-        '''
-        Generate new SSL certificate request PEM data from metadata
-        '''
-        # fill out defaults 
-        defaults = dict([(f,None) for f in self.ca.dn_fields])
-        defaults.update(self.ca.dn_defaults)
-        defaults.update({
-                'ca'        : self.ca.name,
-                'md_algo'   : self.ca.req_default_md,
-                'owner'     : 'root',
-                'group'     : 'root',
-                'mode'      : '0644',
-                'uuid'      : str(uuid.uuid4()),
-                'cn'        : self.metadata.hostname,
-                })
-        # Element.attrib has no 'setdefault' method, so...
-        defaults.update(self.elt.attrib)
-        self.elt.attrib.update(defaults)
-
-        # generate the req
-        req = crypto.X509Req()
-        req.set_version(2) # X509v3 = 2
-        subject = req.get_subject()
-        # fill in subject
-        for f in self.ca.dn_fields:
-            try:
-                setattr(subject,f.upper(),defaults[f])
-            except AttributeError as e:
-                raise SSLObjException(
-                    'Attribute "%s" of cert request "%s", host "%s": %s' %
-                    (f,self.attrib('name'),self.attrib('host'),e.args[0]))
-
-        # retrieve key
-        keyattrs = {'name' : self.attrib('key'),
-                    'host' : self.metadata.hostname,
-                    'type' : 'SSLKey'}
-        if keyattrs['name'] is None \
-                and self.attrib('append_key',default=False):
-            # key and cert in same file; no key specified; assume
-            # key name is the same
-            keyattrs['name'] = self.attrib('name')
-        key = self.ca.initSSLObj(keyattrs, self.metadata).cryptoObj()
+        '''Return a PKey object'''
+        if self.crypto is None:
+            self.crypto = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                                 self.text)
+        return self.crypto
 
-        # add key text to req; sign req
-        req.set_pubkey(key)
-        req.sign(key, self.attrib('md_algo'))
+    formats = ('pem','der')
 
-        # put PEM text of req in object
-        self.text = crypto.dump_certificate_request(crypto.FILETYPE_PEM, req)
+    def encode(self,fmt,passphrase=None):
+        '''Return the key in DER form'''
+        return crypto.dump_privatekey(crypto.FILETYPE_ASN1,self.cryptoObj())
 
-    def cryptoObj(self):
-        '''Return a X509Req object'''
-        return crypto.load_certificate_request(
-            crypto.FILETYPE_PEM, self.text)
 
 class SSLCert(SSLObj):
     '''
     An object representing an SSL certificate
     '''
+    perfStage = 'sign'
+    perfCounter = 'certs_signed'
 
     def genCrypto(self):
         '''
@@ -346,6 +612,10 @@ class SSLCert(SSLObj):
         By default, the CN will be the hostname, unless overridden in
         the spec
         '''
+        # a new cert isn't revoked, or flagged by 'zbca verify'
+        self.elt.pop('revoked',None)
+        self.elt.pop('verify_failed',None)
+
         # fill out defaults
         defaults = {
             'ca'                : self.ca.name,
@@ -356,47 +626,98 @@ class SSLCert(SSLObj):
             'mode'              : '0600',
             'uuid'              : str(uuid.uuid4())
             }
-        # Element.attrib has no 'setdefault' method, so...
-        defaults.update(self.elt.attrib)
-        self.elt.attrib.update(defaults)
+        # records have no 'setdefault' method, so...
+        defaults.update(self.elt.items())
+        self.elt.update(defaults)
 
         # If the 'ou_append_hostname' attribute is 'true', do it
         # (This is for client certs to auth to the same user but from
         # different machines; kojid wants this for some mad reason)
-        if self.attrib('ou_append_hostname',default='').lower() == 'true':
+        # (Don't append it again when regenerating a cert)
+        if self.attrib('ou_append_hostname',default='').lower() == 'true' \
+                and not self.attrib('ou').endswith(self.metadata.hostname):
             self.attrib('ou', self.attrib('ou') + self.metadata.hostname)
 
-        # generate the X509Req object
-        reqattrs = self.myAttrs()
-        reqattrs.update({'type':'SSLReq'})
-        reqobj = SSLObj.init(self.ca, reqattrs, self.metadata)
-        req = reqobj.cryptoObj()
-
-        # load the CA key+cert
-        cacert = SSLCACert(self.ca).cryptoObj()
-        cakey = SSLCAKey(self.ca).cryptoObj()
-
-        # generate cert and fill out basic attributes
-        cert = crypto.X509()
-        cert.set_version(2) # X509v3 = 2
-        cert.set_subject(req.get_subject())
-        cert.set_serial_number(self.ca.newSerial())
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(int(self.attrib('days')) * 24 * 60 * 60)
-        cert.set_issuer(cacert.get_subject())
-        cert.set_pubkey(req.get_pubkey())
-
-        # build extensions from config and add to cert
-        extensions = []
-        for (name,val) in self.ca.extensions[self.attrib('extensions')].items():
-            extensions.append(self.extensionValueParse(name,val,cert,cacert))
-        cert.add_extensions(extensions)
-
-        # sign cert
-        cert.sign(cakey, self.ca.cert_default_md)
-
-        # add cert text to object
-        self.text = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+        # retrieve the key; the live key object if it's new
+        keyobj = self.ca.initSSLObj(self.keyAttrs(), self.metadata)
+
+        # sign the cert, with a serial allocated here; send PEM text
+        # if it's signed in a worker process
+        cacert = self.ca.caObj('SSLCACert')
+        cakey = self.ca.caObj('SSLCAKey')
+        if self.ca.issuer.pooled():
+            args = (keyobj.text, cacert.text, cakey.text)
+        else:
+            args = (keyobj.cryptoObj(), cacert.cryptoObj(),
+                    cakey.cryptoObj())
+        extensions = self.ca.extensions.get(self.attrib('extensions'))
+        if extensions is None:
+            raise SSLObjException(
+                'unknown extensions profile "%s" for cert "%s", host "%s"' %
+                (self.attrib('extensions'),self.attrib('name'),
+                 self.attrib('host')))
+        try:
+            self.text, info = self.ca.issuer.run(
+                issueCertText, self.subject(), args[0],
+                self.ca.newSerial(), self.attrib('days'),
+                self.ca.cert_default_md, extensions, args[1], args[2])
+        except SSLObjException as e:
+            if len(e.args) != 2:
+                raise
+            raise SSLObjException(
+                'Attribute "%s" of cert "%s", host "%s": %s' %
+                (e.args[0],self.attrib('name'),self.attrib('host'),
+                 e.args[1]))
+
+        # record its dates etc. in the index, and the fingerprint of
+        # the profile and DN config it was issued with
+        for attrname, value in info.items():
+            self.attrib(attrname, value)
+        self.attrib('profile_hash',
+                    self.ca.fingerprints[self.attrib('extensions')])
+
+    def subject(self):
+        '''
+        Return the cert subject as a list of (field, value) pairs:
+        'dn_fields' from the spec attributes, the CA's dn-defaults,
+        or the hostname for the CN; fields with no value are left out
+        '''
+        fields = dict(self.ca.dn_defaults)
+        fields['cn'] = self.metadata.hostname
+        fields.update(self.elt.items())
+        return [(f,fields[f.lower()]) for f in self.ca.dn_fields
+                if fields.get(f.lower()) is not None]
+
+    def keyAttrs(self):
+        '''
+        Return the attrs to look up the cert's key with:  the 'key'
+        attribute, or the cert's own name if the key is appended;
+        key type attributes in the cert spec are passed on, for when
+        the cert is bound before its key
+        '''
+        keyattrs = {'name' : self.attrib('key'),
+                    'host' : self.metadata.hostname,
+                    'type' : 'SSLKey'}
+        for attrname in ('algorithm','bits','curve'):
+            if self.attrib(attrname) is not None:
+                keyattrs[attrname] = self.attrib(attrname)
+        if keyattrs['name'] is None \
+                and self.attrib('append_key',default=False):
+            # key and cert in same file; no key specified; assume
+            # key name is the same
+            keyattrs['name'] = self.attrib('name')
+        return keyattrs
+
+    def recordCertInfo(self,cert=None):
+        '''
+        Record the cert's notBefore and notAfter (seconds since the
+        epoch), serial and subject hash as index element attributes,
+        so expiry checks and reports never have to parse the cert
+        '''
+        if cert is None:
+            cert = crypto.load_certificate(crypto.FILETYPE_PEM, self.text)
+        for attrname, value in certInfo(cert).items():
+            self.attrib(attrname, value)
 
     def getText(self):
         '''
@@ -405,11 +726,8 @@ class SSLCert(SSLObj):
         '''
 
         # append key text if they're destined for the same file
-        if self.attrib('key') == self.attrib('name') or \
-                self.attrib('append_key',default='false').lower() == 'true':
-            keyattrs = {'type':'SSLKey',
-                        'name':self.attrib('key',self.attrib('name')),
-                        'host':self.metadata.hostname}
+        keyattrs = self.appendKeyAttrs()
+        if keyattrs is not None:
             keyobj = self.ca.initSSLObj(keyattrs, self.metadata)
             text = '\n'.join((self.text,keyobj.text))
         else:
@@ -417,39 +735,143 @@ class SSLCert(SSLObj):
 
         return text
 
-    def daysLeft(self):
+    formats = ('pem','der','pkcs12')
+
+    def bind(self,entry,fmt=None,passphrase=None):
         '''
-        Calculate the number of days left before expiration
+        A key can only be appended to a PEM cert; PKCS#12 files
+        always hold the key
         '''
-        
-        # the date format returned by load_certificate()
-        asn1Format = '%Y%m%d%H%M%SZ'
+        if fmt == 'der' and self.appendKeyAttrs() is not None:
+            raise SSLObjException(
+                'cert "%s", host "%s" has its key appended, which needs '
+                'format "pem"' % (self.attrib('name'),self.attrib('host')))
+        SSLObj.bind(self,entry,fmt,passphrase)
+
+    def cryptoObj(self):
+        '''Return a X509 object'''
+        if self.crypto is None:
+            self.crypto = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                  self.text)
+        return self.crypto
+
+    def pkcs12Key(self):
+        '''Return the key object that goes in a PKCS#12 file'''
+        keyattrs = self.keyAttrs()
+        if keyattrs['name'] is None:
+            raise SSLObjException(
+                'cert "%s", host "%s" has no key for format "pkcs12"' %
+                (self.attrib('name'),self.attrib('host')))
+        return self.ca.initSSLObj(keyattrs, self.metadata)
+
+    def encodedSourceTimes(self,fmt):
+        '''
+        A PKCS#12 file is also built from the key and CA chain
+        '''
+        times = SSLObj.encodedSourceTimes(self,fmt)
+        if fmt == 'pkcs12':
+            times += [self.pkcs12Key().textTime(),
+                      os.stat(self.ca.caFname('SSLCAChain')).st_mtime]
+        return times
+
+    def encode(self,fmt,passphrase=None):
+        '''
+        Return the cert in DER form, or a PKCS#12 file with the cert,
+        its key, encrypted with passphrase, and the CA chain; the
+        friendly name (e.g. the Java keystore alias) is the host name
+        '''
+        if fmt == 'der':
+            return crypto.dump_certificate(crypto.FILETYPE_ASN1,
+                                           self.cryptoObj())
+        p12 = crypto.PKCS12()
+        p12.set_certificate(self.cryptoObj())
+        p12.set_privatekey(self.pkcs12Key().cryptoObj())
+        p12.set_ca_certificates(
+            loadCerts(self.ca.caObj('SSLCAChain').text))
+        p12.set_friendlyname(self.attrib('host'))
+        return p12.export(passphrase)
+
+    def appendKeyAttrs(self):
+        '''
+        If the key goes in the same file as the cert, return the
+        attrs to look up the key with; otherwise return None
+        '''
+        if self.attrib('key') == self.attrib('name') or \
+                self.attrib('append_key',default='false').lower() == 'true':
+            return {'type':'SSLKey',
+                    'name':self.attrib('key',self.attrib('name')),
+                    'host':self.metadata.hostname}
+        return None
 
-        # extract the expiration date
-        cert = crypto.load_certificate(crypto.FILETYPE_PEM, self.getText())
-        expirationDate = datetime.strptime(cert.get_notAfter(),asn1Format)
+    def indexKeys(self):
+        '''
+        The bound text also depends on an appended key
+        '''
+        keys = SSLObj.indexKeys(self)
+        keyattrs = self.appendKeyAttrs()
+        if keyattrs is not None:
+            keys.append((keyattrs['type'],keyattrs['name'],keyattrs['host']))
+        return keys
 
-        # calculate and return days left
-        return (expirationDate - datetime.today()).days
+    def notAfter(self):
+        '''
+        Return the expiration time in seconds since the epoch, from
+        the index element; certs indexed before it was recorded are
+        parsed once, and the index updated
+        '''
+        if self.attrib('not_after') is None:
+            self.recordCertInfo()
+            self.dirty = True
+        return int(self.attrib('not_after'))
+
+    def renewTime(self):
+        '''
+        The cert is regenerated cert_replace_days before it expires
+        '''
+        return self.notAfter() - int(self.ca.cert_replace_days) * 24*60*60
+
+    def daysLeft(self):
+        '''
+        Calculate the number of days left before expiration
+        '''
+        return int((self.notAfter() - time.time()) // (24*60*60))
 
     def validate(self):
         '''
         Check if the cert is valid
         '''
 
-        # right now this only checks the date, not the CA cert chain
-        return self.daysLeft() > int(self.ca.cert_replace_days)
+        # revocation, 'zbca verify --mark' and the date; with
+        # 'cert_verify', also the signature, chain, key and extensions
+        if self.attrib('revoked') is not None or \
+                self.attrib('verify_failed') is not None:
+            return False
+        if self.notAfter() - int(time.time()) <= \
+                int(self.ca.cert_replace_days) * 24*60*60:
+            return False
+        if self.ca.verifier.enabled:
+            problems = self.ca.verifier.verify(self)
+            if problems:
+                logger.warning('CA "%s": cert "%s", host "%s" failed '
+                               'verification, reissuing: %s' %
+                               (self.ca.name,self.attrib('name'),
+                                self.attrib('host'),'; '.join(problems)))
+                return False
+        return True
 
 
 class SSLCAObj(SSLObj):
     '''
     An object representing an SSL CA object:  cert, key or chain
+
+    These are read-only, so the CA caches them; get them with
+    SSLCA.caObj()
     '''
     def __init__(self,ca,elt=None,metadata=None):
         '''
         For the moment, the CA objects are given to us, not generated.
         '''
-        elt = etree.Element(self.ssltype(),type='file')
+        elt = SSLRecord(self.ssltype(),type='file')
         self.store = False
         SSLObj.__init__(self,ca,elt,metadata)
         
@@ -463,24 +885,42 @@ class SSLCAObj(SSLObj):
             }
         if self.ssltype() == 'SSLCACert':
             defaults['mode'] = '0600'
-        # Element.attrib has no 'setdefault' method, so...
-        defaults.update(self.elt.attrib)
-        self.elt.attrib.update(defaults)
+        # records have no 'setdefault' method, so...
+        defaults.update(self.elt.items())
+        self.elt.update(defaults)
 
     def textFname(self):
         '''
         Compute the crypto text file name for the CA Cert
         '''
-        return '%s/SSLCA/%s.pem' % (self.ca.basepath,self.ssltype())
+        return self.ca.caFname(self.ssltype())
+
+    def readText(self):
+        '''
+        CA objects are files in the CA's SSLCA directory, not in the
+        text store
+        '''
+        with open(self.textFname(), 'r') as f:
+            return f.read()
+
+    def textTime(self):
+        return os.stat(self.textFname()).st_mtime
 
 
 class SSLCACert(SSLCAObj):
     '''
     An object representing an SSL CA certificate
     '''
+    formats = ('pem','der')
+
     def cryptoObj(self):
-        return crypto.load_certificate(crypto.FILETYPE_PEM,
-                                       self.text)
+        if self.crypto is None:
+            self.crypto = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                  self.text)
+        return self.crypto
+
+    def encode(self,fmt,passphrase=None):
+        return crypto.dump_certificate(crypto.FILETYPE_ASN1,self.cryptoObj())
 
 
 class SSLCAKey(SSLCAObj):
@@ -488,8 +928,10 @@ class SSLCAKey(SSLCAObj):
     An object representing an SSL CA key
     '''
     def cryptoObj(self):
-        return crypto.load_privatekey(crypto.FILETYPE_PEM,
-                                      self.text)
+        if self.crypto is None:
+            self.crypto = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                                 self.text)
+        return self.crypto
 
 
 class SSLCAChain(SSLCAObj):
@@ -501,12 +943,30 @@ class SSLCAChain(SSLCAObj):
     pass
 
 
+class SSLCRL(SSLCAObj):
+    '''
+    An object representing the CA's certificate revocation list
+
+    The CRL is maintained by the CA (see SSLRevocation), which
+    refreshes it before it's bound
+    '''
+    formats = ('pem','der')
+
+    def cryptoObj(self):
+        if self.crypto is None:
+            self.crypto = crypto.load_crl(crypto.FILETYPE_PEM, self.text)
+        return self.crypto
+
+    def encode(self,fmt,passphrase=None):
+        return crypto.dump_crl(crypto.FILETYPE_ASN1,self.cryptoObj())
+
+
 # register typedict entries
 SSLObj.typedict.update({
         'SSLKey'        : SSLKey,
         'SSLCert'       : SSLCert,
-        'SSLReq'        : SSLReq,
         'SSLCACert'     : SSLCACert,
         'SSLCAKey'      : SSLCAKey,
         'SSLCAChain'    : SSLCAChain,
+        'SSLCRL'        : SSLCRL,
         })
@@ -1,6 +1,7 @@
+import bisect
 import logging
 from lxml import etree
-import posixpath
+from SSLIndexBackend import backends
 
 logger = logging.getLogger(__name__)
 
@@ -9,16 +10,38 @@ class SSLObjIndexException(Exception):
 
 class SSLObjIndex(object):
     '''
-    An object representing an XML index of SSL object elements
+    An object representing an index of SSL object elements
 
-    Index has top-level container elements SSLKeys, SSLCerts, etc. 
-    under which SSLKey, SSLCert, etc. objects are stored
+    The index holds SSLKey, SSLCert, etc. object elements, which are
+    compact SSLRecord objects rather than lxml elements (see
+    SSLRecord); in XML, they are stored under top-level container
+    elements SSLKeys, SSLCerts, etc.  XML is only produced when the
+    index is serialized.
 
     Retrieve object elements using keys 'ssltype' ('SSLCert', 
     'SSLKey', etc.), 'name' (filename) and 'host' attributes
-    with the search() method
+    with the search() method, or all elements of a type with
+    records()
 
-    Store object elements with the store() method
+    Store object elements with the store() method; after modifying a
+    stored element in place, flag it with the update() method
+
+    The index is persisted by a storage backend chosen with the CA's
+    'index_backend' option (see SSLIndexBackend)
+
+    Elements are kept in a dict keyed by (ssltype, name, host), so
+    search() doesn't scan the whole index; duplicate entries read
+    from storage are kept aside, so they're saved again as they were
+
+    Revoked certs have SSLRevoked elements, keyed by serial rather
+    than name and host (see eltKey()); their serials are also kept in
+    a sorted list for fast lookups, and in a log of serials revoked
+    since startup so CRLs can be updated incrementally
+
+    Certs are also indexed by extensions profile and profile
+    fingerprint (see SSLCA.fingerprints), so staleProfiles() finds
+    the certs issued under an older profile or DN config without
+    scanning every cert
 
     There is also an interface to store/retrieve CA state
     '''
@@ -26,6 +49,7 @@ class SSLObjIndex(object):
     setnamelist = {
         'SSLKey'        : 'SSLKeys',
         'SSLCert'       : 'SSLCerts',
+        'SSLRevoked'    : 'SSLRevocations',
         'SSLCAState'    : 'SSLCAState',
         }
 
@@ -35,35 +59,181 @@ class SSLObjIndex(object):
         Read the index file; create it if necessary
         '''
         self.ca = ca
-        self.index = self._read()
+        self.lookup = {}
+        self.duplicates = set()
+        # duplicate elements beyond the first of each key
+        self.extras = []
+        # { name : value } CA state variables
+        self.state = {}
+        self.changed = {}
+        self.removed = set()
+        self.changedState = set()
+        self.generations = {}
+        self.deferred = 0
+        # sorted revoked serials; revokedLog is appended to as serials
+        # are revoked, and revokedResets counts removals, which
+        # invalidate the log
+        self.revoked = []
+        self.revokedLog = []
+        self.revokedResets = 0
+        # { (profile, fingerprint) : set of cert keys }
+        self.profiles = {}
+        try:
+            self.backend = backends[ca.index_backend](ca)
+        except KeyError:
+            raise SSLObjIndexException(
+                'CA "%s": unknown index_backend "%s"' %
+                (ca.name,ca.index_backend))
+        self._read()
 
     def _read(self):
         '''
-        Read XML object index from file, or create one
+        Read the object elements and CA state from the backend, and
+        build the (ssltype, name, host) lookup table
+        '''
+        records, state = self.backend.read() or ([], {})
+        self.state = state
+        self.lookup.clear()
+        self.duplicates.clear()
+        self.extras = []
+        self.revoked = []
+        self.revokedLog = []
+        self.revokedResets += 1
+        self.profiles.clear()
+        for elt in records:
+            key = self.eltKey(elt)
+            if key in self.lookup:
+                logger.error('Found multiple entries for type %s, '
+                             'name %s, host %s' % key)
+                self.duplicates.add(key)
+                self.extras.append(elt)
+            else:
+                self.lookup[key] = elt
+                self.indexProfile(key,elt)
+        self.revoked = sorted([int(key[1]) for key in self.lookup
+                               if key[0] == 'SSLRevoked'])
+
+    def reload(self):
+        '''
+        Read the index again from the backend, discarding unsaved
+        changes; for processes that only read the index, like a
+        standalone OCSP responder, to pick up the server's changes
+        '''
+        self._read()
+        self.changed.clear()
+        self.removed.clear()
+        self.changedState.clear()
+
+    @staticmethod
+    def eltKey(elt):
+        '''
+        Convenience function returns the lookup table key of an
+        object element; for SSLRevoked, ('SSLRevoked', serial, '')
+        '''
+        if elt.tag == 'SSLRevoked':
+            return (elt.tag, elt.get('serial'), '')
+        return (elt.tag, elt.get('name'), elt.get('host'))
+
+    def records(self,ssltype=None):
+        '''
+        Return a list of the object elements of one type, e.g.
+        'SSLCert', or of all types
+        '''
+        return [elt for key, elt in self.lookup.iteritems()
+                if ssltype is None or key[0] == ssltype] + \
+            [elt for elt in self.extras
+             if ssltype is None or elt.tag == ssltype]
 
-        Check that <SSLKeys/>, <SSLCerts/>, etc. container elements
-        exist in index; create anything missing
+    @staticmethod
+    def profileKey(elt):
+        '''
+        Return the (profile, fingerprint) a cert element was issued
+        with, or None if it isn't a cert or has no fingerprint
         '''
-        if not posixpath.exists(self.indexFilePath()):
-            elt = etree.Element('ZBCAIndex').getroottree()
-        else:            
-            elt = etree.parse(self.indexFilePath())
+        if elt.tag != 'SSLCert' or elt.get('profile_hash') is None:
+            return None
+        return (elt.get('extensions'), elt.get('profile_hash'))
 
-        for tag in self.setnamelist.values():
-            if elt.find(tag) is None:
-                elt.getroot().append(etree.Element(tag))
+    def indexProfile(self,key,elt):
+        '''Add an indexed element to the profile index'''
+        profile = self.profileKey(elt)
+        if profile is not None:
+            self.profiles.setdefault(profile,set()).add(key)
 
-        return elt
+    def unindexProfile(self,key,elt):
+        '''Remove an indexed element from the profile index'''
+        profile = self.profileKey(elt)
+        if profile is not None and profile in self.profiles:
+            self.profiles[profile].discard(key)
+            if not self.profiles[profile]:
+                del self.profiles[profile]
+
+    def staleProfiles(self,fingerprints):
+        '''
+        Return the keys of the certs whose profile fingerprint isn't
+        the current one in 'fingerprints', a { profile : fingerprint }
+        dict; certs whose profile is gone aren't included, since they
+        can't be reissued with it, nor certs with no fingerprint
+        '''
+        stale = []
+        for (profile, fingerprint), keys in self.profiles.items():
+            current = fingerprints.get(profile)
+            if current is not None and current != fingerprint:
+                stale.extend(keys)
+        return sorted(stale)
+
+    def toTree(self):
+        '''
+        Return the index as an XML tree:  object elements under their
+        container elements, sorted by key, and CA state as State
+        elements under SSLCAState
+        '''
+        root = etree.Element('ZBCAIndex')
+        containers = {}
+        for setname in sorted(set(self.setnamelist.values())):
+            containers[setname] = etree.SubElement(root,setname)
+        for elt in sorted(self.records(),key=self.eltKey):
+            containers[self.setnamelist[elt.tag]].append(elt.toElement())
+        for name, value in sorted(self.state.items()):
+            etree.SubElement(containers['SSLCAState'],'State',name=name,
+                             value=value)
+        return root.getroottree()
 
     def write(self):
         '''
-        Save the object index to disk
+        Save the object index to disk; does nothing between defer()
+        and commit()
+        '''
+        if self.deferred:
+            return
+        state = [(key,self.getCAState(key)) for key in self.changedState]
+        with self.ca.perf.timer('write'):
+            size = self.backend.write(self,self.changed.values(),
+                                      list(self.removed),state)
+        self.ca.perf.count('index_writes')
+        self.ca.perf.count('index_bytes',size or 0)
+        self.changed.clear()
+        self.removed.clear()
+        self.changedState.clear()
+
+    def defer(self):
+        '''
+        Hold back write() until the matching commit(), e.g. to save a
+        batch of new objects in one write; calls may be nested
+        '''
+        self.deferred += 1
+
+    def commit(self):
+        '''
+        End a defer(); write the index once the outermost one ends
         '''
-        self.index.write(self.indexFilePath(),pretty_print=True)
+        self.deferred -= 1
+        if not self.deferred:
+            self.write()
 
     def indexFilePath(self):
         '''
-        Convenience function returns name of index file
+        Convenience function returns name of XML index file
         '''
         return '%s/index.xml' % self.ca.basepath
 
@@ -72,19 +242,13 @@ class SSLObjIndex(object):
         Search the object index for an SSL object (SSLKey, SSLCert, etc.)
         Return a single element if found, or None
         '''
-        xpath = '//%s[@host="%s"][@name="%s"]' % \
-            (ssltype,hostname,name)
-        results = self.index.xpath(xpath)
-
-        # check for #results != 1
-        if not results:
-            return None
-        elif len(results) > 1:
+        key = (ssltype,name,hostname)
+        if key in self.duplicates:
             logger.error('Found multiple entries for type %s, name %s, host %s' %
-                         (ssltype,name,hostname))
+                         key)
             raise SSLObjIndexException
 
-        return results[0]
+        return self.lookup.get(key)
 
     def searchAttrs(self,attrs,ssltype='type',name='name',host='host'):
         '''
@@ -99,38 +263,117 @@ class SSLObjIndex(object):
         '''
         Store the object in the index
         '''
-        self.index.find(self.setnamelist[obj.ssltype()]).append(obj.elt)
+        self.storeElt(obj.elt)
+
+    def storeElt(self,elt):
+        '''
+        Store an object element in the index
+        '''
+        key = self.eltKey(elt)
+        if key in self.lookup:
+            # it replaces the stored element
+            logger.error('Storing duplicate entry for type %s, name %s, '
+                         'host %s' % key)
+            self.duplicates.add(key)
+        elif elt.tag == 'SSLRevoked':
+            bisect.insort(self.revoked,int(key[1]))
+            self.revokedLog.append(int(key[1]))
+        self.updateElt(elt)
+
+    def update(self,obj):
+        '''
+        Flag a stored object whose element has changed, e.g. a
+        regenerated cert, to be saved with the next write(); if the
+        object was built from a copy of the indexed element, the copy
+        replaces it
+        '''
+        self.updateElt(obj.elt)
+
+    def updateElt(self,elt):
+        '''
+        Flag a stored object element as changed; see update()
+        '''
+        key = self.eltKey(elt)
+        if key in self.lookup:
+            self.unindexProfile(key,self.lookup[key])
+        self.lookup[key] = elt
+        self.indexProfile(key,elt)
+        self.changed[key] = elt
+        self.removed.discard(key)
+        self.generations[key] = self.generations.get(key,0) + 1
 
+    def remove(self,elt):
+        '''
+        Remove an object element from the index
+        '''
+        key = self.eltKey(elt)
+        if self.lookup.get(key) is elt:
+            del self.lookup[key]
+            self.unindexProfile(key,elt)
+            if elt.tag == 'SSLRevoked':
+                self.revoked.remove(int(key[1]))
+                self.revokedResets += 1
+        else:
+            self.extras = [e for e in self.extras if e is not elt]
+        if key in self.duplicates:
+            # rare; a surviving duplicate takes the removed one's place
+            dups = [e for e in self.extras if self.eltKey(e) == key]
+            if key not in self.lookup and dups:
+                self.extras.remove(dups[0])
+                self.lookup[key] = dups.pop(0)
+                self.indexProfile(key,self.lookup[key])
+            if not dups:
+                self.duplicates.discard(key)
+        if key not in self.lookup:
+            self.changed.pop(key,None)
+            self.removed.add(key)
+        self.generations[key] = self.generations.get(key,0) + 1
+
+    def generation(self,key):
+        '''
+        Return a counter that changes whenever the entry with the
+        (ssltype,name,host) key is stored, updated or removed
+        '''
+        return self.generations.get(key,0)
+
+    def isRevoked(self,serial):
+        '''Return True if the cert serial number has been revoked'''
+        i = bisect.bisect_left(self.revoked,int(serial))
+        return i < len(self.revoked) and self.revoked[i] == int(serial)
+
+    def newSerial(self):
+        '''
+        Allocate a new serial number through the backend
+        '''
+        return self.backend.nextSerial(self)
+
+    def raiseSerial(self,serial):
+        '''
+        Make sure new serial numbers are greater than serial
+        '''
+        self.backend.raiseSerial(self,serial)
 
     def getCAState(self,key,default=None,coerce=None):
         '''
-        Retrieve a state variable from the SSLCAState container element;
-        optionally set a default for or coerce return value
+        Retrieve a CA state variable; optionally set a default for
+        or coerce return value
         '''
-        xpath = '/SSLCAState/State[@name="%s"]' % key
-        elt = self.index.find(xpath)
-        if elt is None:
+        value = self.state.get(key)
+        if value is None:
             return default
         elif coerce is None:
-            return elt.get('value')
+            return value
         else:
-            return coerce(elt.get('value'))
+            return coerce(value)
 
     def setCAState(self,key,val):
         '''
-        Set a state variable from the SSLCAState container element
-        Create state variable element if it doesn't already exist
+        Set a CA state variable
         '''
-        # get existing or create new State element
-        elt = self.index.find('/SSLCAState/State[@name="%s"]' % key)
-        if elt is None:
-            # Put a new State element in the index
-            elt = etree.Element('State',name=key)
-            self.index.find('/SSLCAState').append(elt)
-        # set variable
-        elt.set('value',str(val))
+        self.state[key] = str(val)
+        self.changedState.add(key)
 
     def tostring(self):
         '''Return a string with XML representation of index'''
-        return etree.tostring(self.index, pretty_print=True)
+        return etree.tostring(self.toTree(), pretty_print=True)
 
@@ -0,0 +1,168 @@
+import logging
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+class SSLRecordException(Exception):
+    pass
+
+# attributes whose values are different in every record, so aren't
+# worth sharing; see share()
+uniqueAttrs = frozenset(['uuid', 'serial', 'not_before', 'not_after',
+                         'subject_hash', 'revoked', 'text_offset',
+                         'text_time', 'verify_failed'])
+
+# shared attribute values and name tuples
+_shared = {}
+
+def share(value,unique=False):
+    '''
+    Return a shared copy of an attribute value or name tuple, so
+    records with equal values (the same host, path, owner, ...) hold
+    one string between them; unicode values are turned into str when
+    they're ASCII, as lxml does, since py2 unicode takes four bytes
+    per character.  'unique' values are only converted.
+    '''
+    if isinstance(value,unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeError:
+            pass
+    if unique:
+        return value
+    return _shared.setdefault(value,value)
+
+class SSLRecord(object):
+    '''
+    A compact index entry for an SSL object:  an element tag
+    ('SSLKey', 'SSLCert', ...) and string attributes
+
+    Records stand in for the lxml elements the index used to keep in
+    memory, with the part of the element API the plugin uses:  'tag',
+    get(), set(), items(), keys(), update(), pop(), copying, and
+    toElement()/fromElement() to convert at serialization time.
+
+    Attribute names are a tuple shared by every record with the same
+    names in the same order, and values a tuple of shared strings
+    (see share()), so a record costs a few hundred bytes rather than
+    the kilobytes of an element with its attribute and text nodes.
+    Records are changed by replacing the tuples, never in place.
+    '''
+    __slots__ = ('tag', '_names', '_values')
+
+    def __init__(self,tag,attrib=None,**extra):
+        self.tag = share(tag)
+        self._names = ()
+        self._values = ()
+        if attrib:
+            self.update(attrib)
+        if extra:
+            self.update(extra)
+
+    @classmethod
+    def fromElement(cls,elt):
+        '''Return a record with the tag and attributes of an element'''
+        return cls(elt.tag,elt.items())
+
+    def toElement(self):
+        '''Return an element with the record's tag and attributes'''
+        elt = etree.Element(self.tag)
+        for name, value in zip(self._names,self._values):
+            elt.set(name,value)
+        return elt
+
+    def tostring(self,pretty_print=False):
+        '''Return the record serialized as an XML element'''
+        return etree.tostring(self.toElement(),pretty_print=pretty_print)
+
+    def get(self,name,default=None):
+        try:
+            return self._values[self._names.index(name)]
+        except ValueError:
+            return default
+
+    def set(self,name,value):
+        if not isinstance(value,basestring):
+            raise SSLRecordException('attribute "%s" of %s: value %r is not '
+                                     'a string' % (name,self.tag,value))
+        value = share(value,name in uniqueAttrs)
+        try:
+            i = self._names.index(name)
+        except ValueError:
+            self._names = share(self._names + (share(name),))
+            self._values = self._values + (value,)
+            return
+        self._values = self._values[:i] + (value,) + self._values[i+1:]
+
+    def update(self,attrib):
+        '''
+        Set attributes from a dict or a list of (name, value) pairs
+        '''
+        if hasattr(attrib,'items'):
+            attrib = attrib.items()
+        else:
+            attrib = list(attrib)
+        if self._names:
+            for name, value in attrib:
+                self.set(name,value)
+            return
+
+        # a new record, e.g. read from the index; build the tuples
+        # in one go.  ASCII unicode names hash like their str
+        # versions, so find the shared str tuple.
+        names = _shared.get(tuple([name for name, value in attrib]))
+        if names is None:
+            names = tuple([share(name) for name, value in attrib])
+            if len(set(names)) != len(names):
+                for name, value in attrib:
+                    self.set(name,value)
+                return
+            names = share(names)
+        values = []
+        for name, value in attrib:
+            if value.__class__ is not str:
+                if not isinstance(value,basestring):
+                    # raises the error
+                    self.set(name,value)
+                value = share(value,name in uniqueAttrs)
+            elif name not in uniqueAttrs:
+                value = _shared.setdefault(value,value)
+            values.append(value)
+        self._names = names
+        self._values = tuple(values)
+
+    def pop(self,name,default=None):
+        try:
+            i = self._names.index(name)
+        except ValueError:
+            return default
+        value = self._values[i]
+        self._names = share(self._names[:i] + self._names[i+1:])
+        self._values = self._values[:i] + self._values[i+1:]
+        return value
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._names,self._values)
+
+    def __contains__(self,name):
+        return name in self._names
+
+    def __copy__(self):
+        # the tuples are never changed in place, so can be shared
+        copy = SSLRecord.__new__(SSLRecord)
+        copy.tag = self.tag
+        copy._names = self._names
+        copy._values = self._values
+        return copy
+
+    def __deepcopy__(self,memo):
+        return self.__copy__()
+
+    def __repr__(self):
+        return '<SSLRecord %s %r>' % (self.tag,dict(self.items()))
@@ -0,0 +1,279 @@
+import heapq
+import logging
+import threading
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+class SSLRenewerException(Exception):
+    pass
+
+class SSLRenewer(object):
+    '''
+    Background renewal scheduler for a CA
+
+    Without it, a cert is only renewed when its client binds it
+    within cert_replace_days of expiry, and the client's run waits
+    for the new key lookup and signature.  The renewer keeps a
+    min-heap of (due time, not_after, index key) for the CA's certs,
+    built from the index and updated as certs are issued, and
+    reissues certs 'renew_days' days before they expire, ahead of the
+    clients:
+
+    - only during the 'renew_window' off-peak hours (local time,
+      e.g. 01:00-05:00; may wrap past midnight)
+    - at most 'renew_rate' certs per hour
+    - in a pool of 'renew_workers' threads
+
+    A cert that lives no longer than 'renew_days' (e.g. a spec entry
+    with a small 'days') is renewed halfway through its lifetime
+    instead, so a renewed cert is never due again as soon as it's
+    issued; see dueTime().
+
+    Other components can queue certs for reissue with enqueue();
+    these go through the same window and rate limit.
+
+    Heap entries are not removed when a cert is reissued; the live
+    not_after of each scheduled cert is kept in a dict, and heap
+    entries that don't match it are skipped when they come up, or
+    dropped once they outnumber the live ones.  The rate limit is a
+    deadline for the next dispatch, which new certs and enqueued keys
+    don't bring forward.
+    '''
+    def __init__(self,ca):
+        self.ca = ca
+        self.enabled = str(ca.renew_enable).lower() == 'true'
+        self.renewDays = int(ca.renew_days)
+        self.rate = float(ca.renew_rate)
+        self.workers = int(ca.renew_workers)
+        self.window = self.parseWindow(ca.renew_window)
+        if self.enabled and self.renewDays <= int(ca.cert_replace_days):
+            logger.warning('CA "%s": renew_days should be greater than '
+                           'cert_replace_days, or clients will renew '
+                           'certs first' % ca.name)
+        if self.enabled and self.renewDays >= int(ca.cert_default_days):
+            logger.warning('CA "%s": renew_days should be less than '
+                           'cert_default_days; certs will be renewed '
+                           'halfway through their lifetime' % ca.name)
+
+        self.heap = []
+        # { index key : not_after } of the scheduled certs
+        self.live = {}
+        self.pending = []
+        # no cert is dispatched before this time, see scheduler()
+        self.nextDispatch = 0
+        self.queue = Queue.Queue(max(self.workers,1))
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.running = False
+        self.threads = []
+        self.renewed = 0
+        self.failed = 0
+
+    def parseWindow(self,window):
+        '''
+        Parse 'HH:MM-HH:MM' into (start, end) minutes past midnight
+        '''
+        try:
+            start, end = [t.strip().split(':') for t in window.split('-')]
+            start = int(start[0]) * 60 + int(start[1])
+            end = int(end[0]) * 60 + int(end[1])
+        except (ValueError, IndexError):
+            raise SSLRenewerException('CA "%s": bad renew_window "%s"' %
+                                      (self.ca.name,window))
+        return start, end
+
+    def inWindow(self,now=None):
+        '''
+        Return 0 if now is inside the renewal window, else the number
+        of seconds until the window opens
+        '''
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        start, end = self.window
+        if start == end or \
+                (start < end and start <= minute < end) or \
+                (start > end and (minute >= start or minute < end)):
+            return 0
+        return ((start - minute) % (24*60)) * 60 - t.tm_sec
+
+    def dueTime(self,elt):
+        '''
+        Return the time a cert element is due for renewal:
+        'renew_days' before it expires, but no earlier than halfway
+        through its lifetime
+        '''
+        notAfter = int(elt.get('not_after'))
+        due = notAfter - self.renewDays * 24*60*60
+        if elt.get('not_before') is not None:
+            notBefore = int(elt.get('not_before'))
+            due = max(due,notBefore + (notAfter - notBefore) // 2)
+        return due
+
+    def build(self):
+        '''
+        Build the heap of (due time, not_after, index key) from the
+        CA's indexed certs
+        '''
+        heap = []
+        with self.ca.lock:
+            for elt in self.ca.index.records('SSLCert'):
+                if elt.get('not_after') is not None:
+                    heap.append((self.dueTime(elt),int(elt.get('not_after')),
+                                 self.ca.index.eltKey(elt)))
+        heapq.heapify(heap)
+        with self.lock:
+            self.heap = heap
+            self.live = dict([(key, notAfter)
+                              for due, notAfter, key in heap])
+            self.cond.notify()
+
+    def schedule(self,obj):
+        '''
+        Add a newly issued or renewed cert to the heap
+        '''
+        if not self.running or obj.attrib('not_after') is None:
+            return
+        key = self.ca.index.eltKey(obj.elt)
+        notAfter = int(obj.attrib('not_after'))
+        with self.lock:
+            self.live[key] = notAfter
+            heapq.heappush(self.heap,(self.dueTime(obj.elt),notAfter,key))
+            if len(self.heap) > 2 * len(self.live):
+                # drop the entries of replaced certs
+                self.heap = [entry for entry in self.heap
+                             if self.live.get(entry[2]) == entry[1]]
+                heapq.heapify(self.heap)
+            self.cond.notify()
+
+    def enqueue(self,keys):
+        '''
+        Queue certs, by (ssltype,name,host) index key, for reissue
+        regardless of their expiration; keys already queued are
+        skipped
+        '''
+        with self.lock:
+            queued = set(self.pending)
+            self.pending.extend([key for key in keys if key not in queued])
+            self.cond.notify()
+
+    def start(self):
+        '''Build the heap and start the scheduler and worker threads'''
+        if not self.enabled or self.running:
+            return
+        self.running = True
+        self.build()
+        self.threads = [threading.Thread(target=self.scheduler,
+                                         name='ZBCA %s renewal scheduler' %
+                                         self.ca.name)]
+        for i in range(self.workers):
+            self.threads.append(threading.Thread(
+                    target=self.worker,
+                    name='ZBCA %s renewal worker %d' % (self.ca.name,i)))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def shutdown(self):
+        '''Stop the threads'''
+        if not self.running:
+            return
+        self.running = False
+        with self.lock:
+            self.cond.notify_all()
+        for i in range(self.workers):
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                pass
+        # let the workers finish the certs they're on
+        for thread in self.threads:
+            thread.join(10)
+
+    def nextDue(self):
+        '''
+        Pop the next cert due for renewal from the pending list or
+        the heap; return None and the time to wait if none is due.
+        Call with self.lock held.
+        '''
+        if self.pending:
+            return self.pending.pop(0), 0
+        now = time.time()
+        while self.heap:
+            due, notAfter, key = self.heap[0]
+            wait = due - now
+            if wait > 0:
+                return None, wait
+            heapq.heappop(self.heap)
+            if self.live.get(key) != notAfter:
+                # stale entry; the cert was renewed since
+                continue
+            # a plain dict lookup, safe without the CA lock
+            elt = self.ca.index.lookup.get(key)
+            if elt is not None and elt.get('not_after') == str(notAfter):
+                return key, 0
+            # the cert was removed, or renewed without being scheduled
+            del self.live[key]
+        return None, None
+
+    def scheduler(self):
+        '''
+        Scheduler thread main loop:  hand due certs to the workers,
+        inside the window and at the configured rate
+        '''
+        while self.running:
+            # new certs and enqueued keys wake us up, but nothing is
+            # dispatched before the rate limit allows
+            wait = self.nextDispatch - time.time()
+            if wait <= 0:
+                wait = self.inWindow()
+            if not wait:
+                try:
+                    with self.lock:
+                        key, wait = self.nextDue()
+                except Exception as e:
+                    logger.error('CA "%s": renewal scheduler error: %s' %
+                                 (self.ca.name,e))
+                    key, wait = None, 60
+                if key is not None:
+                    self.queue.put(key)
+                    if self.rate > 0:
+                        self.nextDispatch = time.time() + 3600 / self.rate
+                    wait = 0
+            if wait is None or wait > 0:
+                with self.lock:
+                    if self.running:
+                        # wake up at least every 5 minutes
+                        self.cond.wait(min(wait or 300,300))
+
+    def worker(self):
+        '''Worker thread main loop:  reissue certs'''
+        while self.running:
+            key = self.queue.get()
+            if key is None or not self.running:
+                break
+            try:
+                obj = self.ca.reissue(key)
+                if obj is not None:
+                    self.renewed += 1
+                    logger.info('CA "%s": renewed cert "%s" for host "%s"' %
+                                (self.ca.name,key[1],key[2]))
+            except Exception as e:
+                self.failed += 1
+                logger.error('CA "%s": failed to renew cert "%s" for host '
+                             '"%s": %s' % (self.ca.name,key[1],key[2],e))
+
+    def stats(self):
+        '''Return a dict of renewer statistics'''
+        with self.lock:
+            nextDue = max(self.heap and self.heap[0][0] or 0,
+                          self.nextDispatch)
+            return {
+                'enabled'   : self.enabled,
+                'scheduled' : len(self.live),
+                'pending'   : len(self.pending),
+                'next_due'  : int(nextDue),
+                'renewed'   : self.renewed,
+                'failed'    : self.failed,
+                }
@@ -0,0 +1,145 @@
+import csv
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class SSLReportException(Exception):
+    pass
+
+# seconds in a day and a week
+DAY = 24*60*60
+WEEK = 7*DAY
+
+class SSLReport(object):
+    '''
+    Expiry and inventory report on a CA's certs, built from the index
+    alone
+
+    Each SSLCert index element records its notAfter and serial (see
+    SSLObj.recordCertInfo()), and its key's SSLKey element the key
+    algorithm and size, so one pass over the index is enough; no PEM
+    file is opened, except to backfill index entries written before
+    ZBCA recorded notAfter (see SSLCA.backfillCertInfo()).
+
+    rows() returns a dict per cert, sorted by notAfter; weeks()
+    counts the certs expiring in each week, by the week's Monday,
+    with certs already expired under 'expired'.
+    '''
+    # report columns, in CSV order
+    fields = ('host', 'path', 'serial', 'algorithm', 'bits', 'curve',
+              'not_after', 'days_left')
+
+    def __init__(self,ca,now=None,within=None):
+        self.ca = ca
+        self.now = int(now or time.time())
+        # only report certs expiring within this many days
+        self.within = within
+        self._rows = None
+
+    def backfill(self):
+        '''
+        Record notAfter in index entries missing it; return the
+        number of entries updated
+        '''
+        count = self.ca.backfillCertInfo()
+        if count:
+            logger.info('CA "%s": recorded notAfter for %d old cert index '
+                        'entries' % (self.ca.name,count))
+        return count
+
+    def rows(self):
+        '''Return the report rows, oldest notAfter first'''
+        if self._rows is not None:
+            return self._rows
+        self.backfill()
+        lookup = self.ca.index.lookup
+        rows = []
+        with self.ca.lock:
+            for elt in self.ca.index.records('SSLCert'):
+                try:
+                    notAfter = int(elt.get('not_after'))
+                except (TypeError, ValueError):
+                    raise SSLReportException(
+                        'CA "%s": bad not_after "%s" in the index entry of '
+                        'cert "%s", host "%s"' %
+                        (self.ca.name,elt.get('not_after'),elt.get('name'),
+                         elt.get('host')))
+                daysLeft = (notAfter - self.now) // DAY
+                if self.within is not None and daysLeft > self.within:
+                    continue
+                host = elt.get('host')
+                # an appended key has the cert's name
+                key = lookup.get(('SSLKey',elt.get('key') or elt.get('name'),
+                                  host))
+                if key is None:
+                    key = {}
+                rows.append({
+                    'host'      : host,
+                    'path'      : elt.get('name'),
+                    'serial'    : elt.get('serial'),
+                    'algorithm' : key.get('algorithm',''),
+                    'bits'      : key.get('bits',''),
+                    'curve'     : key.get('curve',''),
+                    'not_after' : notAfter,
+                    'days_left' : daysLeft,
+                    })
+        rows.sort(key=lambda row: (row['not_after'],row['host'],row['path']))
+        self._rows = rows
+        return rows
+
+    def weeks(self):
+        '''
+        Return a list of (week, count) pairs of certs expiring each
+        week, 'week' being its Monday as YYYY-MM-DD, in order and
+        including empty weeks; certs already expired are counted in
+        a leading ('expired', count) pair
+        '''
+        expired = 0
+        counts = {}
+        for row in self.rows():
+            if row['not_after'] <= self.now:
+                expired += 1
+                continue
+            # the epoch was a Thursday
+            monday = (row['not_after'] + 3*DAY) // WEEK * WEEK - 3*DAY
+            counts[monday] = counts.get(monday,0) + 1
+        result = [('expired',expired)]
+        if counts:
+            monday = min(counts)
+            while monday <= max(counts):
+                result.append((time.strftime('%Y-%m-%d',time.gmtime(monday)),
+                               counts.get(monday,0)))
+                monday += WEEK
+        return result
+
+    @staticmethod
+    def isoTime(seconds):
+        '''Format seconds since the epoch as an ISO 8601 UTC time'''
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(seconds))
+
+    def writeCSV(self,f,histogram=False):
+        '''Write the cert rows, or the weekly histogram, as CSV'''
+        writer = csv.writer(f)
+        if histogram:
+            writer.writerow(('week','count'))
+            writer.writerows(self.weeks())
+            return
+        writer.writerow(self.fields)
+        for row in self.rows():
+            row = dict(row,not_after=self.isoTime(row['not_after']))
+            writer.writerow([row[field] for field in self.fields])
+
+    def writeJSON(self,f):
+        '''Write the cert rows and the weekly histogram as JSON'''
+        certs = [dict(row,not_after=self.isoTime(row['not_after']))
+                 for row in self.rows()]
+        json.dump({
+                'ca'        : self.ca.name,
+                'generated' : self.isoTime(self.now),
+                'certs'     : certs,
+                'weeks'     : [{'week' : week, 'count' : count}
+                               for week, count in self.weeks()],
+                }, f, indent=1, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import time
+from OpenSSL import crypto
+from SSLObj import signCRL
+
+logger = logging.getLogger(__name__)
+
+class SSLRevocationException(Exception):
+    pass
+
+# CRL reason codes accepted by revoke()
+reasons = crypto.Revoked().all_reasons()
+
+# the ASN1 time format pyOpenSSL takes
+asn1Format = '%Y%m%d%H%M%SZ'
+
+class SSLRevocation(object):
+    '''
+    Maintains a CA's certificate revocation list, SSLCA/SSLCRL.pem,
+    bound by 'type="SSLCRL"' Path entries
+
+    Revoked certs are SSLRevoked index entries (see SSLCA.revoke()).
+    The CRL object is kept in memory and brought up to date by
+    refresh():  serials revoked since the last refresh are added to
+    it from the index's revocation log, so the cost of an update
+    doesn't grow with the number of revoked certs; only a removed
+    revocation, or the first refresh, builds it from scratch.  The
+    CRL is re-signed and written only when revocations were added or
+    when its nextUpdate is less than 'crl_refresh_hours' hours away;
+    it's valid for 'crl_days' days.
+    '''
+    def __init__(self,ca):
+        self.ca = ca
+        self.days = int(ca.crl_days)
+        self.refreshSeconds = int(ca.crl_refresh_hours) * 60*60
+        if self.refreshSeconds >= self.days * 24*60*60:
+            raise SSLRevocationException(
+                'CA "%s": crl_refresh_hours must be less than crl_days' %
+                ca.name)
+        self.lock = threading.Lock()
+        self.crl = None
+        # position in the index's revocation log, and its reset count,
+        # when self.crl was last brought up to date
+        self.logPos = 0
+        self.resets = None
+        self.nextUpdate = 0
+        self.builds = 0
+        self.updates = 0
+
+    def crlFname(self):
+        '''Convenience function returns the CRL file name'''
+        return self.ca.caFname('SSLCRL')
+
+    def revokedEntry(self,serial):
+        '''
+        Return a crypto.Revoked object for the indexed revoked serial
+        '''
+        elt = self.ca.index.search('SSLRevoked',str(serial),'')
+        revoked = crypto.Revoked()
+        revoked.set_serial('%x' % serial)
+        revoked.set_rev_date(time.strftime(
+                asn1Format,time.gmtime(int(elt.get('revoked')))))
+        if elt.get('reason') is not None:
+            revoked.set_reason(elt.get('reason'))
+        return revoked
+
+    def stale(self):
+        '''
+        Return True if the CRL file is missing, revocations were
+        added or removed, or nextUpdate is near
+        '''
+        index = self.ca.index
+        return self.crl is None or self.resets != index.revokedResets or \
+            self.logPos < len(index.revokedLog) or \
+            time.time() >= self.nextUpdate - self.refreshSeconds or \
+            not os.path.exists(self.crlFname())
+
+    def refresh(self,force=False):
+        '''
+        Bring the CRL up to date, re-sign it and write it if it's
+        stale; return True if it was written
+        '''
+        with self.lock:
+            if not force and not self.stale():
+                return False
+
+            index = self.ca.index
+            with self.ca.lock:
+                if self.crl is None or self.resets != index.revokedResets:
+                    self.crl = crypto.CRL()
+                    serials = list(index.revoked)
+                    self.builds += 1
+                else:
+                    serials = index.revokedLog[self.logPos:]
+                for serial in serials:
+                    self.crl.add_revoked(self.revokedEntry(serial))
+                self.logPos = len(index.revokedLog)
+                self.resets = index.revokedResets
+            self.updates += 1
+
+            # sign it
+            now = int(time.time())
+            self.nextUpdate = now + self.days * 24*60*60
+            self.crl.set_version(1) # v2 = 1
+            self.crl.set_lastUpdate(time.strftime(asn1Format,
+                                                  time.gmtime(now)))
+            self.crl.set_nextUpdate(time.strftime(
+                    asn1Format,time.gmtime(self.nextUpdate)))
+            cacert = self.ca.caObj('SSLCACert').cryptoObj()
+            cakey = self.ca.caObj('SSLCAKey').cryptoObj()
+            signCRL(self.crl,cacert,cakey,self.ca.cert_default_md)
+            text = crypto.dump_crl(crypto.FILETYPE_PEM, self.crl)
+
+            # write it through a temp file, so it's never partial
+            tmpname = self.crlFname() + '.new'
+            f = open(tmpname,'w')
+            try:
+                f.write(text)
+            finally:
+                f.close()
+            os.rename(tmpname,self.crlFname())
+            self.ca.invalidateCACache('SSLCRL')
+            logger.info('CA "%s": wrote CRL with %d revoked certs' %
+                        (self.ca.name,len(index.revoked)))
+            return True
+
+    def stats(self):
+        '''Return a dict of revocation statistics'''
+        return {
+            'revoked'       : len(self.ca.index.revoked),
+            'builds'        : self.builds,
+            'updates'       : self.updates,
+            'next_update'   : self.nextUpdate,
+            }
@@ -0,0 +1,198 @@
+import bisect
+import cProfile
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Bcfg2 1.3 and later keep server timing statistics, shown by
+# 'bcfg2-admin perf'
+try:
+    import Bcfg2.Statistics
+    HAS_BCFG2_STATISTICS = True
+except ImportError:
+    HAS_BCFG2_STATISTICS = False
+
+logger = logging.getLogger(__name__)
+
+class SSLStatsException(Exception):
+    pass
+
+# upper bounds of the latency histogram buckets, in seconds; the last
+# bucket holds anything slower
+buckets = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+           0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+class SSLStats(object):
+    '''
+    Counters and latency histograms for the stages of a CA's bind
+    path
+
+    Stages are timed with the timer() context manager and counted
+    with count(); the plugin uses these:
+
+    - stages:  'bind' (ZBCA.BindEntry), 'search' (index lookup),
+      'read' (SSLObj.readText), 'validate' (expiry checks), 'genkey',
+      'sign' (SSLObj.genCrypto), 'verify' (SSLVerify, with
+      'cert_verify') and 'write' (index writes)
+    - counters:  'binds', 'index_hits', 'index_misses',
+      'keys_generated', 'certs_signed', 'certs_verified',
+      'index_writes' and 'index_bytes'
+
+    Each stage keeps a count, total and maximum, and a histogram over
+    'buckets', from which stats() estimates percentiles.  Timings are
+    also added to Bcfg2's server statistics as '<name>:<stage>',
+    where Bcfg2 has them.
+    '''
+    def __init__(self,name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {}
+        # { stage : [count, total, max, histogram] }
+        self.timings = {}
+
+    def count(self,counter,n=1):
+        '''Add n to a counter'''
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter,0) + n
+
+    def record(self,stage,seconds):
+        '''Record one timing of a stage'''
+        i = bisect.bisect_left(buckets,seconds)
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = \
+                    [0, 0.0, 0.0, [0] * (len(buckets) + 1)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2],seconds)
+            timing[3][i] += 1
+        if HAS_BCFG2_STATISTICS:
+            Bcfg2.Statistics.stats.add_value('%s:%s' % (self.name,stage),
+                                             seconds)
+
+    @contextmanager
+    def timer(self,stage):
+        '''Context manager that records the time spent in a stage'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage,time.time() - start)
+
+    @staticmethod
+    def percentile(timing,fraction):
+        '''
+        Estimate a percentile of a stage's timings:  the upper bound
+        of the histogram bucket it falls in, or the maximum if that
+        is lower or it falls in the last bucket
+        '''
+        count, total, maximum, histogram = timing
+        seen = 0
+        for bound, n in zip(buckets,histogram):
+            seen += n
+            if seen >= fraction * count:
+                return min(bound,maximum)
+        return maximum
+
+    def stats(self):
+        '''
+        Return a dict of the counters, and of each stage's count,
+        total, mean, maximum and estimated 50th and 99th percentile
+        times in seconds, and histogram counts per bucket
+        '''
+        with self.lock:
+            timings = dict([(stage, list(timing[:3]) + [list(timing[3])])
+                            for stage, timing in self.timings.items()])
+            counters = dict(self.counters)
+        result = {}
+        for stage, timing in timings.items():
+            count, total, maximum, histogram = timing
+            result[stage] = {
+                'count'     : count,
+                'total'     : total,
+                'mean'      : total / count,
+                'max'       : maximum,
+                'p50'       : self.percentile(timing,0.5),
+                'p99'       : self.percentile(timing,0.99),
+                'histogram' : histogram,
+                }
+        return {
+            'counters'  : counters,
+            'timings'   : result,
+            'buckets'   : list(buckets),
+            }
+
+class SSLProfiler(object):
+    '''
+    Capture a cProfile profile of the next N binds, and save it for
+    the pstats module to read
+
+    A profile is only enabled in one thread at a time, so binds that
+    run while another is being profiled aren't captured.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = threading.Lock()
+        self.profile = None
+        self.remaining = 0
+        self.fname = None
+
+    def start(self,binds,fname):
+        '''Profile the next 'binds' binds into the file fname'''
+        if binds < 1:
+            raise SSLStatsException('the number of binds to profile must '
+                                    'be positive')
+        with self.lock:
+            if self.remaining:
+                raise SSLStatsException('already profiling %d more binds '
+                                        'into %s' %
+                                        (self.remaining,self.fname))
+            self.profile = cProfile.Profile()
+            self.fname = fname
+            self.remaining = binds
+        logger.info('ZBCA: profiling the next %d binds into %s' %
+                    (binds,fname))
+
+    @contextmanager
+    def capture(self):
+        '''Context manager that profiles a bind, if one is wanted'''
+        if not self.remaining or not self.running.acquire(False):
+            yield
+            return
+        try:
+            profile = self.profile
+            if profile is None:
+                yield
+                return
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self.captured(profile)
+        finally:
+            self.running.release()
+
+    def captured(self,profile):
+        '''Count a profiled bind, and save the profile after the last'''
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining:
+                return
+            self.profile = None
+        try:
+            profile.dump_stats(self.fname)
+            logger.info('ZBCA: saved the bind profile to %s' % self.fname)
+        except (IOError, OSError) as e:
+            logger.error('ZBCA: failed to save the bind profile to %s: %s'
+                         % (self.fname,e))
+
+    def stats(self):
+        '''Return a dict of the profiling state'''
+        with self.lock:
+            return {
+                'remaining' : self.remaining,
+                'file'      : self.fname or '',
+                }
@@ -0,0 +1,379 @@
+import copy
+import logging
+import mmap
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class SSLTextStoreException(Exception):
+    pass
+
+# object types whose PEM text is kept in the store; CA objects are
+# files in the CA's SSLCA directory
+textTypes = ('SSLKey', 'SSLCert')
+
+# index element attributes recording where the pack store put an
+# object's text
+locationAttrs = ('text_pack', 'text_offset', 'text_length', 'text_time')
+
+# packs smaller than this aren't worth compacting
+minCompactBytes = 1 << 20
+
+class SSLTextStore(object):
+    '''
+    Abstract storage for the PEM text of a CA's keys and certs,
+    chosen with the CA's 'text_store' option
+
+    - read() returns an object's text, given its index element
+    - write() saves an object's text, and may record where in the
+      element; the element is saved in the index afterwards
+    - mtime() returns the time an object's text was last written
+    - flush() makes text written with sync=False durable
+    - removeText() deletes the text of index elements, after it was
+      converted to another store (see importText())
+    '''
+    # name used for the 'text_store' CA config option
+    name = None
+
+    def __init__(self,ca):
+        self.ca = ca
+
+    def read(self,elt):
+        raise NotImplementedError
+
+    def write(self,elt,text,sync=True):
+        raise NotImplementedError
+
+    def mtime(self,elt):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def removeText(self,records):
+        raise NotImplementedError
+
+    def stats(self):
+        '''Return a dict of store statistics'''
+        return {'store' : self.name}
+
+    def importText(self,source,remove=True):
+        '''
+        Copy the text of every indexed key and cert from another
+        store into this one, and save the index; with 'remove', the
+        source's copies are deleted afterwards.  Run it while the
+        Bcfg2 server is stopped.  Return (copied, missing) counts.
+        '''
+        index = self.ca.index
+        copied = []
+        missing = 0
+        index.defer()
+        try:
+            with self.ca.lock:
+                for ssltype in textTypes:
+                    for elt in index.records(ssltype):
+                        try:
+                            text = source.read(elt)
+                        except (IOError, OSError,
+                                SSLTextStoreException) as e:
+                            logger.warning('CA "%s": no text for %s "%s", '
+                                           'host "%s": %s' %
+                                           (self.ca.name,ssltype,
+                                            elt.get('name'),
+                                            elt.get('host'),e))
+                            missing += 1
+                            continue
+                        copied.append(elt)
+                        elt = copy.copy(elt)
+                        self.write(elt,text,sync=False)
+                        index.updateElt(elt)
+                self.flush()
+        finally:
+            index.commit()
+        if remove:
+            source.removeText(copied)
+        return len(copied), missing
+
+
+class SSLFileTextStore(SSLTextStore):
+    '''
+    One PEM file per object, <uuid>.pem in the CA's SSLKey and
+    SSLCert directories; writes aren't synced, as they never were
+    '''
+    name = 'files'
+
+    def fname(self,elt):
+        return '%s/%s/%s.pem' % (self.ca.basepath,elt.tag,elt.get('uuid'))
+
+    def read(self,elt):
+        with open(self.fname(elt),'r') as f:
+            return f.read()
+
+    def write(self,elt,text,sync=True):
+        # created w/mode go-rwx to keep key data safe
+        with os.fdopen(os.open(self.fname(elt),
+                               os.O_CREAT|os.O_WRONLY|os.O_TRUNC,0600),
+                       'w') as f:
+            f.write(text)
+        for attr in locationAttrs:
+            elt.pop(attr)
+
+    def mtime(self,elt):
+        return os.stat(self.fname(elt)).st_mtime
+
+    def removeText(self,records):
+        for elt in records:
+            try:
+                os.unlink(self.fname(elt))
+            except OSError:
+                pass
+
+
+class SSLPackTextStore(SSLTextStore):
+    '''
+    Append-only packs of PEM text, one per object type, in the CA
+    directory:  <ssltype>.<generation>.pack
+
+    An object's text is appended to its type's pack, and its index
+    element records the pack generation, offset and length, and the
+    time it was written.  Packs are read through a shared read-only
+    mmap, so a read is a slice of memory rather than an open, read
+    and close of a file; the map is renewed when a read reaches past
+    its end.  Writes are synced, unless batched with sync=False and
+    flush().
+
+    A rewritten (e.g. renewed) object leaves its old text behind in
+    the pack.  Once superseded text is over 'text_pack_garbage' of a
+    pack (and the pack is over a megabyte), the live text is copied
+    to a pack of the next generation, the index updated and saved,
+    and the current generation recorded in the CA state.  Objects
+    written while compacting still point at the old pack, so a pack
+    is only deleted by the compaction after the one that replaced it.
+
+    Indexed objects with no pack location, e.g. from before the CA
+    was switched to packs, are read from their PEM files, and packed
+    when next rewritten; 'zbca convert-store' packs them all at once.
+    '''
+    name = 'pack'
+
+    def __init__(self,ca):
+        SSLTextStore.__init__(self,ca)
+        self.files = SSLFileTextStore(ca)
+        self.garbageRatio = float(ca.text_pack_garbage)
+        self.lock = threading.RLock()
+        # { (ssltype, generation) : mmap }
+        self.maps = {}
+        # { ssltype : (generation, fd) } packs open for appending
+        self.appenders = {}
+        # { ssltype : bytes } current pack sizes and superseded text
+        self.sizes = {}
+        self.garbage = {}
+        for ssltype in textTypes:
+            self.countGarbage(ssltype)
+
+    def packFname(self,ssltype,generation):
+        return '%s/%s.%d.pack' % (self.ca.basepath,ssltype,generation)
+
+    def generation(self,ssltype):
+        '''Return the current pack generation of an object type'''
+        return self.ca.index.getCAState('text_pack_%s' % ssltype,
+                                        default=0,coerce=int)
+
+    def countGarbage(self,ssltype):
+        '''Count the superseded text in the current pack'''
+        generation = str(self.generation(ssltype))
+        live = sum([int(elt.get('text_length'))
+                    for elt in self.ca.index.records(ssltype)
+                    if elt.get('text_pack') == generation])
+        try:
+            size = os.path.getsize(self.packFname(ssltype,int(generation)))
+        except OSError:
+            size = 0
+        self.sizes[ssltype] = size
+        self.garbage[ssltype] = max(size - live,0)
+
+    def mapping(self,ssltype,generation,end):
+        '''Return an mmap of a pack at least 'end' bytes long'''
+        key = (ssltype,generation)
+        mm = self.maps.get(key)
+        if mm is not None and len(mm) >= end:
+            return mm
+        with self.lock:
+            mm = self.maps.get(key)
+            if mm is None or len(mm) < end:
+                fname = self.packFname(ssltype,generation)
+                try:
+                    f = open(fname,'rb')
+                    try:
+                        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+                    finally:
+                        f.close()
+                except (IOError, OSError, ValueError) as e:
+                    raise SSLTextStoreException('CA "%s": can\'t map %s: %s'
+                                                % (self.ca.name,fname,e))
+                if len(mm) < end:
+                    raise SSLTextStoreException(
+                        'CA "%s": %s is truncated' % (self.ca.name,fname))
+                # readers of the old map keep it until they're done
+                self.maps[key] = mm
+        return mm
+
+    def read(self,elt):
+        offset = elt.get('text_offset')
+        if offset is None:
+            return self.files.read(elt)
+        try:
+            generation = int(elt.get('text_pack'))
+            offset = int(offset)
+            end = offset + int(elt.get('text_length'))
+        except (TypeError, ValueError):
+            raise SSLTextStoreException(
+                'CA "%s": bad text location for %s "%s", host "%s"' %
+                (self.ca.name,elt.tag,elt.get('name'),elt.get('host')))
+        text = self.mapping(elt.tag,generation,end)[offset:end]
+        if not text.startswith('-----BEGIN '):
+            raise SSLTextStoreException(
+                'CA "%s": no PEM text at offset %d of %s' %
+                (self.ca.name,offset,self.packFname(elt.tag,generation)))
+        return text
+
+    def appender(self,ssltype):
+        '''
+        Return (generation, fd) of the current pack of an object type
+        opened for appending; call with the lock held
+        '''
+        generation = self.generation(ssltype)
+        appender = self.appenders.get(ssltype)
+        if appender is None or appender[0] != generation:
+            if appender is not None:
+                os.close(appender[1])
+            appender = (generation,
+                        os.open(self.packFname(ssltype,generation),
+                                os.O_CREAT|os.O_WRONLY|os.O_APPEND,0600))
+            self.appenders[ssltype] = appender
+        return appender
+
+    def write(self,elt,text,sync=True):
+        ssltype = elt.tag
+        with self.lock:
+            generation, fd = self.appender(ssltype)
+            offset = os.lseek(fd,0,os.SEEK_END)
+            data = text
+            while data:
+                data = data[os.write(fd,data):]
+            if sync:
+                os.fsync(fd)
+            if elt.get('text_pack') == str(generation) and \
+                    elt.get('text_length') is not None:
+                self.garbage[ssltype] += int(elt.get('text_length'))
+            self.sizes[ssltype] = offset + len(text)
+            compact = self.garbageRatio > 0 and \
+                self.sizes[ssltype] >= minCompactBytes and \
+                self.garbage[ssltype] > \
+                self.garbageRatio * self.sizes[ssltype]
+        elt.update([('text_pack', str(generation)),
+                    ('text_offset', str(offset)),
+                    ('text_length', str(len(text))),
+                    ('text_time', '%.6f' % time.time())])
+        if compact:
+            self.compact(ssltype)
+
+    def mtime(self,elt):
+        if elt.get('text_time') is None:
+            return self.files.mtime(elt)
+        return float(elt.get('text_time'))
+
+    def flush(self):
+        with self.lock:
+            for generation, fd in self.appenders.values():
+                os.fsync(fd)
+
+    def compact(self,ssltype=None):
+        '''
+        Copy the live text of a type's pack, or of every type's, to a
+        new pack generation and save the index; return the number of
+        bytes reclaimed
+        '''
+        if ssltype is None:
+            return sum([self.compact(t) for t in textTypes])
+        with self.ca.lock:
+            with self.lock:
+                return self._compact(ssltype)
+
+    def _compact(self,ssltype):
+        index = self.ca.index
+        old = self.generation(ssltype)
+        generation = old + 1
+        fname = self.packFname(ssltype,generation)
+        tmpname = fname + '.new'
+        moved = []
+        size = 0
+        f = os.fdopen(os.open(tmpname,os.O_CREAT|os.O_TRUNC|os.O_WRONLY,
+                              0600),'wb')
+        try:
+            for elt in index.records(ssltype):
+                if elt.get('text_offset') is None:
+                    continue
+                text = self.read(elt)
+                f.write(text)
+                moved.append((elt,size,len(text)))
+                size += len(text)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpname,fname)
+
+        for elt, offset, length in moved:
+            elt = copy.copy(elt)
+            elt.update([('text_pack', str(generation)),
+                        ('text_offset', str(offset)),
+                        ('text_length', str(length))])
+            index.updateElt(elt)
+        index.setCAState('text_pack_%s' % ssltype,generation)
+        index.write()
+
+        reclaimed = self.sizes[ssltype] - size
+        self.sizes[ssltype] = size
+        self.garbage[ssltype] = 0
+        # text written to the old pack while compacting is copied by
+        # the next compaction, so only older packs can go now
+        for name in os.listdir(self.ca.basepath):
+            parts = name.split('.')
+            if len(parts) == 3 and parts[0] == ssltype and \
+                    parts[2] == 'pack' and parts[1].isdigit() and \
+                    int(parts[1]) < old:
+                os.unlink('%s/%s' % (self.ca.basepath,name))
+                self.maps.pop((ssltype,int(parts[1])),None)
+        logger.info('CA "%s": compacted the %s pack:  %d objects, %d bytes '
+                    'reclaimed' % (self.ca.name,ssltype,len(moved),
+                                   reclaimed))
+        return reclaimed
+
+    def removeText(self,records):
+        '''Delete every pack, once their text was converted'''
+        with self.lock:
+            for generation, fd in self.appenders.values():
+                os.close(fd)
+            self.appenders.clear()
+            self.maps.clear()
+            for name in os.listdir(self.ca.basepath):
+                if name.endswith('.pack') and name.split('.')[0] in textTypes:
+                    os.unlink('%s/%s' % (self.ca.basepath,name))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'store'     : self.name,
+                'packs'     : dict([(ssltype, {
+                                'generation' : self.generation(ssltype),
+                                'size'       : self.sizes[ssltype],
+                                'garbage'    : self.garbage[ssltype]})
+                                    for ssltype in textTypes]),
+                }
+
+# map 'text_store' option values to store classes
+stores = dict([(s.name, s) for s in (SSLFileTextStore,
+                                     SSLPackTextStore)])
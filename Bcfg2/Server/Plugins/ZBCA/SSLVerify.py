@@ -0,0 +1,304 @@
+import copy
+import logging
+import multiprocessing
+import threading
+import time
+from OpenSSL import crypto
+from SSLObj import loadCerts
+from SSLTextStore import SSLTextStoreException
+
+logger = logging.getLogger(__name__)
+
+# X509_V_FLAG_PARTIAL_CHAIN; pyOpenSSL only names it from v20
+PARTIAL_CHAIN = getattr(crypto.X509StoreFlags,'PARTIAL_CHAIN',0x80000)
+
+class SSLVerifyException(Exception):
+    pass
+
+def buildStore(cacerttext,chaintext):
+    '''
+    Return (X509Store, CA cert X509) for a CA's cert and chain PEM
+    texts; the CA cert is a trust anchor even if the chain has no
+    self-signed root.  The CA cert is checked against the store, so
+    e.g. an expired CA cert fails here rather than failing every cert.
+    '''
+    cacert = crypto.load_certificate(crypto.FILETYPE_PEM, cacerttext)
+    store = crypto.X509Store()
+    store.add_cert(cacert)
+    for cert in loadCerts(chaintext):
+        try:
+            store.add_cert(cert)
+        except crypto.Error:
+            # the CA cert is usually in the chain too
+            pass
+    store.set_flags(PARTIAL_CHAIN)
+    try:
+        crypto.X509StoreContext(store,cacert).verify_certificate()
+    except crypto.X509StoreContextError as e:
+        raise SSLVerifyException('the CA cert doesn\'t verify against the '
+                                 'CA chain: %s' % storeError(e))
+    return store, cacert
+
+def storeError(e):
+    '''Return the message of an X509StoreContextError'''
+    if isinstance(e.args[0],list) and len(e.args[0]) == 3:
+        return e.args[0][2]
+    return str(e)
+
+def extensionList(extensions):
+    '''Return (short name, critical, DER data) of X509Extensions'''
+    return [(ext.get_short_name(),bool(ext.get_critical()),ext.get_data())
+            for ext in extensions]
+
+def verifyCertText(store,cacert,profile,certtext,keytext=None):
+    '''
+    Verify a cert's PEM text against a CA; return a list of problems,
+    empty if it passes:
+
+    - chain:  the signature and dates, up the chain in 'store' (see
+      buildStore()); the cert must be issued by 'cacert' itself
+    - key:  the cert's public key is the key's, if 'keytext' is given
+    - extensions:  the cert has exactly the extensions the
+      SSLExtensionProfile 'profile' builds for it
+
+    This is a module-level function so it can be run in
+    multiprocessing workers, see verifyWorker()
+    '''
+    try:
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, certtext)
+    except crypto.Error as e:
+        return ['cert: unreadable: %s' % e]
+    problems = []
+    if cert.get_issuer().der() != cacert.get_subject().der():
+        problems.append('chain: issued by "%s", not the CA' %
+                        cert.get_issuer().CN)
+    try:
+        crypto.X509StoreContext(store,cert).verify_certificate()
+    except crypto.X509StoreContextError as e:
+        problems.append('chain: %s' % storeError(e))
+
+    if keytext is not None:
+        try:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM, keytext)
+            if crypto.dump_publickey(crypto.FILETYPE_ASN1,key) != \
+                    crypto.dump_publickey(crypto.FILETYPE_ASN1,
+                                          cert.get_pubkey()):
+                problems.append('key: doesn\'t match the cert')
+        except crypto.Error as e:
+            problems.append('key: unreadable: %s' % e)
+
+    if profile is None:
+        problems.append('extensions: profile not configured')
+    else:
+        have = extensionList([cert.get_extension(i) for i in
+                              range(cert.get_extension_count())])
+        want = extensionList(profile.build(cert,cacert))
+        if have != want:
+            haveNames = dict([(ext[0], ext) for ext in have])
+            wantNames = dict([(ext[0], ext) for ext in want])
+            differ = [name for name in sorted(set(haveNames) |
+                                              set(wantNames))
+                      if haveNames.get(name) != wantNames.get(name)]
+            problems.append('extensions: %s differ from profile "%s"' %
+                            (', '.join(differ) or 'order',profile.name))
+    return problems
+
+# a worker process's (store, CA cert, profiles), set by initWorker()
+workerState = [None]
+
+def initWorker(cacerttext,chaintext,profiles):
+    '''Build the CA's store once in each verifyIndex() worker'''
+    store, cacert = buildStore(cacerttext,chaintext)
+    workerState[0] = (store,cacert,profiles)
+
+def verifyWorker(item):
+    '''
+    Verify one (index key, cert text, key text, profile name) item
+    in a worker; return (index key, problems)
+    '''
+    store, cacert, profiles = workerState[0]
+    key, certtext, keytext, profile = item
+    return key, verifyCertText(store,cacert,profiles.get(profile),
+                               certtext,keytext)
+
+class SSLVerifier(object):
+    '''
+    Verifies a CA's certs:  signature and chain against the CA cert
+    and SSLCAChain, key/cert match, and extensions against the cert's
+    profile (see verifyCertText())
+
+    The CA's X509Store is built once, and again only when the CA
+    cert or chain change.  With 'cert_verify = true', binds verify
+    certs too (see SSLCert.validate()), and a cert that fails is
+    reissued; results are cached by cert uuid, serial and key uuid,
+    so a cert is only verified again once it or its key is replaced,
+    or the CA changes.  If the CA cert itself doesn't verify, e.g.
+    it expired, bind verification is skipped with an error, rather
+    than reissuing every cert.
+
+    verifyIndex() verifies every indexed cert in a pool of worker
+    processes, each with its own copy of the store, e.g. to audit a
+    CA after replacing its cert; 'zbca verify' runs it, and mark()
+    flags failed certs for reissue on their next bind.
+    '''
+    def __init__(self,ca):
+        self.ca = ca
+        self.enabled = str(ca.cert_verify).lower() == 'true'
+        self.lock = threading.Lock()
+        # (CA cert object, chain object, store, CA cert X509), see store()
+        self.cached = None
+        # { cert uuid : ((serial, key uuid), problems) }
+        self.results = {}
+        self.verified = 0
+        self.failed = 0
+
+    def store(self):
+        '''
+        Return the CA's (X509Store, CA cert X509), built when the CA
+        cert or chain objects change (see SSLCA.caObj())
+        '''
+        cacert = self.ca.caObj('SSLCACert')
+        chain = self.ca.caObj('SSLCAChain')
+        cached = self.cached
+        if cached is None or cached[0] is not cacert or \
+                cached[1] is not chain:
+            with self.lock:
+                cached = self.cached
+                if cached is None or cached[0] is not cacert or \
+                        cached[1] is not chain:
+                    try:
+                        store = buildStore(cacert.text,chain.text)
+                    except (SSLVerifyException, crypto.Error) as e:
+                        raise SSLVerifyException('CA "%s": %s' %
+                                                 (self.ca.name,e))
+                    cached = self.cached = (cacert,chain) + store
+                    self.results.clear()
+        return cached[2:]
+
+    def keyElt(self,elt):
+        '''Return the index element of a cert's key, or None'''
+        keyname = elt.get('key')
+        if keyname is None and \
+                elt.get('append_key','false').lower() == 'true':
+            keyname = elt.get('name')
+        if keyname is None:
+            return None
+        with self.ca.lock:
+            return self.ca.index.search('SSLKey',keyname,elt.get('host'))
+
+    def verify(self,obj):
+        '''
+        Verify an SSLCert object, or return the cached result; return
+        a list of problems, empty if it passes
+        '''
+        try:
+            store, cacert = self.store()
+        except SSLVerifyException as e:
+            logger.error('%s; not verifying certs' % e.args[0])
+            return []
+        keyelt = self.keyElt(obj.elt)
+        version = (obj.attrib('serial'),
+                   keyelt is not None and keyelt.get('uuid') or None)
+        cached = self.results.get(obj.attrib('uuid'))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with self.ca.perf.timer('verify'):
+            keytext = None
+            if keyelt is not None:
+                keytext = self.ca.textstore.read(keyelt)
+            problems = verifyCertText(
+                store,cacert,self.ca.extensions.get(obj.attrib('extensions')),
+                obj.text,keytext)
+        self.ca.perf.count('certs_verified')
+        with self.lock:
+            self.verified += 1
+            if problems:
+                self.failed += 1
+            self.results[obj.attrib('uuid')] = (version,problems)
+        return problems
+
+    def items(self):
+        '''
+        Generate (index key, cert text, key text, profile name) for
+        every indexed cert, reading the texts from the text store
+        '''
+        with self.ca.lock:
+            elts = list(self.ca.index.records('SSLCert'))
+        for elt in elts:
+            keyelt = self.keyElt(elt)
+            try:
+                certtext = self.ca.textstore.read(elt)
+                keytext = keyelt is not None and \
+                    self.ca.textstore.read(keyelt) or None
+            except (IOError, OSError, SSLTextStoreException) as e:
+                logger.warning('CA "%s": can\'t read cert "%s", host "%s": '
+                               '%s' % (self.ca.name,elt.get('name'),
+                                       elt.get('host'),e))
+                continue
+            yield (self.ca.index.eltKey(elt),certtext,keytext,
+                   elt.get('extensions'))
+
+    def verifyIndex(self,processes=0):
+        '''
+        Verify every indexed cert in 'processes' worker processes (0 =
+        one per CPU); return (number verified, list of (index key,
+        problems) of the certs that failed)
+        '''
+        cacert = self.ca.caObj('SSLCACert')
+        chain = self.ca.caObj('SSLCAChain')
+        try:
+            buildStore(cacert.text,chain.text)
+        except (SSLVerifyException, crypto.Error) as e:
+            raise SSLVerifyException('CA "%s": %s' % (self.ca.name,e))
+
+        start = time.time()
+        count = 0
+        failed = []
+        procs = multiprocessing.Pool(processes or None,initWorker,
+                                     (cacert.text,chain.text,
+                                      self.ca.extensions))
+        try:
+            for key, problems in procs.imap_unordered(verifyWorker,
+                                                      self.items(),64):
+                count += 1
+                if problems:
+                    failed.append((key,problems))
+        finally:
+            procs.terminate()
+            procs.join()
+        logger.info('CA "%s": verified %d certs in %.1fs, %d failed' %
+                    (self.ca.name,count,time.time() - start,len(failed)))
+        return count, failed
+
+    def mark(self,keys):
+        '''
+        Flag certs, by (ssltype,name,host) index key, as failing
+        verification, so they're reissued on their next bind; return
+        the number marked.  Run it while the Bcfg2 server is stopped.
+        '''
+        marked = 0
+        now = str(int(time.time()))
+        with self.ca.lock:
+            self.ca.index.defer()
+            try:
+                for key in keys:
+                    elt = self.ca.index.search(*key)
+                    if elt is not None:
+                        elt = copy.copy(elt)
+                        elt.set('verify_failed',now)
+                        self.ca.index.updateElt(elt)
+                        marked += 1
+            finally:
+                self.ca.index.commit()
+        return marked
+
+    def stats(self):
+        '''Return a dict of verifier statistics'''
+        with self.lock:
+            return {
+                'enabled'   : self.enabled,
+                'cached'    : len(self.results),
+                'verified'  : self.verified,
+                'failed'    : self.failed,
+                }
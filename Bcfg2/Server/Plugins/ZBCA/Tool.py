@@ -0,0 +1,584 @@
+'''
+The zbca command line tool:  offline maintenance of ZBCA certificate
+authorities, run on the Bcfg2 server host
+
+Usage:  zbca [-C bcfg2.conf] [-Q repository] [--ca name] <command> [args]
+'''
+import logging
+import optparse
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import xmlrpclib
+import ConfigParser
+from Bcfg2.Proxy import ComponentProxy, ProxyError
+from Bcfg2.Server.Plugin import PluginExecutionError
+from Bcfg2.Server.Plugins.ZBCA import ZBCA
+from SSLCA import SSLCA, SSLCAException
+from SSLRevocation import reasons
+from SSLOCSP import SSLOCSPResponder, SSLOCSPException
+from SSLIndexBackend import backends
+from SSLTextStore import stores
+from SSLImport import SSLImporter, SSLImportException, defaultMaps
+from SSLReport import SSLReport, SSLReportException
+from SSLVerify import SSLVerifyException
+
+logger = logging.getLogger(__name__)
+
+class ToolException(Exception):
+    pass
+
+class ZBCAToolPlugin(ZBCA):
+    '''
+    A ZBCA plugin object usable outside of a running Bcfg2 server:
+    it reads the Bcfg2 config file itself, has no core, and only
+    loads the CAs a command asks for
+    '''
+    def __init__(self,cfp,repository,configfile=None):
+        self.cfp = cfp
+        self.configfile = configfile
+        self.core = None
+        self.data = os.path.join(repository,self.name)
+        self.cas = {}
+        self.calock = threading.Lock()
+        self.loadStats = {}
+        self.canames = self.cfp.get(self.name.lower(),'cas').split(',')
+        try:
+            self.default_ca = self.cfp.get(self.name.lower(),'default_ca')
+        except ConfigParser.Error:
+            self.default_ca = self.canames[0]
+
+    def loadCA(self,caname):
+        '''Load a CA, without starting its background services'''
+        return SSLCA(caname,self)
+
+
+class ToolCommand(object):
+    '''
+    Base class for zbca tool commands; subclasses set the command
+    name, add their options in options() and do their work in run()
+    '''
+    name = None
+    usage = ''
+
+    def __init__(self,plugin):
+        self.plugin = plugin
+
+    def options(self,parser):
+        '''Add command-specific options to an OptionParser'''
+        pass
+
+    def run(self,options,args):
+        '''Run the command; return the exit status'''
+        raise NotImplementedError
+
+    def serverProxy(self,timeout):
+        '''
+        Return an XML-RPC proxy for the running Bcfg2 server,
+        connected the way bcfg2-admin xcmd does
+        '''
+        import Bcfg2.Options
+        optinfo = {
+            'configfile'  : Bcfg2.Options.CFILE,
+            'server'      : Bcfg2.Options.SERVER_LOCATION,
+            'user'        : Bcfg2.Options.CLIENT_USER,
+            'password'    : Bcfg2.Options.SERVER_PASSWORD,
+            'key'         : Bcfg2.Options.SERVER_KEY,
+            'certificate' : Bcfg2.Options.CLIENT_CERT,
+            'ca'          : Bcfg2.Options.CLIENT_CA,
+            }
+        argv = ['-C',self.plugin.configfile]
+        setup = Bcfg2.Options.OptionParser(optinfo,argv=argv,quiet=True)
+        setup.parse(argv)
+        return ComponentProxy(setup['server'],setup['user'],
+                              setup['password'],key=setup['key'],
+                              cert=setup['certificate'],ca=setup['ca'],
+                              timeout=timeout)
+
+
+class MigrateIndex(ToolCommand):
+    '''
+    Convert a CA's object index from one storage backend to another,
+    e.g. an existing index.xml to SQLite; afterwards set the CA's
+    'index_backend' option to the new backend
+    '''
+    name = 'migrate-index'
+    usage = '--to <backend> [--from <backend>] [--force]'
+
+    def options(self,parser):
+        parser.add_option('--from',dest='src',default=None,
+                          help='source backend (default: CA config)')
+        parser.add_option('--to',dest='dst',default=None,
+                          help='destination backend: %s' %
+                          ', '.join(sorted(backends.keys())))
+        parser.add_option('--force',action='store_true',default=False,
+                          help='overwrite existing destination data')
+
+    def run(self,options,args):
+        ca = self.plugin.getCAByName(options.ca)
+        src = options.src or ca.index_backend
+        if src not in backends or options.dst not in backends:
+            raise ToolException('source and destination must be one of: %s'
+                                % ', '.join(sorted(backends.keys())))
+        if src == options.dst:
+            raise ToolException('source and destination are both "%s"' % src)
+
+        dst = backends[options.dst](ca)
+        if dst.exists() and not options.force:
+            raise ToolException('CA "%s" already has a "%s" index; use '
+                                '--force to overwrite it' %
+                                (ca.name,options.dst))
+        index = backends[src](ca).read()
+        if index is None:
+            raise ToolException('CA "%s" has no "%s" index' % (ca.name,src))
+
+        records, state = index
+        dst.importIndex(records,state)
+        count = len(records)
+        print('CA "%s": copied %d index entries from "%s" to "%s"; set '
+              '"index_backend = %s" in [zbca:%s]' %
+              (ca.name,count,src,options.dst,options.dst,ca.name))
+        return 0
+
+
+class BackfillIndex(ToolCommand):
+    '''
+    Record notBefore, notAfter, serial and subject hash in the index
+    entries of certs issued before ZBCA kept them there
+    '''
+    name = 'backfill-index'
+
+    def run(self,options,args):
+        ca = self.plugin.getCAByName(options.ca)
+        print('CA "%s": updated %d cert index entries' %
+              (ca.name,ca.backfillCertInfo()))
+        return 0
+
+
+class ConvertStore(ToolCommand):
+    '''
+    Move a CA's key and cert PEM text from one text store to another,
+    e.g. from a PEM file per object to packs, and delete the old
+    copies; afterwards set the CA's 'text_store' option to the new
+    store.  Run it while the Bcfg2 server is stopped.
+    '''
+    name = 'convert-store'
+    usage = '--to <store> [--from <store>] [--keep]'
+
+    def options(self,parser):
+        parser.add_option('--from',dest='src',default=None,
+                          help='source store (default: CA config)')
+        parser.add_option('--to',dest='dst',default=None,
+                          help='destination store: %s' %
+                          ', '.join(sorted(stores.keys())))
+        parser.add_option('--keep',action='store_true',default=False,
+                          help='keep the source store\'s copies')
+
+    def run(self,options,args):
+        ca = self.plugin.getCAByName(options.ca)
+        src = options.src or ca.text_store
+        if src not in stores or options.dst not in stores:
+            raise ToolException('source and destination must be one of: %s'
+                                % ', '.join(sorted(stores.keys())))
+        if src == options.dst:
+            raise ToolException('source and destination are both "%s"' % src)
+
+        copied, missing = stores[options.dst](ca).importText(
+            stores[src](ca),remove=not options.keep)
+        print('CA "%s": moved the text of %d objects from "%s" to "%s", %d '
+              'missing; set "text_store = %s" in [zbca:%s]' %
+              (ca.name,copied,src,options.dst,missing,options.dst,ca.name))
+        return 0
+
+
+class CompactStore(ToolCommand):
+    '''
+    Reclaim the space of superseded text in a CA's packs now, rather
+    than when it reaches 'text_pack_garbage'; run it while the Bcfg2
+    server is stopped
+    '''
+    name = 'compact-store'
+
+    def run(self,options,args):
+        ca = self.plugin.getCAByName(options.ca)
+        if ca.text_store != 'pack':
+            raise ToolException('CA "%s" doesn\'t use packs' % ca.name)
+        print('CA "%s": reclaimed %d bytes' %
+              (ca.name,ca.textstore.compact()))
+        return 0
+
+
+class Import(ToolCommand):
+    '''
+    Import keys and certs issued outside ZBCA, e.g. by scripts or the
+    old SSLCA plugin, from a directory tree into a CA; see
+    SSLImport.SSLImporter.  Run it while the Bcfg2 server is stopped.
+    '''
+    name = 'import'
+    usage = '--dir <path> [--map <regex> ...] [--batch N] [--dry-run]'
+
+    def options(self,parser):
+        parser.add_option('--dir',dest='dir',default=None,
+                          help='directory tree to import')
+        parser.add_option('--map',dest='maps',action='append',default=[],
+                          help='regular expression matching file paths, '
+                          'relative to --dir, with "name" and "host" '
+                          'groups; may be repeated [old SSLCA plugin '
+                          'layout: %s]' % defaultMaps[0])
+        parser.add_option('--batch',dest='batch',type='int',default=500,
+                          help='write the index every N imported certs '
+                          '[%default]')
+        parser.add_option('--dry-run',dest='dryrun',action='store_true',
+                          default=False,help='match and report, but '
+                          'import nothing')
+
+    def run(self,options,args):
+        if not options.dir or not os.path.isdir(options.dir):
+            raise ToolException('--dir must be a directory')
+        ca = self.plugin.getCAByName(options.ca)
+        try:
+            importer = SSLImporter(ca,options.maps,options.batch,
+                                   options.dryrun)
+        except (SSLImportException, re.error) as e:
+            raise ToolException('bad --map: %s' % e)
+        counts = importer.run(options.dir)
+        print('CA "%s": %s%d certs imported from %d files; %d keys, %d '
+              'certs found; %d certs from other CAs, %d without a key, '
+              '%d unmapped, %d already indexed, %d unreadable' %
+              (ca.name,options.dryrun and '(dry run) ' or '',
+               counts['imported'],counts['files'],counts['keys'],
+               counts['certs'],counts['foreign'],counts['unmatched_certs'],
+               counts['unmapped'],counts['exists'],counts['unreadable']))
+        return 0
+
+
+class Report(ToolCommand):
+    '''
+    Write a CA's cert inventory, or a histogram of cert expiry by
+    week, as CSV or JSON; built from the index, without reading the
+    certs (see SSLReport.SSLReport)
+    '''
+    name = 'report'
+    usage = '[--format csv|json] [--histogram] [--within DAYS] ' \
+        '[--output FILE]'
+
+    def options(self,parser):
+        parser.add_option('--format',dest='format',default='csv',
+                          type='choice',choices=['csv','json'],
+                          help='output format, csv or json [%default]')
+        parser.add_option('--histogram',dest='histogram',
+                          action='store_true',default=False,
+                          help='write the weekly expiry histogram instead '
+                          'of the certs (csv; json has both)')
+        parser.add_option('--within',dest='within',type='int',default=None,
+                          help='only certs expiring within DAYS days')
+        parser.add_option('--output',dest='output',default=None,
+                          help='output file [stdout]')
+
+    def run(self,options,args):
+        report = SSLReport(self.plugin.getCAByName(options.ca),
+                           within=options.within)
+        try:
+            report.rows()
+        except SSLReportException as e:
+            raise ToolException(e.args[0])
+        if options.output is None:
+            f = sys.stdout
+        else:
+            f = open(options.output,'w')
+        try:
+            if options.format == 'json':
+                report.writeJSON(f)
+            else:
+                report.writeCSV(f,options.histogram)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+        return 0
+
+
+class Verify(ToolCommand):
+    '''
+    Verify every cert in a CA's index against the CA cert and chain:
+    signature, chain, key/cert match and extensions profile (see
+    SSLVerify.SSLVerifier), in a pool of worker processes; the certs
+    that fail are listed, and with --mark, flagged in the index to be
+    reissued on their clients' next run, which is only safe while the
+    Bcfg2 server is stopped
+    '''
+    name = 'verify'
+    usage = '[--processes N] [--mark]'
+
+    def options(self,parser):
+        parser.add_option('--processes',dest='processes',type='int',
+                          default=0,help='verification processes '
+                          '(default: one per CPU)')
+        parser.add_option('--mark',action='store_true',default=False,
+                          help='flag failed certs for reissue')
+
+    def run(self,options,args):
+        ca = self.plugin.getCAByName(options.ca)
+        try:
+            count, failed = ca.verifier.verifyIndex(options.processes)
+        except SSLVerifyException as e:
+            raise ToolException(e.args[0])
+        for key, problems in sorted(failed):
+            print('%s %s: %s' % (key[2],key[1],'; '.join(problems)))
+        marked = 0
+        if options.mark and failed:
+            marked = ca.verifier.mark([key for key, problems in failed])
+        print('CA "%s": verified %d certs, %d failed%s' %
+              (ca.name,count,len(failed),
+               options.mark and ', %d marked for reissue' % marked or ''))
+        return failed and 2 or 0
+
+
+class Preissue(ToolCommand):
+    '''
+    Have the running Bcfg2 server issue the keys or certs for a spec
+    path for every client in a metadata group, e.g. before a rollout;
+    this needs the server's client metadata, so it's done through the
+    ZBCA.preissue XML-RPC method
+    '''
+    name = 'preissue'
+    usage = '--group <group> --path <path> [--path <path> ...] ' \
+        '[--processes N]'
+
+    def options(self,parser):
+        parser.add_option('--group',dest='group',default=None,
+                          help='metadata group')
+        parser.add_option('--path',dest='paths',action='append',default=[],
+                          help='Path entry name; may be repeated')
+        parser.add_option('--processes',dest='processes',type='int',
+                          default=0,help='key generation processes '
+                          '(default: one per CPU on the server)')
+        parser.add_option('--timeout',dest='timeout',type='float',
+                          default=3600,help='XML-RPC timeout [%default]')
+
+    def run(self,options,args):
+        if not options.group or not options.paths:
+            raise ToolException('--group and --path are required')
+        proxy = self.serverProxy(options.timeout)
+        for path in options.paths:
+            try:
+                result = proxy.ZBCA.preissue(options.group,path,
+                                             options.processes)
+            except (ProxyError, xmlrpclib.Fault) as e:
+                raise ToolException('preissue "%s" failed: %s' % (path,e))
+            print('%s: %d objects, %d issued, %d new keys; %d clients '
+                  'without this path' %
+                  (path,result.get('objects',0),result.get('issued',0),
+                   result.get('keys',0),result.get('skipped',0)))
+        return 0
+
+
+class Stats(ToolCommand):
+    '''
+    Show the running Bcfg2 server's bind path statistics per CA:
+    counters, and each stage's timings, through the ZBCA.stats
+    XML-RPC method; with --profile N, have the server capture a
+    cProfile profile of its next N binds instead, through
+    ZBCA.profile
+    '''
+    name = 'stats'
+    usage = '[--profile N [--output <file>]]'
+
+    def options(self,parser):
+        parser.add_option('--profile',dest='profile',type='int',default=0,
+                          help='profile the next N binds')
+        parser.add_option('--output',dest='output',default='',
+                          help='profile file on the server [a temp file]')
+        parser.add_option('--timeout',dest='timeout',type='float',
+                          default=60,help='XML-RPC timeout [%default]')
+
+    def run(self,options,args):
+        proxy = self.serverProxy(options.timeout)
+        try:
+            if options.profile:
+                path = proxy.ZBCA.profile(options.profile,options.output)
+                print('Profiling the next %d binds into %s' %
+                      (options.profile,path))
+                return 0
+            stats = proxy.ZBCA.stats()
+        except (ProxyError, xmlrpclib.Fault) as e:
+            raise ToolException('stats failed: %s' % e)
+
+        for caname, castats in sorted(stats['cas'].items()):
+            perf = castats['perf']
+            print('CA "%s":' % caname)
+            print('  %s' % ', '.join(['%s %d' % item for item
+                                      in sorted(perf['counters'].items())]))
+            print('  %-10s %8s %10s %10s %10s %10s' %
+                  ('stage','count','mean ms','p50 ms','p99 ms','max ms'))
+            for stage, t in sorted(perf['timings'].items()):
+                print('  %-10s %8d %10.2f %10.2f %10.2f %10.2f' %
+                      (stage,t['count'],t['mean']*1000,t['p50']*1000,
+                       t['p99']*1000,t['max']*1000))
+        if stats['unloaded']:
+            print('Not loaded: %s' % ', '.join(stats['unloaded']))
+        if stats['profile']['remaining']:
+            print('Profiling %d more binds into %s' %
+                  (stats['profile']['remaining'],stats['profile']['file']))
+        return 0
+
+
+class Revoke(ToolCommand):
+    '''
+    Revoke a cert, by client and Path entry or by serial number, and
+    update the CA's CRL.  This goes through the running Bcfg2 server's
+    ZBCA.revoke XML-RPC method, which can look up the client's
+    entry; with --offline, a cert is revoked by editing the CA's
+    index directly, which is only safe while the server is stopped.
+    '''
+    name = 'revoke'
+    usage = '--host <client> --path <path> | --serial N ' \
+        '[--reason <reason>] [--rekey] [--offline]'
+
+    def options(self,parser):
+        parser.add_option('--host',dest='host',default=None,
+                          help='client name')
+        parser.add_option('--path',dest='path',default=None,
+                          help='Path entry name of the cert')
+        parser.add_option('--name',dest='name',default=None,
+                          help='cert name, if it differs from --path '
+                          '(--offline only)')
+        parser.add_option('--serial',dest='serial',type='int',default=None,
+                          help='cert serial number')
+        parser.add_option('--reason',dest='reason',default=None,
+                          help='revocation reason: %s' % ', '.join(reasons))
+        parser.add_option('--rekey',action='store_true',default=False,
+                          help='replace the key along with the cert')
+        parser.add_option('--offline',action='store_true',default=False,
+                          help='edit the CA index directly')
+        parser.add_option('--timeout',dest='timeout',type='float',
+                          default=300,help='XML-RPC timeout [%default]')
+
+    def run(self,options,args):
+        if options.serial is None and \
+                not (options.host and options.path):
+            raise ToolException('--host and --path, or --serial, are '
+                                'required')
+        if options.offline:
+            ca = self.plugin.getCAByName(options.ca)
+            try:
+                if options.serial is not None:
+                    serial = ca.revoke(serial=options.serial,
+                                       reason=options.reason)
+                else:
+                    serial = ca.revoke(name=options.name or options.path,
+                                       host=options.host,
+                                       reason=options.reason,
+                                       rekey=options.rekey)
+            except SSLCAException as e:
+                raise ToolException(e.args[0])
+        else:
+            proxy = self.serverProxy(options.timeout)
+            try:
+                serial = proxy.ZBCA.revoke(options.host or '',
+                                           options.path or '',
+                                           options.serial or 0,
+                                           options.reason or '',
+                                           options.rekey,
+                                           options.ca or '')
+            except (ProxyError, xmlrpclib.Fault) as e:
+                raise ToolException('revoke failed: %s' % e)
+        print('Revoked serial %s' % serial)
+        return 0
+
+
+class OCSP(ToolCommand):
+    '''
+    Run a standalone OCSP responder for a CA, e.g. on a host other
+    than the Bcfg2 server, sharing its repository; it reloads the
+    CA's index every 'ocsp_refresh_minutes' minutes to pick up new
+    certs and revocations
+    '''
+    name = 'ocsp'
+    usage = '[--listen <host:port>]'
+
+    def options(self,parser):
+        parser.add_option('--listen',dest='listen',default=None,
+                          help='address to listen on [CA ocsp_listen]')
+
+    def run(self,options,args):
+        ca = self.plugin.getCAByName(options.ca)
+        if not (options.listen or ca.ocsp_listen):
+            raise ToolException('CA "%s" has no ocsp_listen address; use '
+                                '--listen' % ca.name)
+        responder = SSLOCSPResponder(ca,reload=True)
+        try:
+            responder.start(options.listen)
+        except (SSLOCSPException, socket.error) as e:
+            raise ToolException('CA "%s": %s' % (ca.name,e))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        responder.shutdown()
+        return 0
+
+
+# map command names to ToolCommand classes
+commands = dict([(c.name, c) for c in (MigrateIndex,
+                                       BackfillIndex,
+                                       ConvertStore,
+                                       CompactStore,
+                                       Import,
+                                       Report,
+                                       Verify,
+                                       Preissue,
+                                       Stats,
+                                       Revoke,
+                                       OCSP,
+                                       )])
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = optparse.OptionParser(
+        usage='%%prog [options] <command> [command options]\n\n'
+        'Commands:\n%s' % '\n'.join(['  %s %s' % (c.name,c.usage)
+                                     for c in sorted(commands.values(),
+                                                     key=lambda c: c.name)]))
+    parser.add_option('-C',dest='configfile',default='/etc/bcfg2.conf',
+                      help='Bcfg2 config file [%default]')
+    parser.add_option('-Q',dest='repository',default=None,
+                      help='Bcfg2 repository [from config file]')
+    parser.add_option('--ca',dest='ca',default=None,
+                      help='CA name [default_ca from config file]')
+    parser.add_option('-d',dest='debug',action='store_true',default=False,
+                      help='debug logging')
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in commands:
+        parser.error('a command is required')
+
+    logging.basicConfig(level=options.debug and logging.DEBUG
+                        or logging.INFO)
+    cfp = ConfigParser.ConfigParser()
+    # keep option case, like the Bcfg2 server does
+    cfp.optionxform = str
+    if not cfp.read(options.configfile):
+        parser.error('could not read config file %s' % options.configfile)
+    if options.repository is None:
+        try:
+            options.repository = cfp.get('server','repository')
+        except ConfigParser.Error:
+            options.repository = '/var/lib/bcfg2'
+
+    command = commands[args[0]](ZBCAToolPlugin(cfp,options.repository,
+                                                   options.configfile))
+    cmdparser = optparse.OptionParser(
+        usage='%%prog [options] %s %s' % (command.name,command.usage))
+    command.options(cmdparser)
+    cmdoptions, cmdargs = cmdparser.parse_args(args[1:])
+    cmdoptions.ca = options.ca
+    try:
+        return command.run(cmdoptions,cmdargs)
+    except (ToolException, PluginExecutionError) as e:
+        logger.error(e.args[0])
+        return 1
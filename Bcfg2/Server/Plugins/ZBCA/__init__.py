@@ -1,10 +1,48 @@
 from Bcfg2.Server import Plugin
-from Bcfg2.Server.Plugin import PluginInitError
+from Bcfg2.Server.Plugin import PluginInitError, PluginExecutionError
+from lxml import etree
 from SSLCA import SSLCA
+from SSLBindCache import SSLBindCache
+from SSLStats import SSLProfiler, SSLStatsException
 import logging
+import os
+import tempfile
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+def residentKB():
+    '''
+    Return the process's resident memory size in kB, or 0 where
+    /proc isn't available
+    '''
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def xmlrpcValue(value):
+    '''
+    Return a copy of a stats value that xmlrpclib can marshal:  ints
+    beyond XML-RPC's 32 bits, e.g. byte counters, become floats, and
+    dict keys become strings
+    '''
+    if isinstance(value,dict):
+        return dict([(str(key), xmlrpcValue(val))
+                     for key, val in value.items()])
+    if isinstance(value,(list,tuple)):
+        return [xmlrpcValue(val) for val in value]
+    if isinstance(value,(int,long)) and not isinstance(value,bool) and \
+            not -2**31 <= value < 2**31:
+        return float(value)
+    return value
+
 class ZBCA(Plugin.PrioDir):
     """
     The ZBCA generator handles the creation and
@@ -13,20 +51,24 @@ class ZBCA(Plugin.PrioDir):
     name = 'ZBCA'
     __author__ = 'John Morris <jman@zultron.com>'
     experimental = True
+    __rmi__ = Plugin.PrioDir.__rmi__ + ['stats', 'preissue',
+                                           'revoke', 'profile']
+
+    # { 'zbca:<ca>-<subsect>-' : [section, ...] }; see config()
+    sectionIndex = None
 
     def __init__(self, core, datastore):
         Plugin.PrioDir.__init__(self, core, datastore)
         self.cfp = self.core.setup.cfp
-        self.cas = {}
         self.default_ca = None
 
-        # set up dict of SSLCA objects from config
-        if True:
-            for caname in self.cfp.get(
-                self.name.lower(), "cas").split(','):
-                self.cas[caname] = SSLCA(caname,self)
+        # CAs are loaded on first use by getCAByName(), since each
+        # reads its whole index; self.cas only holds loaded CAs
+        self.cas = {}
+        self.calock = threading.Lock()
+        self.loadStats = {}
         try:
-            pass
+            self.canames = self.cfp.get(self.name.lower(),"cas").split(',')
         except Exception as e:
             logger.error('ZBCA plugin exception searching for "cas" '
                          'option in config')
@@ -39,7 +81,29 @@ class ZBCA(Plugin.PrioDir):
         except:
             logger.warn('Config file ought to specify "default_ca" in the '
                         '[global] section; picking default CA at random')
-            self.default_ca = self.cas.keys()[0]
+            self.default_ca = self.canames[0]
+
+        # optionally load the CAs in the background now, rather than
+        # when the first client needs them
+        try:
+            warmup = self.cfp.getboolean(self.name.lower(),'warmup')
+        except:
+            warmup = False
+        if warmup:
+            thread = threading.Thread(target=self.warmup,
+                                      name='ZBCA CA warmup')
+            thread.daemon = True
+            thread.start()
+
+        # cache of bound entries; 0 disables
+        try:
+            cachesize = self.cfp.getint(self.name.lower(),'bind_cache_size')
+        except:
+            cachesize = 10000
+        self.bindcache = SSLBindCache(cachesize)
+
+        # cProfile capture of binds on request; see profile()
+        self.profiler = SSLProfiler()
 
     def config(self,caname,subsect=None,isprefix=False):
         '''
@@ -47,6 +111,10 @@ class ZBCA(Plugin.PrioDir):
         If subsect==None, return [zbca:caname]
         Elif not isprefix, return [zbca:caname-subsect]
         Else return { foo : [zbca:caname-subsect-foo], ... }
+
+        Prefix queries are answered from an index of section names by
+        every prefix ending in '-', built on first use, rather than
+        by scanning all sections each time
         '''
         basename = ':'.join((self.name.lower(),caname))
         if not subsect:
@@ -54,19 +122,182 @@ class ZBCA(Plugin.PrioDir):
         elif not isprefix:
             return self.cfp.items('-'.join((basename,subsect)))
         else:
+            if self.sectionIndex is None:
+                self.sectionIndex = {}
+                for section in self.cfp.sections():
+                    pos = section.find('-')
+                    while pos != -1:
+                        self.sectionIndex.setdefault(
+                            section[:pos + 1],[]).append(section)
+                        pos = section.find('-',pos + 1)
             prefix = '-'.join((basename,subsect,''))
-            sections = [k for k in self.cfp.sections()
-                        if k.startswith(prefix)]
+            sections = self.sectionIndex.get(prefix,[])
             sectiondict = [(s[len(prefix):], self.cfp.items(s))
                            for s in sections]
             return sectiondict
 
+    def loadCA(self,caname):
+        '''
+        Load a CA and start its background services
+        '''
+        ca = SSLCA(caname,self)
+        ca.start()
+        return ca
+
+    def getCAByName(self,caname=None):
+        '''
+        Return the named CA, or the default CA, loading it on first
+        use; the load time and resident memory growth are logged at
+        debug level and kept for stats()
+        '''
+        caname = caname or self.default_ca
+        ca = self.cas.get(caname)
+        if ca is not None:
+            return ca
+        if caname not in self.canames:
+            raise PluginExecutionError('Unknown CA "%s"' % caname)
+        with self.calock:
+            # another thread may have loaded it while we waited
+            if caname not in self.cas:
+                start, rss = time.time(), residentKB()
+                ca = self.loadCA(caname)
+                self.loadStats[caname] = {
+                    'seconds' : time.time() - start,
+                    'rss_kb'  : residentKB() - rss,
+                    }
+                logger.debug('ZBCA: loaded CA "%s" in %.3fs; resident '
+                             'memory %+d kB' %
+                             (caname,self.loadStats[caname]['seconds'],
+                              self.loadStats[caname]['rss_kb']))
+                self.cas[caname] = ca
+            return self.cas[caname]
+
+    def warmup(self):
+        '''
+        Warmup thread:  load every configured CA
+        '''
+        for caname in self.canames:
+            try:
+                self.getCAByName(caname)
+            except Exception as e:
+                logger.error('ZBCA: failed to load CA "%s": %s' %
+                             (caname,e))
+
+    def shutdown(self):
+        '''
+        Stop the loaded CAs' background services
+        '''
+        with self.calock:
+            for ca in self.cas.values():
+                ca.shutdown()
+        Plugin.PrioDir.shutdown(self)
+
+    def stats(self):
+        '''
+        Return a dict of statistics:  bind cache and per loaded CA,
+        e.g. key pool hits and misses, bind stage timings and the
+        CA's load time and memory; callable from bcfg2-info or over
+        XML-RPC as ZBCA.stats, so large counters are returned as
+        floats (see xmlrpcValue())
+        '''
+        cas = {}
+        for caname, ca in self.cas.items():
+            cas[caname] = ca.stats()
+            cas[caname]['load'] = self.loadStats.get(caname)
+        return xmlrpcValue({
+            'bindcache' : self.bindcache.stats(),
+            'cas'       : cas,
+            'unloaded'  : [caname for caname in self.canames
+                           if caname not in self.cas],
+            'profile'   : self.profiler.stats(),
+            })
+
+    def profile(self, binds, path=''):
+        '''
+        Capture a cProfile profile of the next 'binds' BindEntry
+        calls into file 'path' (default: a new file in the temp
+        directory), for reading with the pstats module.  Callable
+        over XML-RPC as ZBCA.profile, e.g. by 'zbca stats --profile';
+        return the file name
+        '''
+        if not path:
+            fd, path = tempfile.mkstemp(prefix='zbca-',suffix='.pstats')
+            os.close(fd)
+        try:
+            self.profiler.start(int(binds),path)
+        except SSLStatsException as e:
+            raise PluginExecutionError(str(e))
+        return path
+
+    def preissue(self, group, path, processes=0):
+        '''
+        Issue the key or cert bound to Path 'path' for every client
+        in metadata group 'group' ahead of their first runs, e.g.
+        during a rollout; keys are generated in parallel in
+        'processes' processes (0 = one per CPU).  Callable over
+        XML-RPC as ZBCA.preissue, e.g. by 'zbca preissue'; return a
+        dict of counts
+        '''
+        batches = {}
+        skipped = 0
+        for host in self.core.metadata.get_client_names_by_groups([group]):
+            metadata = self.core.build_metadata(host)
+            try:
+                attrs = self.get_attrs(etree.Element('Path',name=path),
+                                       metadata)
+            except PluginExecutionError:
+                # no spec entry for this client
+                skipped += 1
+                continue
+            attrs['host'] = metadata.hostname
+            batches.setdefault(self.getCA(attrs),[]).append(
+                (attrs,metadata))
+
+        result = {'skipped' : skipped}
+        for ca, items in batches.items():
+            for k, v in ca.preissue(items,int(processes)).items():
+                result[k] = result.get(k,0) + v
+        logger.info('Pre-issued "%s" for group "%s": %s' %
+                    (path,group,result))
+        return result
+
+    def revoke(self, host='', path='', serial=0, reason='', rekey=False,
+               ca=''):
+        '''
+        Revoke the cert bound to Path 'path' for client 'host', or
+        the cert with serial number 'serial' from CA 'ca' (default:
+        the default CA), and update the CA's CRL.  With 'rekey', the
+        cert's key is replaced along with the cert on the client's
+        next run.  Callable over XML-RPC as ZBCA.revoke, e.g. by
+        'zbca revoke'; return the revoked serial
+        '''
+        reason = reason or None
+        if path:
+            metadata = self.core.build_metadata(host)
+            try:
+                attrs = self.get_attrs(etree.Element('Path',name=path),
+                                       metadata)
+            except PluginExecutionError:
+                raise PluginExecutionError('Client %s has no ZBCA entry '
+                                           'for %s' % (host,path))
+            if attrs['type'] != 'SSLCert':
+                raise PluginExecutionError('%s is not a cert' % path)
+            return self.getCA(attrs).revoke(name=attrs['name'],
+                                            host=metadata.hostname,
+                                            reason=reason,rekey=rekey)
+        ca = self.getCAByName(ca)
+        return ca.revoke(serial=int(serial),reason=reason)
+
     def HandleEvent(self, event=None):
         '''
         Let the PrioDir HandleEvent function handle everything but the 
-        'CA' directory
+        'CA' directory; changes there invalidate the CAs' cached CA
+        key, cert and chain
         '''
         if event.filename == 'CA':
+            # CAs not loaded yet will read the files when they are
+            for ca in self.cas.values():
+                ca.invalidateCACache()
             return
 
         Plugin.PrioDir.HandleEvent(self, event)
@@ -75,7 +306,7 @@ class ZBCA(Plugin.PrioDir):
         '''
         Convenience function returns CA object specified in attrs, or default
         '''
-        return self.cas[attrs.get('ca',self.default_ca)]
+        return self.getCAByName(attrs.get('ca'))
 
     def BindEntry(self, entry, metadata):
         '''
@@ -84,7 +315,17 @@ class ZBCA(Plugin.PrioDir):
         attrs = self.get_attrs(entry,metadata)
         attrs['host'] = metadata.hostname
 
-        # retrieve CA and SSL objects and bind the entry
         ca = self.getCA(attrs)
-        obj = ca.initSSLObj(attrs,metadata)
-        obj.bind(entry)
+        ca.perf.count('binds')
+        with self.profiler.capture():
+            with ca.perf.timer('bind'):
+                # serve unchanged entries from the bind cache
+                key = (ca.name,attrs['type'],attrs['name'],attrs['host'],
+                       attrs.get('format'),attrs.get('passphrase'))
+                if self.bindcache.bind(key,entry,self.cas):
+                    return
+
+                # retrieve CA and SSL objects and bind the entry
+                obj = ca.initSSLObj(attrs,metadata)
+                obj.bind(entry,attrs.get('format'),attrs.get('passphrase'))
+                self.bindcache.add(key,entry,obj)
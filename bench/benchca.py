@@ -0,0 +1,101 @@
+'''
+Throwaway CA for the benchmarks:  a self-signed CA in a temporary
+Bcfg2 repository, loaded through the zbca tool's plugin class (so
+Bcfg2 must be importable)
+'''
+import os
+import shutil
+import tempfile
+import ConfigParser
+from StringIO import StringIO
+from OpenSSL import crypto
+from Bcfg2.Server.Plugins.ZBCA.Tool import ZBCAToolPlugin
+
+CONFIG = '''
+[zbca]
+cas = bench
+default_ca = bench
+
+[zbca:bench]
+key_default_bits = %(bits)s
+cert_default_md = sha256
+cert_default_days = 365
+cert_replace_days = 30
+cert_default_extensions = server
+dn_fields = C,ST,L,O,OU,CN
+%(extra)s
+
+[zbca:bench-dn-defaults]
+C = US
+ST = Texas
+L = Austin
+O = Example
+OU = Bench
+
+[zbca:bench-extensions-server]
+basicConstraints = CA:FALSE,pathlen:0;critical
+keyUsage = nonRepudiation,digitalSignature,keyEncipherment
+extendedKeyUsage = serverAuth,clientAuth
+subjectKeyIdentifier = hash;subject=cert
+authorityKeyIdentifier = keyid,issuer;issuer=ca
+'''
+
+class Metadata(object):
+    '''Just enough client metadata for SSLCA.initSSLObj()'''
+    def __init__(self,hostname,groups=()):
+        self.hostname = hostname
+        self.groups = set(groups)
+
+def makeCAFiles(path,bits=2048):
+    '''Write a self-signed CA key, cert and chain to path'''
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, bits)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = 'ZBCA Bench CA'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3650 * 24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([
+        crypto.X509Extension('basicConstraints', True, 'CA:TRUE'),
+        crypto.X509Extension('subjectKeyIdentifier', False, 'hash',
+                             subject=cert)])
+    cert.sign(key, 'sha256')
+    certtext = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+    for ssltype, text in (
+        ('SSLCAKey', crypto.dump_privatekey(crypto.FILETYPE_PEM, key)),
+        ('SSLCACert', certtext),
+        ('SSLCAChain', certtext)):
+        f = open('%s/%s.pem' % (path,ssltype),'w')
+        f.write(text)
+        f.close()
+
+class BenchCA(object):
+    '''
+    A temporary repository with one CA, 'bench'; 'extra' is added
+    to the [zbca:bench] config section.  Call cleanup() when done.
+    '''
+    def __init__(self,extra='',bits=2048,start=True):
+        self.repository = tempfile.mkdtemp(prefix='zbca-bench-')
+        basepath = '%s/ZBCA/CA/bench' % self.repository
+        for d in ('SSLCA','SSLKey','SSLCert'):
+            os.makedirs('%s/%s' % (basepath,d))
+        makeCAFiles('%s/SSLCA' % basepath,bits)
+
+        self.cfp = ConfigParser.ConfigParser()
+        self.cfp.optionxform = str
+        self.cfp.readfp(StringIO(CONFIG % dict(bits=bits,extra=extra)))
+        self.plugin = ZBCAToolPlugin(self.cfp,self.repository)
+        self.ca = self.plugin.getCAByName()
+        if start:
+            self.ca.start()
+
+    def reload(self):
+        '''Load the CA again from disk, e.g. to check what was saved'''
+        return ZBCAToolPlugin(self.cfp,self.repository).getCAByName()
+
+    def cleanup(self):
+        self.ca.shutdown()
+        shutil.rmtree(self.repository)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+'''
+Benchmark ZBCA.BindEntry end to end on a synthetic fleet:  a
+throwaway bench CA, and a key, a cert, a cert with its key appended
+and the CA chain Path entry bound for every host
+
+Scenarios, run in order on the same CA for each fleet size:
+
+- issue:  a fresh CA; every key and cert is generated and signed
+- cold:   a newly loaded plugin, so the bind cache is empty and every
+          entry is read from the index and PEM files and validated
+- warm:   the same plugin again; entries come from the bind cache
+- renew:  a newly loaded plugin with cert_replace_days past the
+          certs' lifetime, so every cert is signed again (keys kept)
+
+Each fleet size runs in its own process, so the peak resident memory
+reported is that size's; it's the peak so far, so it only grows over
+the scenarios.  The bind cache holds the whole fleet unless -c is
+given.  Keys are 512 bits by default to keep 100k-host runs to
+minutes; use -b to weigh in key generation at production sizes.
+
+Usage:  bind_fleet.py [-b bits] [-i index_backend] [-t text_store]
+        [-c cache_size] [--scenario name ...] [--stages] [hosts ...]
+'''
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA, Metadata
+from Bcfg2.Server.Plugins.ZBCA import ZBCA
+from Bcfg2.Server.Plugins.ZBCA.Tool import ZBCAToolPlugin
+from Bcfg2.Server.Plugins.ZBCA.SSLBindCache import SSLBindCache
+from Bcfg2.Server.Plugins.ZBCA.SSLStats import SSLStats, SSLProfiler
+
+SCENARIOS = ('issue', 'cold', 'warm', 'renew')
+
+# the spec:  { Path name : attributes }
+SPECS = {
+    '/etc/pki/tls/private/localhost.key' : {
+        'type' : 'SSLKey'},
+    '/etc/pki/tls/certs/localhost.crt' : {
+        'type' : 'SSLCert', 'key' : '/etc/pki/tls/private/localhost.key'},
+    '/etc/pki/tls/private/combined.pem' : {
+        'type' : 'SSLCert', 'append_key' : 'true'},
+    '/etc/pki/tls/certs/cacert.crt' : {
+        'type' : 'SSLCAChain'},
+    }
+
+class BindPlugin(ZBCAToolPlugin):
+    '''
+    The zbca tool's plugin with what BindEntry needs:  a bind cache,
+    the profiler, started CAs, and the spec above in place of the
+    PrioDir's spec files
+    '''
+    def __init__(self,cfp,repository,cachesize):
+        ZBCAToolPlugin.__init__(self,cfp,repository)
+        self.bindcache = SSLBindCache(cachesize)
+        self.profiler = SSLProfiler()
+
+    loadCA = ZBCA.loadCA
+
+    def get_attrs(self,entry,metadata):
+        return dict(SPECS[entry.get('name')],name=entry.get('name'))
+
+    def shutdown(self):
+        # no PrioDir state to shut down
+        for ca in self.cas.values():
+            ca.shutdown()
+
+def percentile(latencies,fraction):
+    return latencies[int(fraction * (len(latencies) - 1))]
+
+def run(plugin,hosts):
+    '''Bind every spec for every host; return the bind latencies'''
+    latencies = []
+    for host in hosts:
+        metadata = Metadata(host)
+        for path in sorted(SPECS):
+            entry = etree.Element('Path',name=path)
+            start = time.time()
+            plugin.BindEntry(entry,metadata)
+            latencies.append(time.time() - start)
+    return latencies
+
+def report(scenario,latencies,elapsed,plugin,stages):
+    latencies.sort()
+    print('  %-6s %8d binds %8.1fs %9.0f binds/s  p50 %7.2f ms  '
+          'p99 %7.2f ms  peak RSS %5d MB' %
+          (scenario,len(latencies),elapsed,len(latencies) / elapsed,
+           percentile(latencies,0.5) * 1000,
+           percentile(latencies,0.99) * 1000,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+    if stages:
+        perf = plugin.getCAByName().perf.stats()
+        for stage, t in sorted(perf['timings'].items()):
+            print('         %-8s %8d  mean %7.2f ms  p99 %7.2f ms' %
+                  (stage,t['count'],t['mean'] * 1000,t['p99'] * 1000))
+    sys.stdout.flush()
+
+def fleet(options,size):
+    '''Run the scenarios on a fleet of 'size' hosts'''
+    print('%d hosts:' % size)
+    sys.stdout.flush()
+    bench = BenchCA('index_backend = %s\ntext_store = %s' %
+                    (options.backend,options.store),
+                    bits=options.bits,start=False)
+    cachesize = options.cachesize
+    if cachesize is None:
+        cachesize = size * len(SPECS)
+    hosts = ['host%06d.example.com' % i for i in range(size)]
+    plugin = None
+    try:
+        for scenario in SCENARIOS:
+            if scenario == 'renew':
+                bench.cfp.set('zbca:bench','cert_replace_days',
+                              str(int(bench.ca.cert_default_days) + 1))
+            if scenario != 'warm':
+                if plugin is not None:
+                    plugin.shutdown()
+                plugin = BindPlugin(bench.cfp,bench.repository,cachesize)
+            if scenario not in options.scenarios and scenario != 'issue':
+                continue
+            # stage timings per scenario
+            for ca in plugin.cas.values():
+                ca.perf = SSLStats(ca.perf.name)
+            start = time.time()
+            latencies = run(plugin,hosts)
+            report(scenario,latencies,time.time() - start,plugin,
+                   options.stages)
+    finally:
+        if plugin is not None:
+            plugin.shutdown()
+        bench.cleanup()
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='\n'.join(__doc__.strip().splitlines()[-2:]))
+    parser.add_option('-b',dest='bits',type='int',default=512,
+                      help='key bits [%default]')
+    parser.add_option('-i',dest='backend',default='xml',
+                      help='index backend [%default]')
+    parser.add_option('-t',dest='store',default='files',
+                      help='text store [%default]')
+    parser.add_option('-c',dest='cachesize',type='int',default=None,
+                      help='bind cache size [the whole fleet]')
+    parser.add_option('--scenario',dest='scenarios',action='append',
+                      default=[],help='run only this scenario; may be '
+                      'repeated (the fleet is always issued first): %s' %
+                      ', '.join(SCENARIOS))
+    parser.add_option('--stages',dest='stages',action='store_true',
+                      default=False,help='show the CA\'s bind stage timings')
+    parser.add_option('--fleet',dest='fleet',type='int',default=None,
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+    for scenario in options.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario "%s"' % scenario)
+    options.scenarios = options.scenarios or SCENARIOS
+
+    if options.fleet:
+        fleet(options,options.fleet)
+        return 0
+
+    for size in [int(arg) for arg in args] or [1000, 10000, 100000]:
+        status = subprocess.call([sys.executable,__file__,
+                                  '--fleet',str(size)] + argv)
+        if status:
+            return status
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
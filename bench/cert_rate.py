@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+Benchmark cert issuance:  certs per second through SSLCert.genCrypto()
+against the old path, which built an SSLReq (element, uuid, signed
+req, PEM) and parsed it back for its subject and public key, and
+parsed the extensions config for every cert
+
+Two cases:  certs for new hosts, whose keys are generated on the
+way, and certs for hosts whose keys already exist, as when certs
+are renewed
+
+Usage:  cert_rate.py [-n certs] [-b bits]
+'''
+import optparse
+import os
+import sys
+import time
+import uuid
+from OpenSSL import crypto
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA, Metadata
+from Bcfg2.Server.Plugins.ZBCA.SSLObj import SSLCert, certInfo
+
+PATH = '/etc/pki/tls/certs/localhost.crt'
+KEY = '/etc/pki/tls/private/localhost.key'
+
+class OldSSLCert(SSLCert):
+    '''SSLCert with genCrypto() as it was before the direct path'''
+    def ssltype(self):
+        return 'SSLCert'
+
+    def genCrypto(self):
+        defaults = {
+            'ca'                : self.ca.name,
+            'days'              : self.ca.cert_default_days,
+            'extensions'        : self.ca.cert_default_extensions,
+            'owner'             : 'root',
+            'group'             : 'root',
+            'mode'              : '0600',
+            'uuid'              : str(uuid.uuid4())
+            }
+        defaults.update(self.elt.items())
+        self.elt.update(defaults)
+
+        # the SSLReq round trip, now gone from SSLObj:  a req built,
+        # signed and dumped to PEM, then parsed back
+        keytext = self.ca.initSSLObj(self.keyAttrs(), self.metadata).text
+        req = crypto.load_certificate_request(
+            crypto.FILETYPE_PEM, genReqText(self.subject(), keytext,
+                                            self.ca.cert_default_md))
+
+        cacert = self.ca.caObj('SSLCACert').cryptoObj()
+        cakey = self.ca.caObj('SSLCAKey').cryptoObj()
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.set_subject(req.get_subject())
+        cert.set_serial_number(self.ca.newSerial())
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(int(self.attrib('days')) * 24 * 60 * 60)
+        cert.set_issuer(cacert.get_subject())
+        cert.set_pubkey(req.get_pubkey())
+        cert.add_extensions([
+                makeExtension(name,val,cert,cacert) for name, val in
+                self.ca.extensions[self.attrib('extensions')].items])
+        cert.sign(cakey, self.ca.cert_default_md)
+        self.text = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+        for attrname, value in certInfo(cert).items():
+            self.attrib(attrname, value)
+
+def genReqText(subject,keytext,md):
+    '''Build a signed cert request and return its PEM text'''
+    req = crypto.X509Req()
+    req.set_version(2)
+    for f, value in subject:
+        setattr(req.get_subject(),f.upper(),value)
+    key = crypto.load_privatekey(crypto.FILETYPE_PEM, keytext)
+    req.set_pubkey(key)
+    req.sign(key, md)
+    return crypto.dump_certificate_request(crypto.FILETYPE_PEM, req)
+
+def makeExtension(name,val,cert,cacert):
+    '''Config extension parsing as it was done for every cert'''
+    crit = False
+    kwargs = {}
+    args = val.split(';')
+    val = args.pop(0)
+    for arg in args:
+        arg = arg.lower().strip()
+        if arg == 'critical':
+            crit = True
+        elif arg.partition('=')[1]:
+            kwarg, sep, obj = arg.partition('=')
+            kwargs[kwarg] = obj == 'cert' and cert or cacert
+    return crypto.X509Extension(name, crit, val, **kwargs)
+
+def rate(ca,cls,hosts):
+    start = time.time()
+    for host in hosts:
+        cls(ca,{'type':'SSLCert','name':PATH,'key':KEY,'host':host},
+            Metadata(host))
+    return len(hosts) / (time.time() - start)
+
+def main(args):
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option('-n',dest='certs',type='int',default=200)
+    parser.add_option('-b',dest='bits',type='int',default=2048)
+    options, args = parser.parse_args(args)
+
+    bench = BenchCA(bits=options.bits)
+    try:
+        ca = bench.ca
+        print('%-24s %12s %12s' % ('certs/s','req (old)','direct'))
+        n = options.certs
+        hosts = ['host%05d.example.com' % i for i in range(4 * n)]
+        new = (rate(ca,OldSSLCert,hosts[:n]),
+               rate(ca,SSLCert,hosts[n:2*n]))
+        print('%-24s %12.1f %12.1f' % (('new keys',) + new))
+        # the keys of the hosts above now exist
+        existing = (rate(ca,OldSSLCert,hosts[n:2*n]),
+                    rate(ca,SSLCert,hosts[:n]))
+        print('%-24s %12.1f %12.1f' % (('existing keys',) + existing))
+    finally:
+        bench.cleanup()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+Benchmark CRL builds:  revoke a large number of serials, then time
+a full CRL build against incremental refreshes after a few more
+revocations, and check the CRL on disk lists every revoked serial
+
+Usage:  crl_build.py [-n revoked] [-i increments] [-b index_backend]
+'''
+import optparse
+import os
+import sys
+import time
+from OpenSSL import crypto
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('-n',dest='revoked',type='int',default=10000,
+                      help='revoked serials [%default]')
+    parser.add_option('-i',dest='increments',type='int',default=10,
+                      help='incremental refreshes to time [%default]')
+    parser.add_option('-b',dest='backend',default='sqlite',
+                      help='index backend [%default]')
+    options, args = parser.parse_args(argv)
+
+    bench = BenchCA('index_backend = %s' % options.backend,start=False)
+    try:
+        ca = bench.ca
+        ca.index.defer()
+        with ca.lock:
+            for serial in range(2,options.revoked + 2):
+                ca.storeRevoked(serial,'superseded')
+        ca.index.commit()
+
+        start = time.time()
+        ca.revocation.refresh()
+        full = time.time() - start
+
+        incremental = 0
+        for i in range(options.increments):
+            with ca.lock:
+                ca.storeRevoked(options.revoked + 2 + i,'keyCompromise')
+            start = time.time()
+            ca.revocation.refresh()
+            incremental += time.time() - start
+
+        crl = crypto.load_crl(crypto.FILETYPE_PEM,
+                              ca.caObj('SSLCRL').text)
+        listed = len(crl.get_revoked() or ())
+        expected = options.revoked + options.increments
+        print('%d revoked:  full build %.3fs, incremental refresh %.3fs' %
+              (expected,full,incremental / max(options.increments,1)))
+        if listed != expected:
+            print('FAIL: CRL lists %d serials, expected %d' %
+                  (listed,expected))
+            return 1
+        return 0
+    finally:
+        bench.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
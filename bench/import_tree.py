@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Benchmark 'zbca import':  write a tree of keys and certs signed by
+the bench CA in the old SSLCA plugin's layout, with certs before
+their keys in walk order, import it, and report the import rate and
+the process's peak memory
+
+Usage:  import_tree.py [-n hosts] [-b batch] [-i index_backend]
+'''
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from OpenSSL import crypto
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA
+from Bcfg2.Server.Plugins.ZBCA.SSLImport import SSLImporter
+
+def writeTree(ca,topdir,hosts):
+    '''Write a key and cert for each host'''
+    cakey = ca.caObj('SSLCAKey').cryptoObj()
+    cacert = ca.caObj('SSLCACert').cryptoObj()
+    for d in ('etc/pki/tls/certs/localhost.crt',
+              'etc/pki/tls/private/localhost.key'):
+        os.makedirs(os.path.join(topdir,d))
+    for i in range(hosts):
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 512)
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.get_subject().CN = 'h%d' % i
+        cert.set_serial_number(i + 2)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(24 * 60 * 60)
+        cert.set_issuer(cacert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(cakey, 'sha256')
+        for path, text in (
+            ('etc/pki/tls/certs/localhost.crt/localhost.crt.H_h%d' % i,
+             crypto.dump_certificate(crypto.FILETYPE_PEM, cert)),
+            ('etc/pki/tls/private/localhost.key/localhost.key.H_h%d' % i,
+             crypto.dump_privatekey(crypto.FILETYPE_PEM, key))):
+            f = open(os.path.join(topdir,path),'w')
+            f.write(text)
+            f.close()
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('-n',dest='hosts',type='int',default=2000,
+                      help='hosts [%default]')
+    parser.add_option('-b',dest='batch',type='int',default=500,
+                      help='import batch size [%default]')
+    parser.add_option('-i',dest='backend',default='sqlite',
+                      help='index backend [%default]')
+    options, args = parser.parse_args(argv)
+
+    bench = BenchCA('index_backend = %s' % options.backend,start=False)
+    topdir = tempfile.mkdtemp(prefix='zbca-import-')
+    try:
+        writeTree(bench.ca,topdir,options.hosts)
+        start = time.time()
+        counts = SSLImporter(bench.ca,batch=options.batch).run(topdir)
+        elapsed = time.time() - start
+        print('%d hosts:  %d imported in %.1fs, %.0f certs/s; peak RSS '
+              '%d MB' % (options.hosts,counts['imported'],elapsed,
+                         counts['imported'] / elapsed,
+                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                         // 1024))
+        saved = len(bench.reload().index.records('SSLCert'))
+        if counts['imported'] != options.hosts or saved != options.hosts:
+            print('FAIL: %d imported, %d in the saved index' %
+                  (counts['imported'],saved))
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(topdir)
+        bench.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
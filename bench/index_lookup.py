@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Benchmark SSLObjIndex.search() lookup time against index size
+
+Compares the (ssltype, name, host) lookup table with the XPath scan
+that search() used to do over the whole index tree
+
+Usage:  index_lookup.py [size ...]
+'''
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Bcfg2', 'Server', 'Plugins', 'ZBCA'))
+from SSLObjIndex import SSLObjIndex
+from SSLRecord import SSLRecord
+from SSLStats import SSLStats
+
+PATHS = ('/etc/pki/tls/private/localhost.key',
+         '/etc/pki/tls/certs/localhost.crt')
+
+class BenchCA(object):
+    '''Just enough of an SSLCA for SSLObjIndex'''
+    def __init__(self,basepath):
+        self.name = 'bench'
+        self.basepath = basepath
+        self.index_backend = 'xml'
+        self.index_journal = 'false'
+        self.index_journal_records = '1000'
+        self.index_journal_bytes = '1048576'
+        self.perf = SSLStats('bench')
+
+class BenchObj(object):
+    '''Just enough of an SSLObj for SSLObjIndex.store()'''
+    def __init__(self,ssltype,name,host):
+        self.elt = SSLRecord(ssltype,name=name,host=host,type='file')
+    def ssltype(self):
+        return self.elt.tag
+
+def xpathSearch(tree,ssltype,name,hostname):
+    '''The old SSLObjIndex.search() implementation, on an XML tree'''
+    xpath = '//%s[@host="%s"][@name="%s"]' % \
+        (ssltype,hostname,name)
+    results = tree.xpath(xpath)
+    return results and results[0] or None
+
+def timeit(func,keys):
+    start = time.time()
+    for key in keys:
+        func(*key)
+    return (time.time() - start) / len(keys)
+
+def bench(size,lookups=200):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        index = SSLObjIndex(BenchCA(tmpdir))
+        hosts = ['host%06d.example.com' % i for i in range(size // 2)]
+        for host in hosts:
+            index.store(BenchObj('SSLKey',PATHS[0],host))
+            index.store(BenchObj('SSLCert',PATHS[1],host))
+        keys = [('SSLCert',PATHS[1],random.choice(hosts))
+                for i in range(lookups)]
+        dictTime = timeit(index.search,keys)
+        tree = index.toTree()
+        xpathTime = timeit(lambda *k: xpathSearch(tree,*k),
+                           keys[:max(lookups // 20,5)])
+        return dictTime, xpathTime
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main(args):
+    sizes = [int(a) for a in args] or [1000, 10000, 100000]
+    print('%10s %14s %14s' % ('entries','dict (us)','xpath (us)'))
+    for size in sizes:
+        dictTime, xpathTime = bench(size)
+        print('%10d %14.2f %14.2f' % (size,dictTime*1e6,xpathTime*1e6))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
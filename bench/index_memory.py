@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+Benchmark the memory an index entry takes:  an lxml element in a
+tree, referenced from a lookup dict, as the index used to keep its
+entries, against an SSLRecord
+
+Each representation is measured in a fresh process, from the growth
+of its resident memory while a key and a cert entry per host, with
+the attributes ZBCA records, are built and indexed.
+
+Usage:  index_memory.py [-n hosts]
+'''
+import optparse
+import os
+import subprocess
+import sys
+import time
+import uuid
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Bcfg2', 'Server', 'Plugins', 'ZBCA'))
+from SSLObjIndex import SSLObjIndex
+from SSLRecord import SSLRecord
+
+KEY = '/etc/pki/tls/private/localhost.key'
+CERT = '/etc/pki/tls/certs/localhost.crt'
+
+def entries(hosts):
+    '''Yield (tag, attrs) for a key and a cert per host'''
+    now = int(time.time())
+    for i in range(hosts):
+        host = 'host%06d.example.com' % i
+        common = {'host' : host, 'type' : 'file', 'ca' : 'default_ca',
+                  'owner' : 'root', 'group' : 'root', 'mode' : '0600'}
+        yield 'SSLKey', dict(common,name=KEY,algorithm='rsa',bits='2048',
+                             uuid=str(uuid.uuid4()))
+        yield 'SSLCert', dict(common,name=CERT,key=KEY,days='365',
+                              extensions='server',serial=str(i + 2),
+                              not_before=str(now),
+                              not_after=str(now + 365*24*60*60),
+                              subject_hash='%08x' % i,
+                              uuid=str(uuid.uuid4()))
+
+def buildTree(hosts):
+    '''The old index:  a tree of elements and a lookup dict'''
+    root = etree.Element('ZBCAIndex')
+    containers = dict([(tag, etree.SubElement(root,tag + 's'))
+                       for tag in ('SSLKey','SSLCert')])
+    lookup = {}
+    for tag, attrs in entries(hosts):
+        elt = etree.SubElement(containers[tag],tag,attrs)
+        lookup[SSLObjIndex.eltKey(elt)] = elt
+    return root, lookup
+
+def buildRecords(hosts):
+    '''The index now:  SSLRecords in the lookup dict'''
+    lookup = {}
+    for tag, attrs in entries(hosts):
+        elt = SSLRecord(tag,attrs)
+        lookup[SSLObjIndex.eltKey(elt)] = elt
+    return lookup
+
+def residentKB():
+    f = open('/proc/self/statm')
+    try:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    finally:
+        f.close()
+
+def measure(mode,hosts):
+    '''Print the resident memory growth building one representation'''
+    before = residentKB()
+    start = time.time()
+    index = {'tree' : buildTree, 'records' : buildRecords}[mode](hosts)
+    print('%d %.2f' % (residentKB() - before,time.time() - start))
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('-n',dest='hosts',type='int',default=50000,
+                      help='hosts, two entries each [%default]')
+    parser.add_option('--measure',dest='measure',default=None,
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+    if options.measure:
+        measure(options.measure,options.hosts)
+        return 0
+
+    entries = options.hosts * 2
+    print('%d entries:' % entries)
+    for mode in ('tree','records'):
+        out = subprocess.check_output([sys.executable,__file__,'-n',
+                                       str(options.hosts),
+                                       '--measure',mode])
+        kb, seconds = out.split()
+        print('  %-8s %8.1f MB  %6d bytes/entry  built in %ss' %
+              (mode,int(kb) / 1024.0,int(kb) * 1024 // entries,seconds))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
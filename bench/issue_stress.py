@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+Stress test for concurrent issuance:  many threads bind certs at
+once, as Bcfg2's threaded server does, some of them for the same
+hosts; then check every cert got a unique serial, each host got
+exactly one cert and key, and the index saved on disk has them all
+
+Usage:  issue_stress.py [-t threads] [-n hosts] [-p issue_processes]
+'''
+import optparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA, Metadata
+
+PATH = '/etc/pki/tls/certs/localhost.crt'
+KEY = '/etc/pki/tls/private/localhost.key'
+
+def binder(ca,hosts,errors):
+    for host in hosts:
+        try:
+            ca.initSSLObj({'type':'SSLCert','name':PATH,'key':KEY,
+                           'host':host},Metadata(host))
+        except Exception as e:
+            errors.append((host,e))
+
+def check(ca,hosts):
+    '''Return a list of problems found in the CA's index'''
+    problems = []
+    certs = ca.index.records('SSLCert')
+    keys = ca.index.records('SSLKey')
+    serials = [int(elt.get('serial')) for elt in certs]
+    if len(set(serials)) != len(serials):
+        problems.append('%d duplicate serials' %
+                        (len(serials) - len(set(serials))))
+    for ssltype, elts in (('certs',certs),('keys',keys)):
+        if len(elts) != len(hosts) or \
+                set([elt.get('host') for elt in elts]) != set(hosts):
+            problems.append('%d %s for %d hosts' %
+                            (len(elts),ssltype,len(hosts)))
+    if serials and ca.index.getCAState('serial',0,int) < max(serials):
+        problems.append('CA serial %s is behind issued serial %d' %
+                        (ca.index.getCAState('serial'),max(serials)))
+    return problems
+
+def main(args):
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option('-t',dest='threads',type='int',default=16)
+    parser.add_option('-n',dest='hosts',type='int',default=200)
+    parser.add_option('-p',dest='processes',type='int',default=0,
+                      help='issue_processes (0 = sign in the threads)')
+    parser.add_option('-b',dest='bits',type='int',default=1024)
+    options, args = parser.parse_args(args)
+
+    bench = BenchCA(extra='issue_processes = %d' % options.processes,
+                    bits=options.bits)
+    try:
+        hosts = ['host%05d.example.com' % i for i in range(options.hosts)]
+        # each thread takes an overlapping slice, so most hosts are
+        # bound by two threads at once
+        step = max(len(hosts) // options.threads,1)
+        errors = []
+        threads = [threading.Thread(target=binder,
+                                    args=(bench.ca,
+                                          (hosts + hosts)[i*step:(i+2)*step],
+                                          errors))
+                   for i in range(options.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        bound = set()
+        for i in range(options.threads):
+            bound.update((hosts + hosts)[i*step:(i+2)*step])
+        problems = ['%s: %s' % e for e in errors[:10]]
+        problems += check(bench.ca,bound)
+        problems += ['on disk: %s' % p for p in check(bench.reload(),bound)]
+        print('%d threads, %d hosts, issue_processes=%d:  %.1f certs/s' %
+              (options.threads,len(bound),options.processes,
+               len(bound) / elapsed))
+        for problem in problems:
+            print('FAIL: %s' % problem)
+        return problems and 1 or 0
+    finally:
+        bench.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+'''
+Benchmark key algorithms:  key generation time, the time for a CA
+with a key of that type to sign a cert, and the PEM size of a key
+plus cert as bound into a Path entry
+
+Usage:  key_algos.py [-n rounds] [algorithm:size ...]
+'''
+import optparse
+import os
+import sys
+import time
+from OpenSSL import crypto
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Bcfg2', 'Server', 'Plugins', 'ZBCA'))
+from SSLObj import genKey, issueCertText, signWith, validKeySpec
+from SSLExtensionProfile import SSLExtensionProfile
+
+SPECS = ('rsa:2048', 'rsa:3072', 'rsa:4096', 'dsa:2048',
+         'ec:secp256r1', 'ec:secp384r1', 'ec:secp521r1', 'ed25519:')
+
+SUBJECT = [('C','US'), ('O','Example'), ('CN','host.example.com')]
+EXTENSIONS = SSLExtensionProfile('bench',[
+        ('basicConstraints','CA:FALSE'),
+        ('keyUsage','digitalSignature,keyEncipherment'),
+        ('subjectKeyIdentifier','hash;subject=cert'),
+        ('authorityKeyIdentifier','keyid;issuer=ca')])
+
+def makeCA(key):
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = 'Bench CA'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([
+        crypto.X509Extension('basicConstraints', True, 'CA:TRUE'),
+        crypto.X509Extension('subjectKeyIdentifier', False, 'hash',
+                             subject=cert)])
+    signWith(cert, key, 'sha256')
+    return cert
+
+def bench(spec,rounds):
+    start = time.time()
+    keys = [genKey(*spec) for i in range(rounds)]
+    genTime = (time.time() - start) / rounds
+
+    cakey = keys[0]
+    cacert = makeCA(cakey)
+    start = time.time()
+    for i, key in enumerate(keys):
+        text, info = issueCertText(SUBJECT, key, i + 2, 365, 'sha256',
+                                   EXTENSIONS, cacert, cakey)
+    signTime = (time.time() - start) / rounds
+
+    size = len(text) + len(crypto.dump_privatekey(crypto.FILETYPE_PEM,
+                                                  keys[-1]))
+    return genTime, signTime, size
+
+def main(args):
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option('-n',dest='rounds',type='int',default=20)
+    options, args = parser.parse_args(args)
+
+    print('%-16s %14s %14s %12s' %
+          ('algorithm','keygen (ms)','sign (ms)','PEM bytes'))
+    for spec in (args or SPECS):
+        spec = tuple(spec.partition(':')[::2])
+        if not validKeySpec(*spec):
+            print('%-16s %s' % (':'.join(spec),'unsupported here'))
+            continue
+        genTime, signTime, size = bench(spec,options.rounds)
+        print('%-16s %14.2f %14.2f %12d' %
+              (':'.join(spec).rstrip(':'),genTime*1e3,signTime*1e3,size))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+Benchmark the OCSP responder:  the cost of answering a query from
+a pre-signed cached response, against signing one per query, for
+a CA with a number of issued certs (needs the cryptography package)
+
+Usage:  ocsp_query.py [-n certs] [-q queries]
+'''
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA
+from Bcfg2.Server.Plugins.ZBCA.SSLRecord import SSLRecord
+from cryptography.x509 import ocsp
+from cryptography.hazmat.primitives import hashes, serialization
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('-n',dest='certs',type='int',default=1000,
+                      help='indexed certs [%default]')
+    parser.add_option('-q',dest='queries',type='int',default=2000,
+                      help='queries to time [%default]')
+    options, args = parser.parse_args(argv)
+
+    bench = BenchCA('index_backend = sqlite',start=False)
+    try:
+        ca = bench.ca
+        # index entries are all the responder reads; no certs needed
+        notAfter = str(int(time.time()) + 365 * 24*60*60)
+        ca.index.defer()
+        with ca.lock:
+            for serial in range(2,options.certs + 2):
+                ca.index.storeElt(SSLRecord(
+                        'SSLCert',name='/cert.pem',host='h%d' % serial,
+                        serial=str(serial),not_after=notAfter))
+        ca.index.commit()
+
+        responder = ca.ocsp
+        responder.load()
+        responder.build()
+        start = time.time()
+        responder.presign()
+        presign = time.time() - start
+
+        serials = [random.randint(2,options.certs + 1)
+                   for i in range(options.queries)]
+        requests = [ocsp.OCSPRequestBuilder().add_certificate(
+                responder.stubCert(serial),responder.issuer,
+                hashes.SHA1()).build().public_bytes(
+                serialization.Encoding.DER) for serial in serials]
+
+        start = time.time()
+        for der in requests:
+            responder.respond(der)
+        cached = time.time() - start
+
+        start = time.time()
+        for der in requests:
+            responder.responses.clear()
+            responder.respond(der)
+        signed = time.time() - start
+
+        print('%d certs:  presign %.2fs; %.0f queries/s cached, '
+              '%.0f queries/s signing each' %
+              (options.certs,presign,options.queries / cached,
+               options.queries / signed))
+        return 0
+    finally:
+        bench.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
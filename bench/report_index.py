@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Benchmark 'zbca report':  fill a CA index with synthetic key and
+cert entries (no PEM files, so the report fails if it reads any),
+then time loading the index and building the CSV report and the
+weekly expiry histogram
+
+Usage:  report_index.py [-n certs] [-b index_backend]
+'''
+import optparse
+import os
+import random
+import sys
+import time
+import uuid
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA
+from Bcfg2.Server.Plugins.ZBCA.SSLRecord import SSLRecord
+from Bcfg2.Server.Plugins.ZBCA.SSLReport import SSLReport
+
+def fill(ca,certs):
+    '''Add a key and cert entry per host, expiring over two years'''
+    now = int(time.time())
+    ca.index.defer()
+    with ca.lock:
+        for i in range(certs):
+            host = 'host%06d.example.com' % i
+            ca.index.storeElt(SSLRecord(
+                    'SSLKey',name='/etc/pki/tls/private/localhost.key',
+                    host=host,type='file',algorithm='rsa',bits='2048',
+                    uuid=str(uuid.uuid4())))
+            notAfter = now + random.randint(-30,730) * 24*60*60
+            ca.index.storeElt(SSLRecord(
+                    'SSLCert',name='/etc/pki/tls/certs/localhost.crt',
+                    host=host,type='file',
+                    key='/etc/pki/tls/private/localhost.key',
+                    serial=str(i + 2),not_before=str(notAfter - 365*24*60*60),
+                    not_after=str(notAfter),uuid=str(uuid.uuid4())))
+    ca.index.commit()
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('-n',dest='certs',type='int',default=100000,
+                      help='certs [%default]')
+    parser.add_option('-b',dest='backend',default='sqlite',
+                      help='index backend [%default]')
+    options, args = parser.parse_args(argv)
+
+    bench = BenchCA('index_backend = %s' % options.backend,start=False)
+    try:
+        fill(bench.ca,options.certs)
+
+        start = time.time()
+        ca = bench.reload()
+        loaded = time.time() - start
+
+        start = time.time()
+        report = SSLReport(ca)
+        out = StringIO()
+        report.writeCSV(out)
+        report.writeCSV(StringIO(),histogram=True)
+        built = time.time() - start
+
+        rows = out.getvalue().count('\n') - 1
+        print('%d certs:  index load %.2fs, report %.2fs' %
+              (options.certs,loaded,built))
+        if rows != options.certs:
+            print('FAIL: %d report rows' % rows)
+            return 1
+        return 0
+    finally:
+        bench.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Benchmark 'zbca verify':  issue a key and cert per host in a bench
+CA, then time verifying the whole index with each number of worker
+processes given, and check that a cert signed by another key fails
+
+Usage:  verify_index.py [-n certs] [-b bits] [-t text_store]
+        [processes ...]
+'''
+import copy
+import optparse
+import os
+import sys
+import time
+from OpenSSL import crypto
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchca import BenchCA, Metadata
+
+def issue(ca,certs):
+    '''Issue a key and cert per host; write the index once'''
+    ca.index.defer()
+    try:
+        for i in range(certs):
+            host = 'host%06d.example.com' % i
+            ca.initSSLObj({'type' : 'SSLCert',
+                           'name' : '/etc/pki/tls/certs/localhost.crt',
+                           'key' : '/etc/pki/tls/private/localhost.key',
+                           'host' : host},Metadata(host))
+    finally:
+        with ca.lock:
+            ca.index.commit()
+
+def forge(ca,host):
+    '''Re-sign a host's cert with a stranger's key'''
+    elt = copy.copy(ca.index.search('SSLCert',
+                                    '/etc/pki/tls/certs/localhost.crt',host))
+    cert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                   ca.textstore.read(elt))
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    cert.sign(key, 'sha256')
+    ca.textstore.write(elt,crypto.dump_certificate(crypto.FILETYPE_PEM,cert))
+    with ca.lock:
+        ca.index.updateElt(elt)
+        ca.index.write()
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='\n'.join(__doc__.strip().splitlines()[-2:]))
+    parser.add_option('-n',dest='certs',type='int',default=10000,
+                      help='certs [%default]')
+    parser.add_option('-b',dest='bits',type='int',default=512,
+                      help='key bits [%default]')
+    parser.add_option('-t',dest='store',default='files',
+                      help='text store [%default]')
+    options, args = parser.parse_args(argv)
+
+    bench = BenchCA('text_store = %s' % options.store,bits=options.bits,
+                    start=False)
+    try:
+        start = time.time()
+        issue(bench.ca,options.certs)
+        print('%d certs issued in %.1fs' %
+              (options.certs,time.time() - start))
+        forge(bench.ca,'host000000.example.com')
+
+        for processes in [int(arg) for arg in args] or [1, 0]:
+            start = time.time()
+            count, failed = bench.ca.verifier.verifyIndex(processes)
+            elapsed = time.time() - start
+            print('  %-8s %8d certs %8.1fs %9.0f certs/s  %d failed' %
+                  (processes or 'per-CPU',count,elapsed,count / elapsed,
+                   len(failed)))
+            if count != options.certs or len(failed) != 1:
+                print('FAIL: expected %d certs, 1 failed' % options.certs)
+                return 1
+        return 0
+    finally:
+        bench.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
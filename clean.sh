@@ -5,7 +5,7 @@ DIR=ZBCA/CA/int2
 # trash emacs shit
 find ZBCA -name \*~ -exec rm '{}' \;
 
-rm -f $DIR/index.xml
+rm -f $DIR/index.xml $DIR/index.journal
 rm -f $DIR/SSLCert/*
 rm -f $DIR/SSLKey/*
 
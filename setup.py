@@ -16,10 +16,16 @@ setup(
       url='https://github.com/zultron/bcfg2-ZBCA',
       packages=['Bcfg2.Server.Plugins.ZBCA',
                 ],
+      scripts=['zbca',
+               ],
       install_requires=[
         'Bcfg2.Server',
         'OpenSSL',
         ],
+      extras_require={
+        # 'ec' and 'ed25519' keys
+        'ec' : ['cryptography'],
+        },
       license='GPL v2+',
       classifiers=[
         'Development Status :: 3 - Alpha',